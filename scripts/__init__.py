@@ -0,0 +1,6 @@
+import pandas as pd
+
+# Pipelines rely on copy-on-write: stages return new frames sharing the data of their input,
+# which is only copied when it is modified. Always on from pandas 3
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
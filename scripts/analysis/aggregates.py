@@ -1,21 +1,59 @@
 """Common functions for aggregating data into groups"""
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
 import pandas as pd
-import country_converter as coco
-from bblocks.dataframe_tools.add import add_income_level_column
 
+from scripts.lazy import LazyModule
+from scripts.analysis import income_levels
 from scripts.analysis.common import add_pop, add_gge_usd_const_2022, add_gdp_usd_const_2022, add_che_usd2022
+from scripts.analysis.engines import engine_dispatch
+
+coco = LazyModule("country_converter")
+
+
+# aggregation functions implemented by the other engines
+dispatch = engine_dispatch({"duckdb": "scripts.analysis.aggregates_duckdb",
+                            "polars": "scripts.analysis.aggregates_polars",
+                            "cube": "scripts.analysis.aggregates_cube"})
 
+# groupings, in the order they are returned by the aggregation functions
+GROUPINGS = ["continent", "income_level"]
 
+# aggregates are made up to this year (later values are preliminary)
+LAST_AGGREGATE_YEAR: int = 2022
 
-def expand_df(df):
+# the groups computed by the aggregation functions (None for all), see `requested_groups`
+_requested_groups: ContextVar[tuple[str, ...] | None] = ContextVar("requested_groups", default=None)
+
+
+@contextmanager
+def requested_groups(groups: list[str] | None):
+    """Only compute these groups in the aggregations run inside the block (in this thread)
+
+    The membership, completion and sums of the other groups are skipped. None computes
+    every group.
     """
-    Expand the dataframe to include all years for each country
+
+    token = _requested_groups.set(None if groups is None else tuple(groups))
+    try:
+        yield
+    finally:
+        _requested_groups.reset(token)
+
+
+def expand_df(df, years=None):
+    """
+    Expand the dataframe to include all years (or `years`) for each country
     """
 
     return (df
             .set_index(["iso3_code", "year"])
-            .pipe(lambda d: d.reindex(pd.MultiIndex.from_product([d.index.get_level_values("iso3_code").unique(), d.index.get_level_values("year").unique()],names=["iso3_code", "year"])))
+            .pipe(lambda d: d.reindex(pd.MultiIndex.from_product([d.index.get_level_values("iso3_code").unique(),
+                                                                  d.index.get_level_values("year").unique() if years is None else years],
+                                                                 names=["iso3_code", "year"])))
             .reset_index()
             )
 
@@ -26,15 +64,28 @@ def ffill_df(df):
 
     return(df
            .sort_values(["iso3_code", "year"])
-           .pipe(lambda d: d.assign(**d.groupby("iso3_code").ffill(limit=2)))
+           .pipe(lambda d: d.assign(**d.groupby("iso3_code")[d.columns.drop(["iso3_code", "year"])].ffill(limit=2)))
            )
 
+def continents(iso3_codes: pd.Series) -> pd.Series:
+    """The continent of each iso3 code, converting each distinct code once"""
+
+    codes = iso3_codes.dropna().unique()
+    converted = coco.convert(list(codes), src="ISO3", to="continent")
+
+    return iso3_codes.map(dict(zip(codes, converted if isinstance(converted, list) else [converted])))
+
+
 def add_africa_low_middle_income(df, col_name = "group"):
-    """Add a group for Africa low and lower middle income countries"""
+    """Add a group for Africa low and lower middle income countries
+
+    With the historical income classification (see `income_levels`), a country is in the
+    group in the years it was low or lower middle income (`df` must have a year column).
+    """
 
     afr_df = (df
-              .pipe(add_income_level_column, "iso3_code", 'ISO3')
-              .assign(continent = lambda d: coco.convert(d.iso3_code, src="ISO3", to="continent"))
+              .pipe(income_levels.add_income_level, "iso3_code")
+              .assign(continent = lambda d: continents(d.iso3_code))
               .loc[lambda d: (d.continent == "Africa") & (d.income_level.isin(["Low income", "Lower middle income"]))]
               .drop(columns = ['continent', 'income_level'])
               .assign(**{col_name: 'Africa (Low and lower middle income)'})
@@ -42,8 +93,8 @@ def add_africa_low_middle_income(df, col_name = "group"):
 
     return pd.concat([df, afr_df], ignore_index=True)
 
-def add_group(df: pd.DataFrame, group: str) -> pd.DataFrame:
-    """Add a group column to the dataframe
+def _assign_group(df: pd.DataFrame, group: str) -> pd.DataFrame:
+    """Add a group column to the dataframe, converting the iso3 code of every row
 
     df: the dataframe
     group: the group to add, either "continent" or "income_level"
@@ -51,18 +102,113 @@ def add_group(df: pd.DataFrame, group: str) -> pd.DataFrame:
 
     if group == "continent":
         return (df
-                .assign(group = lambda d: coco.convert(d.iso3_code, src="ISO3", to='continent'))
+                .assign(group = lambda d: continents(d.iso3_code))
                 .pipe(add_africa_low_middle_income, col_name = "group")
                 )
 
     elif group == "income_level":
         return (df
-                .pipe(add_income_level_column, "iso3_code", 'ISO3', target_column= 'group')
+                .pipe(income_levels.add_income_level, "iso3_code", target_column= 'group')
                 )
 
     else:
         raise ValueError(f"Invalid group: {group}")
 
+@lru_cache
+def _country_groups(iso3_codes: tuple, groupings: tuple, years: tuple | None = None) -> pd.DataFrame:
+    countries = pd.DataFrame({"iso3_code": list(iso3_codes)})
+    columns = ["iso3_code", "grouping", "group"]
+
+    if years is not None:
+        countries = countries.merge(pd.DataFrame({"year": list(years)}), how="cross")
+        columns = ["iso3_code", "year", "grouping", "group"]
+
+    return pd.concat(
+        [countries.pipe(_assign_group, grouping).assign(grouping=GROUPINGS.index(grouping))
+         for grouping in groupings],
+        ignore_index=True,
+    ).dropna(subset="group").loc[:, columns]
+
+
+def selected_groupings(continent: bool, income_level: bool) -> list[str]:
+    """The groupings to aggregate by, for the other engines"""
+
+    if not continent and not income_level:
+        raise ValueError("At least one of continent or income_level must be True")
+
+    return [g for g, selected in zip(GROUPINGS, [continent, income_level]) if selected]
+
+
+def membership_keys() -> list[str]:
+    """The columns the group members are joined on: the country, and its year with the historical income classification"""
+
+    return ["iso3_code", "year"] if income_levels.historical() else ["iso3_code"]
+
+
+def country_groups(iso3_codes, groupings: list[str], groups: list[str] | None = None, years=None) -> pd.DataFrame:
+    """The groups of each country (one row per country and group)
+
+    `grouping` is the position of the grouping in `GROUPINGS`. Only `groups` are returned,
+    by default the requested groups (see `requested_groups`). Results are cached by set of countries.
+
+    With the historical income classification (see `income_levels`), members change over
+    time: there is one row per country, year (of `years`) and group, with a year column.
+    """
+
+    groups = _requested_groups.get() if groups is None else groups
+    codes = tuple(sorted(pd.Series(iso3_codes).dropna().unique()))
+
+    if income_levels.historical():
+        if years is None:
+            raise ValueError("The groups of the historical income classification need the years")
+        members = _country_groups(codes, tuple(groupings), tuple(sorted(pd.Series(years).dropna().unique().tolist())))
+    else:
+        members = _country_groups(codes, tuple(groupings))
+
+    if groups is not None:
+        members = members.loc[lambda d: d.group.isin(groups)]
+
+    return members.reset_index(drop=True)
+
+
+def add_group(df: pd.DataFrame, group: str, groups: list[str] | None = None) -> pd.DataFrame:
+    """Add a group column to the dataframe (one row per country and group)
+
+    df: the dataframe
+    group: the grouping, either "continent" or "income_level"
+    groups: only keep the rows of these groups. Defaults to the requested groups
+    """
+
+    if group not in GROUPINGS:
+        raise ValueError(f"Invalid group: {group}")
+
+    keys = membership_keys()
+    years = df.year.unique() if "year" in df.columns else None
+    members = country_groups(df.iso3_code, [group], groups, years).loc[:, [*keys, "group"]]
+
+    return df.merge(members, on=keys, how="inner")
+
+
+def grouped(df: pd.DataFrame, group: str, groups: list[str] | None = None) -> pd.DataFrame:
+    """Expand and forward fill the data of the countries in `groups`, and add their group
+
+    Countries that are not in any of the groups are dropped first. The years are those of
+    the whole dataframe, so the result is the same as grouping every country and then
+    filtering the groups.
+    """
+
+    members = country_groups(df.iso3_code, [group], groups, df.year.unique())
+    if members.empty:
+        return df.iloc[:0].assign(group=pd.Series(dtype="str"))
+
+    return (df
+            .loc[lambda d: d.iso3_code.isin(members.iso3_code)]
+            .pipe(expand_df, years=df.year.unique())
+            .pipe(ffill_df)
+            .pipe(add_group, group, groups)
+            )
+
+
 def filter_threshold(df, threshold=0.95) -> pd.DataFrame:
     """Filter the dataframe to only include groups that have a completion rate of at least threshold
 
@@ -119,12 +265,14 @@ def agg_proportion(df: pd.DataFrame, denominator_col: str) -> pd.DataFrame:
             )
 
 
-def aggregate(df: pd.DataFrame, continent: bool=True, income_level: bool=True) -> pd.DataFrame:
+@dispatch
+def aggregate(df: pd.DataFrame, continent: bool=True, income_level: bool=True, *, groups: list[str] | None = None) -> pd.DataFrame:
     """Aggregate the dataframe
 
     df: the dataframe
     continent: whether to aggregate by continent
     income_level: whether to aggregate by income level
+    groups: only compute these groups. Defaults to the requested groups (see `requested_groups`)
 
     Returns:
         the aggregated dataframe
@@ -136,9 +284,7 @@ def aggregate(df: pd.DataFrame, continent: bool=True, income_level: bool=True) -
 
     if continent:
         cont_df = (df
-                .pipe(expand_df)
-                .pipe(ffill_df)
-                .pipe(add_group, "continent")
+                .pipe(grouped, "continent", groups)
                 .pipe(filter_threshold)
                 .pipe(agg)
                 )
@@ -147,19 +293,18 @@ def aggregate(df: pd.DataFrame, continent: bool=True, income_level: bool=True) -
 
     if income_level:
         income_df = (df
-                     .pipe(expand_df)
-                     .pipe(ffill_df)
-                     .pipe(add_group, "income_level")
+                     .pipe(grouped, "income_level", groups)
                      .pipe(filter_threshold)
                      .pipe(agg)
                      )
     else:
         income_df = pd.DataFrame()
 
-    return pd.concat([cont_df, income_df], ignore_index=True).loc[lambda d: d.year <= 2022]
+    return pd.concat([cont_df, income_df], ignore_index=True).loc[lambda d: d.year <= LAST_AGGREGATE_YEAR]
 
 
-def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominator_col: str, *, continent: bool=True, income_level: bool=True) -> pd.DataFrame:
+def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominator_col: str, *, continent: bool=True, income_level: bool=True,
+                         groups: list[str] | None = None) -> pd.DataFrame:
     """Aggregate the dataframe by proportion of the denominator
 
     Args:
@@ -168,6 +313,7 @@ def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominat
         denominator_col: the column to use as the denominator
         continent: whether to aggregate by continent
         income_level: whether to aggregate by income level
+        groups: only compute these groups. Defaults to the requested groups (see `requested_groups`)
 
     Returns:
         the aggregated dataframe
@@ -179,9 +325,7 @@ def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominat
 
     if continent:
         cont_df = (df
-                .pipe(expand_df)
-                .pipe(ffill_df)
-                .pipe(add_group, "continent")
+                .pipe(grouped, "continent", groups)
                 .pipe(filter_threshold)
                    .pipe(proportion_funct) # add the denominator column
                    .pipe(agg_proportion, denominator_col=denominator_col)
@@ -193,9 +337,7 @@ def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominat
 
     if income_level:
         income_df = (df
-                     .pipe(expand_df)
-                     .pipe(ffill_df)
-                     .pipe(add_group, "income_level")
+                     .pipe(grouped, "income_level", groups)
                      .pipe(filter_threshold)
                      .pipe(proportion_funct) # add the denominator column
                      .pipe(agg_proportion, denominator_col=denominator_col)
@@ -204,29 +346,32 @@ def aggregate_proportion(df: pd.DataFrame, proportion_funct: callable, denominat
     else:
         income_df = pd.DataFrame()
 
-    return pd.concat([cont_df, income_df], ignore_index=True).loc[lambda d: d.year <= 2022]
+    return pd.concat([cont_df, income_df], ignore_index=True).loc[lambda d: d.year <= LAST_AGGREGATE_YEAR]
 
 
-def aggregate_per_capita(df: pd.DataFrame, *, continent=True, income_level=True) -> pd.DataFrame:
+@dispatch
+def aggregate_per_capita(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
     """Aggregate per capita data"""
 
     return (df
-            .pipe(aggregate_proportion, add_pop, "population", continent=continent, income_level=income_level)
+            .pipe(aggregate_proportion, add_pop, "population", continent=continent, income_level=income_level, groups=groups)
             )
 
-def aggregate_pct_gge_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True)-> pd.DataFrame:
+@dispatch
+def aggregate_pct_gge_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None)-> pd.DataFrame:
     """Aggregate the percentage of general government expenditure in USD constant 2022"""
 
     return (df
-            .pipe(aggregate_proportion, add_gge_usd_const_2022, "gge_usd2022", continent=continent, income_level=income_level)
+            .pipe(aggregate_proportion, add_gge_usd_const_2022, "gge_usd2022", continent=continent, income_level=income_level, groups=groups)
             .assign(value = lambda d: d.value*100)
             )
 
-def aggregate_pct_che_usd2022(df, *, continent=True, income_level=True) -> pd.DataFrame:
+@dispatch
+def aggregate_pct_che_usd2022(df, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
     """Aggregate the percentage of current health expenditure in USD 2022"""
 
     return (df
-            .pipe(aggregate_proportion, add_che_usd2022, "che_usd2022", continent=continent, income_level=income_level)
+            .pipe(aggregate_proportion, add_che_usd2022, "che_usd2022", continent=continent, income_level=income_level, groups=groups)
             .assign(value = lambda d: d.value*100)
             )
 
@@ -238,10 +383,11 @@ def aggregate_pct_che_usd2022(df, *, continent=True, income_level=True) -> pd.Da
 #             .assign(value = lambda d: d.value*100)
 #             )
 
-def aggregate_pct_gdp_usd_const_2022(df, *, continent=True, income_level=True) -> pd.DataFrame:
+@dispatch
+def aggregate_pct_gdp_usd_const_2022(df, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
     """Aggregate the percentage of GDP in USD constant 2022"""
 
     return (df
-            .pipe(aggregate_proportion, add_gdp_usd_const_2022, "gdp_usd_const_2022", continent=continent, income_level=income_level)
+            .pipe(aggregate_proportion, add_gdp_usd_const_2022, "gdp_usd_const_2022", continent=continent, income_level=income_level, groups=groups)
             .assign(value = lambda d: d.value*100)
             )
@@ -0,0 +1,117 @@
+"""GHED aggregations run as array operations on the GHED cube.
+
+Same functions, arguments and results as `aggregates.py`, selected with
+`config.ENGINE = "cube"`. The data to aggregate becomes a countries x years panel (see
+`GhedCube`), so the country-year grid is the panel itself and the forward fill (limit 2)
+shifts it along the years axis. The group memberships are a groups x countries x years
+boolean array, so the completion threshold and the grouped sums are reductions over the
+countries axis. Denominators are selected from the GHED cube for the same countries and
+years, summed the same way, and divided with the cube ratios (`per_capita`, `pct_gdp`...).
+
+Country groups (continent, income level) are still assigned in pandas, for the unique
+countries and the requested groups only (see `aggregates.country_groups`).
+"""
+
+import numpy as np
+import pandas as pd
+
+from scripts.analysis.aggregates import LAST_AGGREGATE_YEAR, country_groups, selected_groupings
+from scripts.analysis.common import get_ghed_cube
+from scripts.analysis.cube import CHE, GDP, GGE, POPULATION, GhedCube
+
+# the denominator of each cube ratio
+RATIOS = {"per_capita": POPULATION, "pct_gdp": GDP, "pct_gge": GGE, "pct_che": CHE}
+
+# countries are not expected before the year they were created
+CREATED = {"SSD": 2011, "TLS": 2002}
+
+
+def _empty() -> pd.DataFrame:
+    return pd.DataFrame({"group": pd.Series(dtype="str"), "year": pd.Series(dtype="int64"),
+                         "value": pd.Series(dtype="float64")})
+
+
+def run_aggregation(df: pd.DataFrame, groupings: list[str], *, ratio: str | None = None,
+                    threshold: float = 0.95, groups: list[str] | None = None) -> pd.DataFrame:
+    """Aggregate the `value` of `df` (iso3_code, year, value) by group and year
+
+    Args:
+        df: the data to aggregate
+        groupings: "continent" and/or "income_level"
+        ratio: a `GhedCube` ratio (see `RATIOS`). If given, the result is the sum of the
+            values divided by the sum of its denominator, for the same countries and years
+        threshold: the share of countries with data a group needs in a year to be aggregated
+        groups: only compute these groups. Defaults to the requested groups (see
+            `aggregates.requested_groups`)
+
+    Returns:
+        a dataframe with the columns group, year and value
+    """
+
+    df = df.dropna(subset="iso3_code")
+    if df.empty:
+        return _empty()
+
+    # the years of the whole data, as in `aggregates.grouped`
+    data = GhedCube.from_frame(df.assign(indicator_code="value")).sel(years=np.sort(df.year.unique()))
+
+    members = (country_groups(data.countries, groupings, groups, data.years)
+               .sort_values(["grouping", "group"], kind="stable"))
+    if members.empty:
+        return _empty()
+
+    names, membership = data.membership(members)
+    sums, counts = data.group_sum(data.ffill(data.panel("value")), membership)
+
+    created = np.array([CREATED.get(code, 0) for code in data.countries])
+    expected = (membership & (data.years.to_numpy()[None, :] >= created[:, None])).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        complete = np.where(expected > 0, counts / expected, np.nan) >= threshold
+
+    if ratio is None:
+        values = sums
+    else:
+        denominator = RATIOS[ratio]
+        panel = get_ghed_cube().sel([denominator], data.countries, data.years).panel(denominator)
+        totals = GhedCube(np.stack([sums, data.group_sum(panel, membership)[0]]), ["value", denominator],
+                          names, data.years)
+        values = getattr(totals, ratio)("value")
+
+    keep = (complete & (data.years.to_numpy() <= LAST_AGGREGATE_YEAR)[None, :]).ravel()
+
+    return (data.to_frame(values, rows=names, dropna=False)
+            .loc[keep]
+            .reset_index(drop=True)
+            .astype({"group": "str", "year": "int64", "value": "float64"})
+            )
+
+
+def aggregate(df: pd.DataFrame, continent: bool = True, income_level: bool = True, *,
+              groups: list[str] | None = None) -> pd.DataFrame:
+    """Aggregate the dataframe by group and year"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), groups=groups)
+
+
+def aggregate_per_capita(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate per capita data"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), ratio="per_capita", groups=groups)
+
+
+def aggregate_pct_gge_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of general government expenditure in USD constant 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), ratio="pct_gge", groups=groups)
+
+
+def aggregate_pct_che_usd2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of current health expenditure in USD 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), ratio="pct_che", groups=groups)
+
+
+def aggregate_pct_gdp_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of GDP in USD constant 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), ratio="pct_gdp", groups=groups)
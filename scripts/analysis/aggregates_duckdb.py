@@ -0,0 +1,171 @@
+"""GHED aggregations run in an embedded DuckDB database.
+
+Same functions, arguments and results as `aggregates.py`, selected with
+`config.ENGINE = "duckdb"`. Each aggregation is a single query: the country-year grid,
+the forward fill (limit 2), the completion threshold and the grouped sums are evaluated
+by DuckDB over all cores, without materialising intermediate frames. Denominators are
+read from the GHED file (`ghed.parquet` if it exists, otherwise `ghed.csv`), loaded once
+into a database table for each version of the file.
+
+Country groups (continent, income level) are still assigned in pandas, for the unique
+countries and the requested groups only (see `aggregates.country_groups`), and joined on
+the country (and the year, with the historical income classification).
+"""
+
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.analysis.aggregates import LAST_AGGREGATE_YEAR, country_groups, membership_keys, selected_groupings
+from scripts.analysis.checkpoint import file_hash
+from scripts.config import PATHS
+from scripts.lazy import LazyModule
+
+duckdb = LazyModule("duckdb")
+
+_load_lock = threading.Lock()
+
+_QUERY = """
+WITH grid AS (
+    SELECT c.iso3_code, y.year, d.value
+    FROM (SELECT DISTINCT iso3_code FROM data) c
+    CROSS JOIN (SELECT DISTINCT year FROM data) y
+    LEFT JOIN data d ON d.iso3_code = c.iso3_code AND d.year = y.year
+),
+filled AS (
+    -- forward fill up to 2 years
+    SELECT iso3_code, year, coalesce(value, lag(value, 1) OVER w, lag(value, 2) OVER w) AS value
+    FROM grid
+    WINDOW w AS (PARTITION BY iso3_code ORDER BY year)
+),
+grouped AS (
+    SELECT g.grouping, g."group", f.iso3_code, f.year, f.value
+    FROM filled f
+    JOIN groups g USING ({keys})
+),
+complete AS (
+    -- countries are not expected before the year they were created
+    SELECT grouping, "group", year
+    FROM grouped
+    GROUP BY grouping, "group", year
+    HAVING count(value) / nullif(count(*) FILTER (WHERE NOT ((iso3_code = 'SSD' AND year < 2011)
+                                                        OR (iso3_code = 'TLS' AND year < 2002))), 0)
+           >= $threshold
+)
+SELECT "group", year, {value} AS value
+FROM grouped
+JOIN complete USING (grouping, "group", year)
+{denominator_join}
+WHERE year <= $last_year
+GROUP BY grouping, "group", year
+ORDER BY grouping, "group", year
+"""
+
+
+@lru_cache
+def _connection():
+    """In-memory database. DuckDB uses all cores by default"""
+    return duckdb.connect()
+
+
+def ghed_source() -> str:
+    """DuckDB table expression reading the GHED file"""
+
+    parquet = PATHS.raw_data / "ghed.parquet"
+    if parquet.exists():
+        return f"read_parquet('{_escape(parquet)}')"
+
+    return (f"read_csv('{_escape(PATHS.raw_data / 'ghed.csv')}', header = true, "
+            f"types = {{'year': 'BIGINT', 'value': 'DOUBLE'}})")
+
+
+def _escape(path: Path) -> str:
+    return str(path).replace("'", "''")
+
+
+def ghed_table() -> str:
+    """The name of a table with the GHED data, loaded from the file the first time it is used"""
+
+    parquet = PATHS.raw_data / "ghed.parquet"
+    name = f"ghed_{file_hash(parquet if parquet.exists() else PATHS.raw_data / 'ghed.csv')[:16]}"
+
+    with _load_lock:
+        _connection().execute(f"CREATE TABLE IF NOT EXISTS {name} AS "
+                              f"SELECT iso3_code, year, indicator_code, value FROM {ghed_source()}")
+
+    return name
+
+
+def run_aggregation(df: pd.DataFrame, groupings: list[str], *, denominator: str | None = None,
+                    scale: float = 1, threshold: float = 0.95, groups: list[str] | None = None) -> pd.DataFrame:
+    """Aggregate the `value` of `df` (iso3_code, year, value) by group and year
+
+    Args:
+        df: the data to aggregate
+        groupings: "continent" and/or "income_level"
+        denominator: a GHED indicator code. If given, the result is the sum of the values
+            divided by the sum of the indicator, for the same countries and years
+        scale: multiply the result by this (e.g. 100 for percentages)
+        threshold: the share of countries with data a group needs in a year to be aggregated
+        groups: only compute these groups. Defaults to the requested groups (see
+            `aggregates.requested_groups`)
+
+    Returns:
+        a dataframe with the columns group, year and value
+    """
+
+    con = _connection().cursor()
+    con.register("data", df)
+    con.register("groups", country_groups(df.iso3_code.unique(), groupings, groups, df.year.unique()))
+
+    if denominator is None:
+        value, denominator_join = "coalesce(sum(value), 0) * $scale", ""
+    else:
+        value = "coalesce(sum(value), 0) / coalesce(sum(denominator), 0) * $scale"
+        denominator_join = (f"LEFT JOIN (SELECT iso3_code, year, value AS denominator FROM {ghed_table()} "
+                            f"WHERE indicator_code = $indicator) USING (iso3_code, year)")
+
+    params = {"threshold": threshold, "last_year": LAST_AGGREGATE_YEAR, "scale": scale}
+    if denominator is not None:
+        params["indicator"] = denominator
+
+    try:
+        query = _QUERY.format(value=value, denominator_join=denominator_join, keys=", ".join(membership_keys()))
+        result = con.execute(query, params).df()
+    finally:
+        con.close()
+
+    return result.astype({"group": "str", "value": "float64"})
+
+
+def aggregate(df: pd.DataFrame, continent: bool = True, income_level: bool = True, *,
+              groups: list[str] | None = None) -> pd.DataFrame:
+    """Aggregate the dataframe by group and year"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), groups=groups)
+
+
+def aggregate_per_capita(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate per capita data"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), denominator="pop", groups=groups)
+
+
+def aggregate_pct_gge_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of general government expenditure in USD constant 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), denominator="gge_usd2022", scale=100, groups=groups)
+
+
+def aggregate_pct_che_usd2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of current health expenditure in USD 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), denominator="che_usd2022", scale=100, groups=groups)
+
+
+def aggregate_pct_gdp_usd_const_2022(df: pd.DataFrame, *, continent=True, income_level=True, groups=None) -> pd.DataFrame:
+    """Aggregate the percentage of GDP in USD constant 2022"""
+
+    return run_aggregation(df, selected_groupings(continent, income_level), denominator="gdp_usd2022", scale=100, groups=groups)
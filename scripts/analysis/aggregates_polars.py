@@ -0,0 +1,139 @@
+"""GHED aggregations as Polars lazy queries.
+
+Same functions and results as `aggregates.py`, selected with `config.ENGINE = "polars"`.
+The functions accept a pandas dataframe (and then return one) or a Polars LazyFrame (and
+then return a LazyFrame, so the builders in create_data_polars.py can compose them into a
+single query). Denominators are read from the `ghed` LazyFrame when given, otherwise from
+the GHED file.
+"""
+
+import pandas as pd
+
+from scripts.analysis.aggregates import LAST_AGGREGATE_YEAR, country_groups, membership_keys, selected_groupings
+from scripts.config import PATHS
+from scripts.lazy import LazyModule
+
+pl = LazyModule("polars")
+
+
+def scan_ghed():
+    """Lazily scan the GHED file (`ghed.parquet` if it exists, otherwise `ghed.csv`)"""
+
+    parquet = PATHS.raw_data / "ghed.parquet"
+    if parquet.exists():
+        return pl.scan_parquet(parquet)
+
+    return pl.scan_csv(PATHS.raw_data / "ghed.csv", schema_overrides={"year": pl.Int64, "value": pl.Float64})
+
+
+def run_aggregation(data, groupings: list[str], *, denominator: str | None = None, scale: float = 1,
+                    threshold: float = 0.95, ghed=None, groups: list[str] | None = None):
+    """Aggregate the `value` of `data` (iso3_code, year, value) by group and year
+
+    Args:
+        data: a LazyFrame with the data to aggregate
+        groupings: "continent" and/or "income_level"
+        denominator: a GHED indicator code. If given, the result is the sum of the values
+            divided by the sum of the indicator, for the same countries and years
+        scale: multiply the result by this (e.g. 100 for percentages)
+        threshold: the share of countries with data a group needs in a year to be aggregated
+        ghed: a LazyFrame with the GHED data, to read the denominator from
+        groups: only compute these groups. Defaults to the requested groups (see
+            `aggregates.requested_groups`)
+
+    Returns:
+        a LazyFrame with the columns group, year and value
+    """
+
+    data = data.select("iso3_code", "year", pl.col("value").fill_nan(None))
+
+    # the groups are assigned in python, for the unique countries only
+    codes = data.select(pl.col("iso3_code").unique()).collect().to_series().to_list()
+    years = data.select(pl.col("year").unique()).collect().to_series().to_list()
+    members = pl.from_pandas(country_groups(codes, groupings, groups, years),
+                             schema_overrides={"iso3_code": pl.String, "year": pl.Int64, "grouping": pl.Int64,
+                                               "group": pl.String}).lazy()
+
+    grouped = (data.select("iso3_code").unique()
+               .join(data.select("year").unique(), how="cross")
+               .join(data, on=["iso3_code", "year"], how="left")
+               .sort("iso3_code", "year")
+               # forward fill up to 2 years
+               .with_columns(pl.coalesce(pl.col("value"),
+                                         pl.col("value").shift(1).over("iso3_code"),
+                                         pl.col("value").shift(2).over("iso3_code")))
+               .join(members, on=membership_keys(), how="inner")
+               )
+
+    # countries are not expected before the year they were created
+    expected = ~(((pl.col("iso3_code") == "SSD") & (pl.col("year") < 2011))
+                 | ((pl.col("iso3_code") == "TLS") & (pl.col("year") < 2002)))
+    complete = (grouped
+                .group_by("grouping", "group", "year")
+                .agg(pl.col("value").count().alias("count"), expected.sum().alias("total"))
+                .filter((pl.col("total") > 0) & (pl.col("count") / pl.col("total") >= threshold))
+                .select("grouping", "group", "year")
+                )
+
+    result = grouped.join(complete, on=["grouping", "group", "year"], how="inner")
+
+    if denominator is None:
+        value = pl.col("value").sum()
+    else:
+        denominators = ((ghed if ghed is not None else scan_ghed())
+                        .filter(pl.col("indicator_code") == denominator)
+                        .select("iso3_code", "year", pl.col("value").alias("denominator")))
+        result = result.join(denominators, on=["iso3_code", "year"], how="left")
+        value = pl.col("value").sum() / pl.col("denominator").sum()
+
+    return (result
+            .filter(pl.col("year") <= LAST_AGGREGATE_YEAR)
+            .group_by("grouping", "group", "year")
+            .agg((value * scale).alias("value"))
+            .sort("grouping", "group", "year")
+            .select("group", "year", "value")
+            )
+
+
+def _aggregate(df, continent: bool, income_level: bool, ghed=None, groups=None, **kwargs):
+    """Run an aggregation on a pandas dataframe or a LazyFrame, returning the same type"""
+
+    if not isinstance(df, pd.DataFrame):
+        return run_aggregation(df, selected_groupings(continent, income_level), ghed=ghed, groups=groups, **kwargs)
+
+    return (run_aggregation(pl.from_pandas(df).lazy(), selected_groupings(continent, income_level),
+                            ghed=ghed, groups=groups, **kwargs)
+            .collect()
+            .to_pandas()
+            .astype({"group": "str", "value": "float64"})
+            )
+
+
+def aggregate(df, continent: bool = True, income_level: bool = True, *, ghed=None, groups=None):
+    """Aggregate the dataframe by group and year"""
+
+    return _aggregate(df, continent, income_level, ghed, groups)
+
+
+def aggregate_per_capita(df, *, continent=True, income_level=True, ghed=None, groups=None):
+    """Aggregate per capita data"""
+
+    return _aggregate(df, continent, income_level, ghed, groups, denominator="pop")
+
+
+def aggregate_pct_gge_usd_const_2022(df, *, continent=True, income_level=True, ghed=None, groups=None):
+    """Aggregate the percentage of general government expenditure in USD constant 2022"""
+
+    return _aggregate(df, continent, income_level, ghed, groups, denominator="gge_usd2022", scale=100)
+
+
+def aggregate_pct_che_usd2022(df, *, continent=True, income_level=True, ghed=None, groups=None):
+    """Aggregate the percentage of current health expenditure in USD 2022"""
+
+    return _aggregate(df, continent, income_level, ghed, groups, denominator="che_usd2022", scale=100)
+
+
+def aggregate_pct_gdp_usd_const_2022(df, *, continent=True, income_level=True, ghed=None, groups=None):
+    """Aggregate the percentage of GDP in USD constant 2022"""
+
+    return _aggregate(df, continent, income_level, ghed, groups, denominator="gdp_usd2022", scale=100)
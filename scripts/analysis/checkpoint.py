@@ -0,0 +1,156 @@
+"""Versioned, typed checkpoints for expensive intermediate dataframes.
+
+A checkpoint is a parquet file stored under `PATHS.checkpoints`, named after the
+pipeline stage it captures and a key derived from everything the stage depends on
+(input file hashes, configuration, parameters). Parquet preserves the column types,
+including categoricals, so a checkpoint loads back exactly as it was saved.
+
+Checkpoints and the cache of file hashes are written atomically (see
+`writers.atomic_write`), and updated under a lock, as stages and writers run on threads.
+"""
+
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import writers
+from scripts.config import PATHS
+from scripts.logger import logger
+
+# Bump when the layout of any checkpointed frame changes, to invalidate old files
+CHECKPOINT_VERSION: int = 2
+
+_lock = threading.Lock()
+
+
+def _hash_cache_path() -> Path:
+    """Cache of file hashes, so unchanged files (same size and mtime) are not re-hashed"""
+    return PATHS.checkpoints / "file_hashes.json"
+
+
+def _read_hash_cache() -> dict:
+    if _hash_cache_path().exists():
+        return json.loads(_hash_cache_path().read_text())
+    return {}
+
+
+def file_hash(path: Path) -> str:
+    """Return the sha256 of a file. Hashes are cached by path, size and mtime.
+
+    Waits for a pending background write of the file (see `writers.write_background`).
+    """
+
+    writers.wait(path)
+    stat = path.stat()
+    with _lock:
+        cached_entry = _read_hash_cache().get(str(path))
+    if cached_entry and cached_entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached_entry[2]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    with _lock:
+        # read again: other threads may have added hashes while this file was hashed
+        cache = _read_hash_cache()
+        cache[str(path)] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        text = json.dumps(cache, indent=1)
+        writers.atomic_write(_hash_cache_path(), lambda temporary: temporary.write_text(text), deduplicate=False)
+
+    return digest.hexdigest()
+
+
+def checkpoint_key(**parts) -> str:
+    """Create a key from the parts a checkpoint depends on. Parts must be json serialisable"""
+
+    payload = json.dumps({"version": CHECKPOINT_VERSION, **parts}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:20]
+
+
+def _paths(name: str, key: str) -> tuple[Path, Path]:
+    stem = f"{name}-v{CHECKPOINT_VERSION}-{key}"
+    return PATHS.checkpoints / f"{stem}.parquet", PATHS.checkpoints / f"{stem}.json"
+
+
+def load_checkpoint(name: str, key: str) -> pd.DataFrame | None:
+    """Load a checkpoint if it exists and its column types match the stored schema"""
+
+    data_path, meta_path = _paths(name, key)
+    if not (data_path.exists() and meta_path.exists()):
+        return None
+
+    schema = json.loads(meta_path.read_text())["dtypes"]
+    df = pd.read_parquet(data_path)
+
+    if {col: str(dtype) for col, dtype in df.dtypes.items()} != schema:
+        logger.info(f"Checkpoint {data_path.name} has an unexpected schema. Ignoring it")
+        return None
+
+    return df
+
+
+def save_checkpoint(df: pd.DataFrame, name: str, key: str, **metadata) -> None:
+    """Save a checkpoint and remove older checkpoints for the same stage"""
+
+    data_path, meta_path = _paths(name, key)
+    meta = json.dumps({"name": name,
+                       "key": key,
+                       "version": CHECKPOINT_VERSION,
+                       "dtypes": {col: str(dtype) for col, dtype in df.dtypes.items()},
+                       **metadata},
+                      indent=2, default=str)
+
+    with _lock:
+        for old in PATHS.checkpoints.glob(f"{name}-v*"):
+            if old not in (data_path, meta_path):
+                old.unlink(missing_ok=True)
+
+        writers.atomic_write(data_path, lambda temporary: df.to_parquet(temporary, index=False), deduplicate=False)
+        writers.atomic_write(meta_path, lambda temporary: temporary.write_text(meta), deduplicate=False)
+
+
+def remove_checkpoints(name: str) -> int:
+    """Remove the checkpoints of a stage, so it is built again on the next run
+
+    Returns:
+        the number of checkpoints removed
+    """
+
+    with _lock:
+        removed = len(list(PATHS.checkpoints.glob(f"{name}-v*.parquet")))
+        for path in PATHS.checkpoints.glob(f"{name}-v*"):
+            path.unlink(missing_ok=True)
+
+    return removed
+
+
+def load_or_build(name: str, key: str, build: Callable[[], pd.DataFrame], *, refresh: bool = False) -> pd.DataFrame:
+    """Return the checkpointed frame for `name` and `key`, building and saving it if needed
+
+    Args:
+        name: the name of the pipeline stage being checkpointed
+        key: the key identifying the inputs of the stage (see `checkpoint_key`)
+        build: a function that builds the frame from scratch
+        refresh: ignore any existing checkpoint and rebuild it
+
+    Returns:
+        the dataframe
+    """
+
+    if not refresh:
+        df = load_checkpoint(name, key)
+        if df is not None:
+            logger.info(f"Loaded {name} from checkpoint")
+            return df
+
+    logger.info(f"Building {name} checkpoint")
+    df = build().reset_index(drop=True)
+    save_checkpoint(df, name, key)
+
+    return df
@@ -1,9 +1,15 @@
 """Common helper function"""
 
-from functools import lru_cache
+import threading
+from functools import lru_cache, wraps
 import pandas as pd
 
+from scripts.analysis.checkpoint import file_hash
+from scripts.analysis.cube import GhedCube
+from scripts.analysis.snapshot import GhedSnapshot
 from scripts.config import PATHS
+from scripts.manifest import read_csv
+from scripts.writers import atomic_write
 
 
 def format_large_numbers(series: pd.Series, tn_dec: int = 2, bn_dec: int = 2, mn_dec: int = 2, other_dec: int = 2) -> pd.Series:
@@ -50,42 +56,94 @@ def custom_sort(df: pd.DataFrame, col: str, priority_list: list) -> pd.DataFrame
     :param priority_list: List of values to prioritize in sorting
     :return: Sorted dataframe
     """
-    df = df.copy(deep=True)
-    df[col] = df[col].astype(str)  # Ensure the column is of string type for sorting
+    priority = {value: i for i, value in reversed(list(enumerate(priority_list)))}
 
-    df["order"] = df[col].apply(lambda x: priority_list.index(x) if x in priority_list else len(priority_list))
-    df = df.sort_values(by=["order", col]).drop(columns=["order"]).reset_index(drop=True)
+    return (df
+            .assign(**{col: lambda d: d[col].astype(str)})  # Ensure the column is of string type for sorting
+            .assign(order=lambda d: d[col].map(priority).fillna(len(priority_list)))
+            .sort_values(by=["order", col])
+            .drop(columns=["order"])
+            .reset_index(drop=True)
+            )
 
-    return df
+
+# the aggregates published in the outputs
+RELEVANT_GROUPS = ['Africa', "Africa (Low and lower middle income)", 'Low income', 'Lower middle income', 'Upper middle income', 'High income']
 
 
 def keep_relevant_groups(df):
     """Keep only Africa, and income groups"""
 
     return (df
-            .loc[lambda d: (d.entity_name.isin(['Africa', "Africa (Low and lower middle income)", 'Low income', 'Lower middle income', 'Upper middle income', 'High income'])) |
+            .loc[lambda d: (d.entity_name.isin(RELEVANT_GROUPS)) |
                            (d.iso3_code.notna())
     ]
         .reset_index(drop=True)
             )
 
-@lru_cache
-def get_ghed_data():
-    """ """
+_ghed_lock = threading.RLock()
 
-    return pd.read_csv(PATHS.raw_data / "ghed.csv")
 
+def _load_once(func):
+    """Cache a loader of the GHED data, loading once when several threads ask at the same time"""
+
+    cached = lru_cache(func)
+
+    @wraps(func)
+    def wrapper():
+        with _ghed_lock:
+            return cached()
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@_load_once
+def get_ghed_snapshot() -> GhedSnapshot:
+    """The GHED data as a snapshot, shared by every caller"""
+
+    return GhedSnapshot.from_frame(read_csv(PATHS.raw_data / "ghed.csv"))
+
+
+def get_ghed_data() -> pd.DataFrame:
+    """The GHED data, as a new frame referencing the snapshot (copied only where it is changed)"""
+
+    return get_ghed_snapshot().frame()
 
-def _add_indicator(df, indicator_code, indicator_col):
-    """ """
 
-    ind_df = (get_ghed_data()
-              .loc[lambda d: d.indicator_code == indicator_code, ['iso3_code', 'year', 'value']]
-              .reset_index(drop=True)
-              .rename(columns={'value': indicator_col})
-              )
+def get_indicator(indicator_code: str) -> pd.DataFrame:
+    """The iso3_code, year and value of a GHED indicator, as a slice of the snapshot (copied only where it is changed)"""
+
+    return get_ghed_snapshot().indicator(indicator_code)
+
+
+@_load_once
+def get_ghed_cube() -> GhedCube:
+    """GHED data as a read-only indicator x country x year cube.
+
+    The cube is saved next to the raw data and memory-mapped on later runs, as long as
+    ghed.csv has not changed.
+    """
+
+    path = PATHS.raw_data / "ghed_cube"
+    source = file_hash(PATHS.raw_data / "ghed.csv")
+
+    if (path / "source.txt").exists() and (path / "source.txt").read_text() == source:
+        return GhedCube.load(path)
+
+    cube = GhedCube.from_frame(get_ghed_data())
+    cube.save(path)
+    # written last: the saved cube is only used once it is complete
+    atomic_write(path / "source.txt", lambda temporary: temporary.write_text(source), deduplicate=False)
+    cube.values.flags.writeable = False
+
+    return cube
+
+
+def _add_indicator(df, indicator_code, indicator_col):
+    """Add an indicator for the iso3_code and year of each row, looked up in the GHED cube"""
 
-    return df.merge(ind_df, on=['iso3_code', 'year'], how='left')
+    return df.assign(**{indicator_col: get_ghed_cube().lookup(indicator_code, df.iso3_code, df.year)})
 
 
 
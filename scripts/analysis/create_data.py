@@ -1,33 +1,44 @@
 """Create formatted data for total health expenditure, government expenditure, expenditure by source, and expenditure by condition"""
 
+import argparse
+from contextlib import nullcontext
+
 import pandas as pd
 import numpy as np
-import country_converter as coco
 
-from scripts.analysis.common import get_ghed_data, keep_relevant_groups
-from scripts.analysis.aggregates import aggregate_per_capita, aggregate_pct_gdp_usd_const_2022, aggregate, aggregate_pct_gge_usd_const_2022, aggregate_pct_che_usd2022
+from scripts import config, profiling, writers
+from scripts.analysis.common import RELEVANT_GROUPS, get_ghed_data, get_indicator, keep_relevant_groups
+from scripts.analysis.aggregates import aggregate_per_capita, aggregate_pct_gdp_usd_const_2022, aggregate, aggregate_pct_gge_usd_const_2022, aggregate_pct_che_usd2022, requested_groups
+from scripts.analysis.engines import engine_dispatch
 from scripts.config import PATHS
+from scripts.instrumentation import enable_from_env, stage
+from scripts.lazy import LazyModule
+from scripts.manifest import track, write_csv
+
+coco = LazyModule("country_converter")
+
+# builders implemented by the other engines
+dispatch = engine_dispatch({"polars": "scripts.analysis.create_data_polars"})
 
 
+@dispatch
 def create_total_health_expenditure() -> pd.DataFrame:
     """Create data with total health expenditure in constant USD, per capita, and as a percentage of GDP
     """
 
-    ghed = get_ghed_data() # get the raw data
-
     # Total health expenditure in constant 2022 USD
-    tt = (ghed.loc[lambda d: d.indicator_code == 'che_usd2022', ['iso3_code', 'year', 'value']].reset_index(drop=True))
+    tt = get_indicator('che_usd2022')
     ag_tt = aggregate(tt)
-    tt_full = pd.concat([tt, ag_tt.rename(columns={'group':'iso3_code'})]).assign(unit = "USD constant (2022)")
+    tt_full = pd.concat([tt, ag_tt.rename(columns={'group':'iso3_code'})]).assign(unit = f"USD constant ({config.CONSTANT_YEAR})")
 
     # Total health expenditure per capita in constant 2022 USD
-    tt_pc = (ghed.loc[lambda d: d.indicator_code == 'che_usd2022_pc', ['iso3_code', 'year', 'value']].reset_index(drop=True))
-    ag_tt_pc = aggregate_per_capita(ghed.loc[lambda d: d.indicator_code == 'che_usd2022', ['iso3_code', 'year', 'value']])
-    tt_pc_full = pd.concat([tt_pc, ag_tt_pc.rename(columns={'group':'iso3_code'})]).assign(unit = "per capita, USD constant (2022)")
+    tt_pc = get_indicator('che_usd2022_pc')
+    ag_tt_pc = aggregate_per_capita(get_indicator('che_usd2022'))
+    tt_pc_full = pd.concat([tt_pc, ag_tt_pc.rename(columns={'group':'iso3_code'})]).assign(unit = f"per capita, USD constant ({config.CONSTANT_YEAR})")
 
     # Total health expenditure as a percentage of GDP
-    tt_gdp = ghed.loc[lambda d: d.indicator_code == 'che_gdp', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    ag_tt_gdp = aggregate_pct_gdp_usd_const_2022(ghed.loc[lambda d: d.indicator_code == 'che_usd2022', ['iso3_code', 'year', 'value']])
+    tt_gdp = get_indicator('che_gdp')
+    ag_tt_gdp = aggregate_pct_gdp_usd_const_2022(get_indicator('che_usd2022'))
     tt_gdp_full = pd.concat([tt_gdp, ag_tt_gdp.rename(columns={'group':'iso3_code'})]).assign(unit = "percent of GDP")
 
     # merge the dataframes, convert the iso3 codes to names
@@ -39,30 +50,29 @@ def create_total_health_expenditure() -> pd.DataFrame:
     return df
 
 
+@dispatch
 def create_gov_expenditure():
     """Data with aggregates as percent of general government expenditure, include constant USD values and total government expenditure values"""
 
-    ghed = get_ghed_data()
-
     # gov expenditure as a percent of total government expenditure
-    gov = ghed.loc[lambda d: d.indicator_code == 'gghed_gge', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_agg = aggregate_pct_gge_usd_const_2022(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
+    gov = get_indicator('gghed_gge')
+    gov_agg = aggregate_pct_gge_usd_const_2022(get_indicator('gghed_usd2022'))
     gov_full = pd.concat([gov, gov_agg.rename(columns={'group':'iso3_code'})]).assign(unit = "percent of general government expenditure")
 
     # gov expenditure in constant 2022 USD
-    gov_usd = ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_usd_agg = aggregate(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
-    gov_usd_full = pd.concat([gov_usd, gov_usd_agg.rename(columns={'group':'iso3_code'})]).assign(unit = "USD constant (2022)")
+    gov_usd = get_indicator('gghed_usd2022')
+    gov_usd_agg = aggregate(get_indicator('gghed_usd2022'))
+    gov_usd_full = pd.concat([gov_usd, gov_usd_agg.rename(columns={'group':'iso3_code'})]).assign(unit = f"USD constant ({config.CONSTANT_YEAR})")
 
     #gov expenditure as a percent of GDP
-    gov_gdp = ghed.loc[lambda d: d.indicator_code == 'gghed_gdp', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_gdp_agg = aggregate_pct_gdp_usd_const_2022(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
+    gov_gdp = get_indicator('gghed_gdp')
+    gov_gdp_agg = aggregate_pct_gdp_usd_const_2022(get_indicator('gghed_usd2022'))
     gov_gdp_full = pd.concat([gov_gdp, gov_gdp_agg.rename(columns={'group':'iso3_code'})]).assign(unit = "percent of GDP")
 
     # gov expenditure per capita
-    gov_pc = ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022_pc', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_pc_agg = aggregate_per_capita(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
-    gov_pc_full = pd.concat([gov_pc, gov_pc_agg.rename(columns={'group':'iso3_code'})]).assign(unit = "per capita, USD constant (2022)")
+    gov_pc = get_indicator('gghed_usd2022_pc')
+    gov_pc_agg = aggregate_per_capita(get_indicator('gghed_usd2022'))
+    gov_pc_full = pd.concat([gov_pc, gov_pc_agg.rename(columns={'group':'iso3_code'})]).assign(unit = f"per capita, USD constant ({config.CONSTANT_YEAR})")
 
     return (pd.concat([gov_full, gov_usd_full, gov_gdp_full, gov_pc_full])
             .assign(entity_name=lambda d: coco.convert(d.iso3_code, to='name_short', not_found=None))
@@ -112,6 +122,7 @@ def calculate_pvt_excl_oop_percent_che(ghed: pd.DataFrame) -> pd.DataFrame:
                          )
 
 
+@dispatch
 def create_expenditure_by_source() -> pd.DataFrame:
     """External, domestic gov, OOP, private excl OOP"""
 
@@ -126,8 +137,8 @@ def create_expenditure_by_source() -> pd.DataFrame:
     # 1. Sources as shares of total health expenditure
 
     # gov expenditure as a percent of total government expenditure
-    gov = ghed.loc[lambda d: d.indicator_code == 'gghed_che', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_agg = aggregate_pct_che_usd2022(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
+    gov = get_indicator('gghed_che')
+    gov_agg = aggregate_pct_che_usd2022(get_indicator('gghed_usd2022'))
     gov_full = (pd.concat([gov, gov_agg.rename(columns={'group':'iso3_code'})])
                 .assign(unit = "percent of health expenditure",
                         source = sources['gov']
@@ -135,8 +146,8 @@ def create_expenditure_by_source() -> pd.DataFrame:
                 )
 
     # external expenditure as a percent of total government expenditure
-    ext = ghed.loc[lambda d: d.indicator_code == 'ext_che', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    ext_agg = aggregate_pct_che_usd2022(ghed.loc[lambda d: d.indicator_code == 'ext_usd2022', ['iso3_code', 'year', 'value']])
+    ext = get_indicator('ext_che')
+    ext_agg = aggregate_pct_che_usd2022(get_indicator('ext_usd2022'))
     ext_full = (pd.concat([ext, ext_agg.rename(columns={'group':'iso3_code'})])
                 .assign(unit = "percent of health expenditure",
                         source = sources['ext']
@@ -153,8 +164,8 @@ def create_expenditure_by_source() -> pd.DataFrame:
                 )
 
     # out-of-pocket expenditure as a percent of total government expenditure, using indicator hf3
-    oop = ghed.loc[lambda d: d.indicator_code == 'hf3_che', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    oop_agg = aggregate_pct_che_usd2022(ghed.loc[lambda d: d.indicator_code == 'hf3_usd2022', ['iso3_code', 'year', 'value']])
+    oop = get_indicator('hf3_che')
+    oop_agg = aggregate_pct_che_usd2022(get_indicator('hf3_usd2022'))
     oop_full = (pd.concat([oop, oop_agg.rename(columns={'group':'iso3_code'})])
                 .assign(unit = "percent of health expenditure",
                         source = sources['oop']
@@ -164,19 +175,19 @@ def create_expenditure_by_source() -> pd.DataFrame:
     # 2. Sources in constant USD
 
     # gov expenditure in constant 2022 USD
-    gov_usd = ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    gov_agg_usd = aggregate(ghed.loc[lambda d: d.indicator_code == 'gghed_usd2022', ['iso3_code', 'year', 'value']])
+    gov_usd = get_indicator('gghed_usd2022')
+    gov_agg_usd = aggregate(get_indicator('gghed_usd2022'))
     gov_full_usd = (pd.concat([gov_usd, gov_agg_usd.rename(columns={'group':'iso3_code'})])
-                .assign(unit = "constant USD (2022)",
+                .assign(unit = f"constant USD ({config.CONSTANT_YEAR})",
                         source = sources['gov']
                         )
                 )
 
     # external expenditure as a percent of total government expenditure
-    ext_usd = ghed.loc[lambda d: d.indicator_code == 'ext_usd2022', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    ext_agg_usd = aggregate(ghed.loc[lambda d: d.indicator_code == 'ext_usd2022', ['iso3_code', 'year', 'value']])
+    ext_usd = get_indicator('ext_usd2022')
+    ext_agg_usd = aggregate(get_indicator('ext_usd2022'))
     ext_full_usd = (pd.concat([ext_usd, ext_agg_usd.rename(columns={'group':'iso3_code'})])
-                .assign(unit = "constant USD (2022)",
+                .assign(unit = f"constant USD ({config.CONSTANT_YEAR})",
                         source = sources['ext']
                         )
                 )
@@ -185,16 +196,16 @@ def create_expenditure_by_source() -> pd.DataFrame:
     pvt_usd = calculate_pvt_excl_oop_usd2022(ghed)
     pvt_agg_usd = aggregate(calculate_pvt_excl_oop_usd2022(ghed))
     pvt_full_usd = (pd.concat([pvt_usd, pvt_agg_usd.rename(columns={'group':'iso3_code'})])
-                .assign(unit = "constant USD (2022)",
+                .assign(unit = f"constant USD ({config.CONSTANT_YEAR})",
                         source = sources['pvt']
                         )
                 )
 
     # out-of-pocket expenditure as a percent of total government expenditure, using indicator hf3
-    oop_usd = ghed.loc[lambda d: d.indicator_code == 'hf3_usd2022', ['iso3_code', 'year', 'value']].reset_index(drop=True)
-    oop_agg_usd = aggregate(ghed.loc[lambda d: d.indicator_code == 'hf3_usd2022', ['iso3_code', 'year', 'value']])
+    oop_usd = get_indicator('hf3_usd2022')
+    oop_agg_usd = aggregate(get_indicator('hf3_usd2022'))
     oop_full_usd = (pd.concat([oop_usd, oop_agg_usd.rename(columns={'group':'iso3_code'})])
-                .assign(unit = "constant USD (2022)",
+                .assign(unit = f"constant USD ({config.CONSTANT_YEAR})",
                         source = sources['oop']
                         )
                 )
@@ -207,11 +218,10 @@ def create_expenditure_by_source() -> pd.DataFrame:
 
 
 
+@dispatch
 def create_expenditure_by_condition() -> pd.DataFrame:
     """Create data with health expenditure by condition"""
 
-    ghed = get_ghed_data()
-
     dis_indicators = {"dis11": "HIV/AIDS and other STDs",
                       "dis12": "Tuberculosis",
                       "dis13": "Malaria",
@@ -235,15 +245,13 @@ def create_expenditure_by_condition() -> pd.DataFrame:
     for source_code, source_name in sources.items():
 
         for k,v in dis_indicators.items():
-            dis = (ghed
-                   .loc[lambda d: d.indicator_code == f"{k}_{source_code}usd2022", ['iso3_code', 'year', 'value']]
-                   .reset_index(drop=True)
+            dis = (get_indicator(f"{k}_{source_code}usd2022")
                    .assign(condition = v,
                            source=source_name)
                    )
 
             # aggregates may not be generated because of extensive missing data for these breakdowns
-            # dis_agg = aggregate(ghed.loc[lambda d: d.indicator_code == f"{k}_{source_code}usd2022", ['iso3_code', 'year', 'value']])
+            # dis_agg = aggregate(get_indicator(f"{k}_{source_code}usd2022"))
             # dis_full = pd.concat([dis, dis_agg.rename(columns={"group": "iso3_code"})], ignore_index=True).assign(condition = f"{v}", source=source_name)
 
             df = pd.concat([df, dis], ignore_index=True)
@@ -254,16 +262,47 @@ def create_expenditure_by_condition() -> pd.DataFrame:
             )
 
 
+# The builder of each output file
+OUTPUTS = {
+    "total_health_expenditure.csv": create_total_health_expenditure,
+    "gov_expenditure.csv": create_gov_expenditure,
+    "expenditure_by_source.csv": create_expenditure_by_source,
+    "expenditure_by_condition.csv": create_expenditure_by_condition,
+}
 
-if __name__ == "__main__":
 
-    (create_total_health_expenditure()
-     .pipe(keep_relevant_groups)
-     .to_csv(PATHS.output / "total_health_expenditure.csv", index=False))
-    create_gov_expenditure().pipe(keep_relevant_groups).to_csv(PATHS.output / "gov_expenditure.csv", index=False)
-    create_expenditure_by_source().pipe(keep_relevant_groups).to_csv(PATHS.output / "expenditure_by_source.csv", index=False)
-    create_expenditure_by_condition().pipe(keep_relevant_groups).to_csv(PATHS.output / "expenditure_by_condition.csv", index=False)
+def build_output(file_name: str) -> pd.DataFrame:
+    """Build an output and keep the relevant groups. Only the relevant groups are aggregated
 
+    Builders read the shared GHED snapshot, so outputs can be built concurrently
+    on threads.
+    """
+
+    with requested_groups(RELEVANT_GROUPS):
+        df = OUTPUTS[file_name]()
+
+    return df.pipe(keep_relevant_groups)
+
+
+def write_output(file_name: str) -> pd.DataFrame:
+    """Build an output, keep the relevant groups and write it to the output folder"""
+
+    return build_output(file_name).pipe(write_csv, PATHS.output / file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the GHED outputs")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
 
+    enable_from_env()
+    profiled = profiling.profile("create_data", ("create_data.create_",), args.flamegraph) if args.profile else nullcontext()
 
+    with profiled:
+        for file_name, builder in OUTPUTS.items():
+            with (stage(f"create_data.{builder.__name__}"),
+                  track(f"create_data.{builder.__name__}", [PATHS.raw_data / "ghed.csv"])):
+                write_output(file_name)
 
+        # the outputs are written in the background while the next builders run
+        writers.flush()
@@ -0,0 +1,212 @@
+"""The create_data builders as Polars lazy queries.
+
+Same functions and outputs as `create_data.py`, selected with `config.ENGINE = "polars"`.
+Each builder reads the columns and indicators it needs from the GHED file once, composes
+its filters, aggregations (see aggregates_polars.py) and concatenations into a single lazy
+query, and collects it at the end, so Polars can optimise and parallelise the whole plan.
+Country names are converted for the unique codes only.
+"""
+
+import numpy as np
+import pandas as pd
+
+from scripts import config
+from scripts.analysis.aggregates_polars import (
+    aggregate,
+    aggregate_pct_che_usd2022,
+    aggregate_pct_gdp_usd_const_2022,
+    aggregate_pct_gge_usd_const_2022,
+    aggregate_per_capita,
+    scan_ghed,
+)
+from scripts.lazy import LazyModule
+
+coco = LazyModule("country_converter")
+pl = LazyModule("polars")
+
+
+def read_ghed(indicators: list[str]):
+    """The GHED data for `indicators`, as a LazyFrame over an in-memory frame"""
+
+    return (scan_ghed()
+            .select("iso3_code", "year", "indicator_code", "value")
+            .filter(pl.col("indicator_code").is_in(indicators))
+            .collect()
+            .lazy()
+            )
+
+
+def indicator(ghed, code: str):
+    """iso3_code, year and value of an indicator"""
+
+    return ghed.filter(pl.col("indicator_code") == code).select("iso3_code", "year", "value")
+
+
+def with_aggregates(data, aggregates, **columns):
+    """Append the aggregates (with the group as iso3_code) to the data, and add constant columns"""
+
+    return (pl.concat([data, aggregates.rename({"group": "iso3_code"})])
+            .with_columns(**{name: pl.lit(value) for name, value in columns.items()})
+            )
+
+
+def _convert(codes: list, **kwargs) -> dict:
+    converted = coco.convert(codes, **kwargs)
+    return dict(zip(codes, converted if isinstance(converted, list) else [converted]))
+
+
+def add_names(lf) -> pd.DataFrame:
+    """Collect the query, add the entity name and clean the iso3 codes (as `create_data` does)"""
+
+    df = lf.collect()
+    codes = df["iso3_code"].unique(maintain_order=True).drop_nulls().to_list()
+
+    names = _convert(codes, to="name_short", not_found=None)
+    iso3_codes = {code: (None if pd.isna(iso3) else iso3)
+                  for code, iso3 in _convert(codes, src="ISO3", to="ISO3", not_found=np.nan).items()}
+
+    return (df
+            .with_columns(entity_name=pl.col("iso3_code").replace_strict(names, default=None),
+                          iso3_code=pl.col("iso3_code").replace_strict(iso3_codes, default=None))
+            .to_pandas()
+            .assign(iso3_code=lambda d: d.iso3_code.fillna(np.nan))
+            )
+
+
+def create_total_health_expenditure() -> pd.DataFrame:
+    """Create data with total health expenditure in constant USD, per capita, and as a percentage of GDP"""
+
+    ghed = read_ghed(["che_usd2022", "che_usd2022_pc", "che_gdp", "pop", "gdp_usd2022"])
+    che = indicator(ghed, "che_usd2022")
+
+    return add_names(pl.concat([
+        with_aggregates(che, aggregate(che, ghed=ghed), unit=f"USD constant ({config.CONSTANT_YEAR})"),
+        with_aggregates(indicator(ghed, "che_usd2022_pc"), aggregate_per_capita(che, ghed=ghed),
+                        unit=f"per capita, USD constant ({config.CONSTANT_YEAR})"),
+        with_aggregates(indicator(ghed, "che_gdp"), aggregate_pct_gdp_usd_const_2022(che, ghed=ghed),
+                        unit="percent of GDP"),
+    ]))
+
+
+def create_gov_expenditure() -> pd.DataFrame:
+    """Data with aggregates as percent of general government expenditure, include constant USD values and total government expenditure values"""
+
+    ghed = read_ghed(["gghed_gge", "gghed_usd2022", "gghed_gdp", "gghed_usd2022_pc",
+                      "gge_usd2022", "gdp_usd2022", "pop"])
+    gov = indicator(ghed, "gghed_usd2022")
+
+    return add_names(pl.concat([
+        with_aggregates(indicator(ghed, "gghed_gge"), aggregate_pct_gge_usd_const_2022(gov, ghed=ghed),
+                        unit="percent of general government expenditure"),
+        with_aggregates(gov, aggregate(gov, ghed=ghed), unit=f"USD constant ({config.CONSTANT_YEAR})"),
+        with_aggregates(indicator(ghed, "gghed_gdp"), aggregate_pct_gdp_usd_const_2022(gov, ghed=ghed),
+                        unit="percent of GDP"),
+        with_aggregates(indicator(ghed, "gghed_usd2022_pc"), aggregate_per_capita(gov, ghed=ghed),
+                        unit=f"per capita, USD constant ({config.CONSTANT_YEAR})"),
+    ]))
+
+
+def _sum_of(ghed, terms: dict[str, int], name: str):
+    """Sum (or subtract, with -1) indicators by country and year, treating missing ones as 0
+
+    Country-years without any of the indicators are dropped.
+    """
+
+    value = None
+    for code, sign in terms.items():
+        term = pl.col("value").filter(pl.col("indicator_code") == code).sum()
+        value = term if value is None else (value + term if sign > 0 else value - term)
+
+    return (ghed
+            .filter(pl.col("indicator_code").is_in(list(terms)))
+            .group_by("iso3_code", "year")
+            .agg(value.alias(name), pl.col("value").count().alias("count"))
+            .filter(pl.col("count") > 0)
+            .sort("iso3_code", "year")
+            .select("iso3_code", "year", name)
+            )
+
+
+def calculate_pvt_excl_oop_usd2022(ghed):
+    """Calculate private expenditure excluding out-of-pocket payments"""
+
+    return _sum_of(ghed, {"fs4_usd2022": 1, "fs5_usd2022": 1, "fs6_usd2022": 1, "fsnec_usd2022": 1,
+                          "fs61_usd2022": -1}, "value")
+
+
+def calculate_pvt_excl_oop_percent_che(ghed):
+    """Calculate private expenditure excluding out-of-pocket payments as a percentage of current health expenditure"""
+
+    che = _sum_of(ghed, {"hf1": 1, "hf2": 1, "hf3": 1, "hf4": 1, "hfnec": 1}, "che")
+    pvtd_excl_oop = _sum_of(ghed, {"fs4": 1, "fs5": 1, "fs6": 1, "fsnec": 1, "fs61": -1}, "value")
+
+    return (pvtd_excl_oop
+            .join(che, on=["iso3_code", "year"], how="left", maintain_order="left")
+            .with_columns(value=(pl.col("value") / pl.col("che")) * 100)
+            .drop("che")
+            )
+
+
+def create_expenditure_by_source() -> pd.DataFrame:
+    """External, domestic gov, OOP, private excl OOP"""
+
+    ghed = read_ghed(["gghed_che", "gghed_usd2022", "ext_che", "ext_usd2022", "hf3_che", "hf3_usd2022",
+                      "fs4_usd2022", "fs5_usd2022", "fs6_usd2022", "fsnec_usd2022", "fs61_usd2022",
+                      "hf1", "hf2", "hf3", "hf4", "hfnec", "fs4", "fs5", "fs6", "fsnec", "fs61",
+                      "che_usd2022"])
+
+    sources = {"gov": "Domestic government",
+               "ext": "External",
+               "pvt": "Other private",
+               "oop": "Out-of-pocket"
+               }
+
+    gov = indicator(ghed, "gghed_usd2022")
+    ext = indicator(ghed, "ext_usd2022")
+    pvt = calculate_pvt_excl_oop_usd2022(ghed)
+    oop = indicator(ghed, "hf3_usd2022")
+    share, usd = "percent of health expenditure", f"constant USD ({config.CONSTANT_YEAR})"
+
+    return add_names(pl.concat([
+        # 1. Sources as shares of total health expenditure
+        with_aggregates(indicator(ghed, "gghed_che"), aggregate_pct_che_usd2022(gov, ghed=ghed),
+                        unit=share, source=sources["gov"]),
+        with_aggregates(indicator(ghed, "ext_che"), aggregate_pct_che_usd2022(ext, ghed=ghed),
+                        unit=share, source=sources["ext"]),
+        with_aggregates(calculate_pvt_excl_oop_percent_che(ghed), aggregate_pct_che_usd2022(pvt, ghed=ghed),
+                        unit=share, source=sources["pvt"]),
+        with_aggregates(indicator(ghed, "hf3_che"), aggregate_pct_che_usd2022(oop, ghed=ghed),
+                        unit=share, source=sources["oop"]),
+        # 2. Sources in constant USD
+        with_aggregates(gov, aggregate(gov, ghed=ghed), unit=usd, source=sources["gov"]),
+        with_aggregates(ext, aggregate(ext, ghed=ghed), unit=usd, source=sources["ext"]),
+        with_aggregates(pvt, aggregate(pvt, ghed=ghed), unit=usd, source=sources["pvt"]),
+        with_aggregates(oop, aggregate(oop, ghed=ghed), unit=usd, source=sources["oop"]),
+    ]))
+
+
+def create_expenditure_by_condition() -> pd.DataFrame:
+    """Create data with health expenditure by condition"""
+
+    dis_indicators = {"dis11": "HIV/AIDS and other STDs",
+                      "dis12": "Tuberculosis",
+                      "dis13": "Malaria",
+                      "dis21": "Maternal health",
+                      "dis23": "Family planning",
+                      "dis3": "Nutritional deficiencies",
+                      "dis4": "Noncommunicable diseases",
+                      "dis5": "Injuries",
+                      }
+
+    sources = {"": "total",
+               "ext_": "External",
+               "gghed_": "Domestic government",
+               "pvtd_": "Private and out-of-pocket"}
+
+    codes = {(source, dis): f"{dis}_{source}usd2022" for source in sources for dis in dis_indicators}
+    ghed = read_ghed(list(codes.values()))
+
+    return add_names(pl.concat([
+        indicator(ghed, code).with_columns(condition=pl.lit(dis_indicators[dis]), source=pl.lit(sources[source]))
+        for (source, dis), code in codes.items()
+    ]))
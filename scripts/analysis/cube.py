@@ -0,0 +1,228 @@
+"""A dense indicator x country x year cube of the GHED data"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts.writers import atomic_write
+
+# Denominators used for ratios
+POPULATION = "pop"
+GDP = "gdp_usd2022"
+GGE = "gge_usd2022"
+CHE = "che_usd2022"
+
+
+class GhedCube:
+    """GHED values as a float array of shape indicators x countries x years.
+
+    Every country-year panel is complete by construction (missing values are NaN), so
+    joining a denominator or expanding a panel to all years is index arithmetic on the
+    array instead of a merge on (iso3_code, year). The group aggregations of the "cube"
+    engine run on it (see `aggregates_cube.py`).
+
+    Attributes:
+        values: the data array, possibly memory-mapped from disk
+        indicators: the indicator codes, in array order
+        countries: the iso3 codes, in array order
+        years: the years, in array order
+    """
+
+    def __init__(self, values: np.ndarray, indicators: pd.Index, countries: pd.Index, years: pd.Index):
+        self.values = values
+        self.indicators = pd.Index(indicators, name="indicator_code")
+        self.countries = pd.Index(countries, name="iso3_code")
+        self.years = pd.Index(years, name="year")
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "GhedCube":
+        """Build the cube from long GHED data with iso3_code, year, indicator_code and value columns
+
+        Raises:
+            ValueError: if an indicator has several rows for a country and year
+        """
+
+        df = df.dropna(subset=["iso3_code", "indicator_code"])
+
+        duplicated = df.duplicated(["indicator_code", "iso3_code", "year"], keep=False)
+        if duplicated.any():
+            examples = df.loc[duplicated, ["indicator_code", "iso3_code", "year"]].drop_duplicates().head(5)
+            raise ValueError(f"{int(duplicated.sum())} GHED rows share their indicator, country and year, e.g.\n"
+                             f"{examples.to_string(index=False)}")
+
+        ind_codes, indicators = pd.factorize(df.indicator_code, sort=True)
+        country_codes, countries = pd.factorize(df.iso3_code, sort=True)
+        years = pd.Index(np.arange(df.year.min(), df.year.max() + 1))
+
+        values = np.full((len(indicators), len(countries), len(years)), np.nan)
+        values[ind_codes, country_codes, df.year.to_numpy() - years[0]] = df.value.to_numpy(dtype="float64")
+
+        return cls(values, indicators, countries, years)
+
+    def save(self, path: Path) -> None:
+        """Save the cube to a folder, as a .npy array and a json index, each written atomically"""
+
+        def write_values(temporary: Path) -> None:
+            # through a file object, as np.save adds .npy to a path without it
+            with open(temporary, "wb") as file:
+                np.save(file, self.values)
+
+        index = json.dumps({"indicators": self.indicators.tolist(), "countries": self.countries.tolist(),
+                            "years": self.years.tolist()})
+
+        atomic_write(path / "values.npy", write_values, deduplicate=False)
+        atomic_write(path / "index.json", lambda temporary: temporary.write_text(index), deduplicate=False)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "GhedCube":
+        """Load a saved cube. By default the array is memory-mapped read-only"""
+
+        index = json.loads((path / "index.json").read_text())
+        values = np.load(path / "values.npy", mmap_mode="r" if mmap else None)
+
+        return cls(values, index["indicators"], index["countries"], index["years"])
+
+    # ---------------------------------- slicing ------------------------------------------
+
+    def panel(self, indicator: str) -> np.ndarray:
+        """The countries x years panel of an indicator (a view, not a copy)"""
+
+        return self.values[self.indicators.get_loc(indicator)]
+
+    def sel(self, indicators: list[str] | None = None, countries=None, years=None) -> "GhedCube":
+        """Select a subset of the cube (a copy). Labels not in the cube are filled with NaN"""
+
+        def positions(index: pd.Index, labels) -> np.ndarray:
+            return np.arange(len(index)) if labels is None else index.get_indexer(labels)
+
+        ii, ci, yi = (positions(self.indicators, indicators), positions(self.countries, countries),
+                      positions(self.years, years))
+
+        values = self.values[np.ix_(ii, ci, yi)]
+        values = np.where((ii[:, None, None] >= 0) & (ci[None, :, None] >= 0) & (yi[None, None, :] >= 0),
+                          values, np.nan)
+
+        return GhedCube(values,
+                        self.indicators if indicators is None else indicators,
+                        self.countries if countries is None else countries,
+                        self.years if years is None else years)
+
+    def lookup(self, indicator: str, iso3_codes, years) -> np.ndarray:
+        """The values of an indicator for arrays of iso3 codes and years. NaN where not available"""
+
+        ci = self.countries.get_indexer(iso3_codes)
+        yi = self.years.get_indexer(years)
+        found = (ci >= 0) & (yi >= 0)
+
+        if indicator not in self.indicators:
+            return np.full(len(ci), np.nan)
+
+        return np.where(found, self.panel(indicator)[ci, yi], np.nan)
+
+    # ---------------------------------- ratios -------------------------------------------
+
+    def ratio(self, numerator: str, denominator: str, scale: float = 1) -> np.ndarray:
+        """The ratio of two indicators for every country (row) and year"""
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.panel(numerator) / self.panel(denominator) * scale
+
+    def per_capita(self, indicator: str) -> np.ndarray:
+        """An indicator per capita"""
+        return self.ratio(indicator, POPULATION)
+
+    def pct_gdp(self, indicator: str) -> np.ndarray:
+        """An indicator as a percentage of GDP in USD constant 2022"""
+        return self.ratio(indicator, GDP, 100)
+
+    def pct_gge(self, indicator: str) -> np.ndarray:
+        """An indicator as a percentage of general government expenditure in USD constant 2022"""
+        return self.ratio(indicator, GGE, 100)
+
+    def pct_che(self, indicator: str) -> np.ndarray:
+        """An indicator as a percentage of current health expenditure in USD constant 2022"""
+        return self.ratio(indicator, CHE, 100)
+
+    # ------------------------------- group reduction -------------------------------------
+
+    def membership(self, members: pd.DataFrame) -> tuple[pd.Index, np.ndarray]:
+        """A groups x countries x years boolean array of the members of each group
+
+        Args:
+            members: one row per country (iso3_code) and group, and per year if the members
+                change over time (see `aggregates.country_groups`). Groups are in the order
+                of their first row
+        """
+
+        names = pd.Index(members.group.drop_duplicates().tolist(), name="group")
+        matrix = np.zeros((len(names), len(self.countries), len(self.years)), dtype=bool)
+
+        gi, ci = names.get_indexer(members.group), self.countries.get_indexer(members.iso3_code)
+        if "year" in members.columns:
+            yi = self.years.get_indexer(members.year)
+            found = (ci >= 0) & (yi >= 0)
+            matrix[gi[found], ci[found], yi[found]] = True
+        else:
+            found = ci >= 0
+            matrix[gi[found], ci[found], :] = True
+
+        return names, matrix
+
+    @staticmethod
+    def ffill(panel: np.ndarray, limit: int = 2) -> np.ndarray:
+        """Forward fill missing values along the years axis, up to `limit` years"""
+
+        filled = np.array(panel, dtype="float64")
+        for lag in range(1, limit + 1):
+            shifted = np.full_like(filled, np.nan)
+            shifted[..., lag:] = panel[..., :-lag]
+            filled = np.where(np.isnan(filled), shifted, filled)
+
+        return filled
+
+    @staticmethod
+    def group_sum(panel: np.ndarray, membership: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Sum a countries x years panel by group, skipping missing values
+
+        Args:
+            panel: a countries x years array
+            membership: a groups x countries x years boolean array (see `membership`)
+
+        Returns:
+            the groups x years sums, and the number of countries with data in each cell
+        """
+
+        counted = membership & ~np.isnan(panel)
+
+        return np.where(counted, panel, 0).sum(axis=1), counted.sum(axis=1)
+
+    # ---------------------------------- output -------------------------------------------
+
+    def to_frame(self, panel: np.ndarray | None = None, rows: pd.Index | None = None,
+                 dropna: bool = True) -> pd.DataFrame:
+        """Convert a 2D panel (or the whole cube) back to a long dataframe
+
+        Args:
+            panel: a rows x years array. If None, the whole cube is converted
+            rows: the labels of the panel rows. Defaults to the countries
+            dropna: drop cells without data
+        """
+
+        if panel is None:
+            df = pd.DataFrame({
+                "iso3_code": np.tile(np.repeat(self.countries.to_numpy(), len(self.years)), len(self.indicators)),
+                "year": np.tile(self.years.to_numpy(), len(self.indicators) * len(self.countries)),
+                "indicator_code": np.repeat(self.indicators.to_numpy(), len(self.countries) * len(self.years)),
+                "value": np.asarray(self.values).ravel(),
+            })
+        else:
+            rows = self.countries if rows is None else rows
+            df = pd.DataFrame({
+                rows.name or "iso3_code": np.repeat(rows.to_numpy(), len(self.years)),
+                "year": np.tile(self.years.to_numpy(), len(rows)),
+                "value": np.asarray(panel).ravel(),
+            })
+
+        return df.dropna(subset=["value"]).reset_index(drop=True) if dropna else df
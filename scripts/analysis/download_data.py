@@ -1,13 +1,19 @@
 """Download GHED data"""
 
-import bblocks_data_importers as bbdata
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
-import country_converter as coco
-from bblocks.dataframe_tools.add import add_income_level_column
 
+from scripts import instrumentation, writers
 from scripts.config import PATHS
+from scripts.lazy import LazyModule, lazy_function
 from scripts.logger import logger
+from scripts.manifest import register, track
+
+bbdata = LazyModule("bblocks_data_importers")
+coco = LazyModule("country_converter")
+add_income_level_column = lazy_function("bblocks.dataframe_tools.add", "add_income_level_column")
 
 
 def clean(df) -> pd.DataFrame:
@@ -21,15 +27,26 @@ def clean(df) -> pd.DataFrame:
             .loc[:, ['iso3_code', 'year', 'indicator_code', 'value', 'continent', 'income_level']]
      )
 
-def download_ghed() -> None:
-    """Download ghed data to raw data directory"""
+def download_ghed(data_file: Path | None = None) -> None:
+    """Download ghed data to raw data directory
+
+    Args:
+        data_file: read the GHED workbook from this file instead of downloading it
+            (see `scripts.refresh`)
+    """
 
-    ghed = bbdata.GHED()
+    ghed = bbdata.GHED(data_file=data_file)
     df = ghed.get_data()
     df = clean(df)
 
-    df.to_csv(PATHS.raw_data / "ghed.csv", index=False)
+    # raw data: written in place (never deduplicated), as `refresh` installs its files
+    path = PATHS.raw_data / "ghed.csv"
+    writers.atomic_write(path, lambda p: df.to_csv(p, index=False), deduplicate=False)
+    register(path, rows=len(df))
 
 if __name__ == "__main__":
-    download_ghed()
+    instrumentation.enable_from_env()
+    with track("download_data.download_ghed"):
+        download_ghed()
+    writers.flush()
     logger.info("GHED data downloaded")
@@ -0,0 +1,64 @@
+"""Select the engine running the aggregations and the builders.
+
+`config.ENGINE` names the engine: "pandas" (the reference implementation), "duckdb"
+(aggregations in DuckDB, see aggregates_duckdb.py), "polars" (builders and aggregations
+as Polars lazy queries, see create_data_polars.py and aggregates_polars.py) or "cube"
+(aggregations as array operations on the GHED cube, see aggregates_cube.py). Functions
+decorated with `engine_dispatch` run the implementation with the same name and signature
+in the module of the selected engine, or their own (pandas) implementation if the engine
+doesn't provide one. `use_engine` selects another engine in the current thread only, so
+threads running concurrently (e.g. the pipeline stages) can use different engines.
+"""
+
+import importlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from scripts import config
+
+ENGINES = ["pandas", "duckdb", "polars", "cube"]
+
+# the engine selected with `use_engine` in this thread (context), if any
+_engine: ContextVar[str | None] = ContextVar("engine", default=None)
+
+
+def selected_engine() -> str:
+    """The engine selected with `use_engine` in this thread, or `config.ENGINE`"""
+    return _engine.get() or config.ENGINE
+
+
+def engine_dispatch(implementations: dict[str, str]):
+    """Dispatch a function to the module implementing it for the selected engine
+
+    Args:
+        implementations: the module implementing the function, by engine
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            engine = selected_engine()
+            if engine not in ENGINES:
+                raise ValueError(f"Invalid engine: {engine}")
+            if engine in implementations:
+                module = importlib.import_module(implementations[engine])
+                return getattr(module, func.__name__)(*args, **kwargs)
+
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def use_engine(engine: str | None):
+    """Temporarily select an engine in this thread (threads started in the block don't
+    inherit it). None keeps the engine selected"""
+
+    token = _engine.set(engine or _engine.get())
+    try:
+        yield
+    finally:
+        _engine.reset(token)
@@ -0,0 +1,107 @@
+"""World Bank income classification of countries: current, or historical by year.
+
+With the current classification (the default), every year uses today's income level of a
+country (from bblocks), so an income group has the same members in every year. With the
+historical classification (`config.INCOME_CLASSIFICATION = "historical"`), each year uses
+the classification based on that year's data (the World Bank OGHIST table, saved by
+`scripts.refresh` as `income_levels_history.csv`, one row per country and year). Years
+after the last classified year use the last classification, and years before the first
+use the first one.
+
+The historical table is read once per version of the file, and assigned to data with one
+merge on (iso3_code, year).
+"""
+
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+from scripts import config
+from scripts.analysis.checkpoint import file_hash
+from scripts.config import PATHS
+from scripts.lazy import lazy_function
+
+add_income_level_column = lazy_function("bblocks.dataframe_tools.add", "add_income_level_column")
+
+CLASSIFICATIONS = ("current", "historical")
+
+# Codes of the OGHIST table, by income level
+LEVELS = {
+    "L": "Low income",
+    "LM": "Lower middle income",
+    "LM*": "Lower middle income",
+    "UM": "Upper middle income",
+    "H": "High income",
+}
+
+
+def history_path() -> Path:
+    return PATHS.raw_data / "income_levels_history.csv"
+
+
+def historical() -> bool:
+    """Whether the historical classification is used (see `config.INCOME_CLASSIFICATION`)"""
+
+    if config.INCOME_CLASSIFICATION not in CLASSIFICATIONS:
+        raise ValueError(f"Invalid income classification {config.INCOME_CLASSIFICATION!r}. "
+                         f"Classifications: {', '.join(CLASSIFICATIONS)}")
+
+    return config.INCOME_CLASSIFICATION == "historical"
+
+
+@lru_cache
+def _read_history(path: Path, version: str) -> pd.DataFrame:
+    return pd.read_csv(path, dtype={"iso3_code": "str", "year": "int64", "income_level": "str"})
+
+
+def income_history() -> pd.DataFrame:
+    """The historical classification: iso3_code, year and income_level of every classified country and year"""
+
+    path = history_path()
+    if not path.exists():
+        raise FileNotFoundError(f"{path} not found. Download it with `python -m scripts.refresh income_history`")
+
+    return _read_history(path, file_hash(path))
+
+
+def historical_income_levels(iso3_codes, years) -> pd.DataFrame:
+    """The historical income level of each country in each year
+
+    Returns:
+        a dataframe with the columns iso3_code, year and income_level (NaN where a
+        country was not classified)
+    """
+
+    history = income_history()
+    first, last = history.year.min(), history.year.max()
+
+    grid = pd.MultiIndex.from_product([pd.Series(iso3_codes).dropna().unique(), pd.Series(years).dropna().unique()],
+                                      names=["iso3_code", "year"]).to_frame(index=False)
+
+    return (grid
+            .assign(classification_year=lambda d: d.year.clip(first, last))
+            .merge(history.rename(columns={"year": "classification_year"}),
+                   on=["iso3_code", "classification_year"], how="left")
+            .drop(columns="classification_year")
+            )
+
+
+def add_income_level(df: pd.DataFrame, id_column: str = "iso3_code",
+                     target_column: str = "income_level") -> pd.DataFrame:
+    """Add the income level of the country (by iso3 code) of each row
+
+    With the historical classification, the level of the year of the row (`df` must have
+    a year column).
+    """
+
+    if not historical():
+        return add_income_level_column(df, id_column, "ISO3", target_column=target_column)
+
+    if "year" not in df.columns:
+        raise ValueError("The historical income classification needs a year column")
+
+    levels = historical_income_levels(df[id_column], df.year).rename(
+        columns={"iso3_code": id_column, "income_level": target_column})
+
+    return df.drop(columns=target_column, errors="ignore").merge(levels, on=[id_column, "year"], how="left")
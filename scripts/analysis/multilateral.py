@@ -1,21 +1,66 @@
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
-from bblocks import add_income_level_column, set_bblocks_data_path
-from oda_data import read_crs, set_data_path, download_crs
-from pydeflate import set_pydeflate_path, oecd_dac_deflate
 
 from scripts import config
+from scripts.analysis.checkpoint import checkpoint_key, file_hash, load_checkpoint, save_checkpoint
+from scripts.analysis.reduction import sum_by
 from scripts.config import PATHS
+from scripts.lazy import lazy_function
+from scripts.logger import logger
+
+add_income_level_column = lazy_function("bblocks", "add_income_level_column")
+read_crs = lazy_function("oda_data", "read_crs")
+download_crs = lazy_function("oda_data", "download_crs")
+oecd_dac_deflate = lazy_function("pydeflate", "oecd_dac_deflate")
 
 MULTI_CONSTANT_YEAR: int = 2022
 MULTI_START_YEAR: int = 2006
 MULTI_END_YEAR: int = 2022
 
-# Set path to raw data folders
-set_data_path(PATHS.raw_data)
-set_pydeflate_path(PATHS.pydeflate_data)
-set_bblocks_data_path(PATHS.raw_data)
+# Raw CRS files written by oda_data: one per year, or one with every year
+CRS_YEAR_FILE = re.compile(r"crs_(\d{4})_raw\.(feather|parquet)")
+CRS_FULL_FILE = "fullCRS.parquet"
+
+# Parallel CRS reduction: number of worker processes and number of years per task
+MULTI_WORKERS: int = os.cpu_count() or 1
+MULTI_CHUNK_YEARS: int = 1
+
+
+def init_paths() -> None:
+    """Point oda_data, pydeflate and bblocks to the raw data folders.
+
+    Must be called before reading the CRS, deflating or adding income levels.
+    """
+    from bblocks import set_bblocks_data_path
+    from oda_data import set_data_path
+    from pydeflate import set_pydeflate_path
+
+    set_data_path(PATHS.raw_data)
+    set_pydeflate_path(PATHS.pydeflate_data)
+    set_bblocks_data_path(PATHS.raw_data)
+
+
+def pydeflate_signature() -> list[tuple[str, int]]:
+    """The pydeflate data files and their modification times, for checkpoint keys of deflated data"""
+
+    return sorted((str(p.relative_to(PATHS.pydeflate_data)), p.stat().st_mtime_ns)
+                  for p in PATHS.pydeflate_data.rglob("*") if p.is_file())
+
+
+def init_worker(paths: dict[str, Path]) -> None:
+    """Initialise a spawned worker: use the paths of the parent process, then `init_paths`"""
+
+    for name, path in paths.items():
+        setattr(PATHS, name, path)
+    init_paths()
+
 
 # ----------------------------- Sector Groups ------------------------------------------
 health = [120]
@@ -70,6 +115,72 @@ MULTILATERALS: dict = {
     1044: ("New Development Bank", [1, 2]),
 }
 
+# ----------------------------- CRS schema ---------------------------------------------
+
+# Types enforced on the CRS columns (and the columns derived from them) at every stage.
+# Repetitive strings are categoricals (with lexically sorted categories, so sorting and
+# grouping order match plain strings) and codes are small integers.
+CRS_SCHEMA: dict[str, str] = {
+    "year": "int16",
+    "donor_code": "int16",
+    "agency_code": "Int16",
+    "donor_name": "category",
+    "recipient_code": "Int16",
+    "recipient_name": "category",
+    "recipient_region_code": "Int32",
+    "recipient_region": "category",
+    "purpose_code": "Int32",
+    "sector_code": "Int16",
+    "purpose_name": "category",
+    "sector_name": "category",
+    "flow_name": "category",
+    "sector": "category",
+    "broad_sector": "category",
+    "income_level": "category",
+    "usd_disbursement": "float64",
+}
+
+
+def enforce_crs_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Cast the CRS columns present in the dataframe to the types in CRS_SCHEMA"""
+
+    types = {col: dtype for col, dtype in CRS_SCHEMA.items() if col in df.columns and dtype != "category"}
+    df = df.astype(types) if types else df
+
+    categorical = {}
+    for col in [c for c, dtype in CRS_SCHEMA.items() if c in df.columns and dtype == "category"]:
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            categorical[col] = df[col].astype(pd.CategoricalDtype(sorted(df[col].dropna().unique())))
+        elif not df[col].cat.categories.is_monotonic_increasing:
+            categorical[col] = df[col].cat.set_categories(df[col].cat.categories.sort_values())
+
+    return df.assign(**categorical) if categorical else df
+
+
+def map_categorical(s: pd.Series, mapping: dict, *, keep_unmapped: bool = True) -> pd.Series:
+    """Map the values of a series through its categories, returning a categorical series.
+
+    The mapping is applied to the (few) categories only, and the codes are remapped with
+    an array lookup, so the cost does not depend on the string values in every row.
+
+    Args:
+        s: the series to map
+        mapping: a dictionary of old values to new values
+        keep_unmapped: keep values not in the mapping (as `rename`), or set them to NaN (as `map`)
+    """
+
+    s = s.astype("category")
+    old = s.cat.categories
+    new = old.map(lambda c: mapping.get(c, c if keep_unmapped else np.nan))
+
+    categories = pd.Index(sorted(new.dropna().unique()))
+    lookup = categories.get_indexer(new)
+    codes = s.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, lookup[codes], -1)
+
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=s.index, name=s.name)
+
+
 # -------------------------------------------------------------------------------------
 
 # helper function to convert from current to constant prices, using DAC data
@@ -83,8 +194,8 @@ to_constant_dac = partial(
 )
 
 
-def read_raw_data() -> pd.DataFrame:
-    """Read the CRS for the years under study"""
+def read_raw_data(years: range | list[int] = range(MULTI_START_YEAR, MULTI_END_YEAR + 1)) -> pd.DataFrame:
+    """Read the CRS for the years under study (exactly those years)"""
     cols = [
         "year",
         "donor_code",
@@ -101,7 +212,36 @@ def read_raw_data() -> pd.DataFrame:
         "flow_name",
         "usd_disbursement",
     ]
-    return read_crs(years=range(MULTI_START_YEAR, MULTI_END_YEAR + 1), columns=cols)
+    return read_crs(years=years, columns=cols).pipe(enforce_crs_schema)
+
+
+def crs_files(years: range = range(MULTI_START_YEAR, MULTI_END_YEAR + 1), *,
+              required: bool = True) -> dict[int, list[Path]]:
+    """Return the raw CRS files stored for each year under study
+
+    oda_data stores the CRS either in one file per year (`crs_<year>_raw.feather`), or all
+    years in one file (`fullCRS.parquet`), which then holds every year.
+
+    Args:
+        years: the years
+        required: raise if a year has no file. Otherwise its list of files is empty
+    """
+
+    by_year = {}
+    for path in sorted(PATHS.raw_data.glob("crs_*_raw.*")):
+        match = CRS_YEAR_FILE.fullmatch(path.name)
+        if match:
+            by_year.setdefault(int(match[1]), []).append(path)
+
+    full = [PATHS.raw_data / CRS_FULL_FILE] if (PATHS.raw_data / CRS_FULL_FILE).exists() else []
+    files = {year: by_year.get(year, []) + full for year in years}
+
+    missing = [year for year, paths in files.items() if not paths]
+    if required and missing:
+        raise FileNotFoundError(f"No CRS file in {PATHS.raw_data} for {', '.join(map(str, missing))}. "
+                                "Download them with `python -m scripts.refresh crs`")
+
+    return files
 
 
 def filter_multi_donors(df: pd.DataFrame) -> pd.DataFrame:
@@ -112,23 +252,23 @@ def filter_multi_donors(df: pd.DataFrame) -> pd.DataFrame:
 def add_sectors_column(df: pd.DataFrame) -> pd.DataFrame:
     """Add a column with the sector name for health, and 'other' for everything else."""
 
-    df = df.copy(deep=True)
-
-    for sector, codes in health_group.items():
-        df.loc[lambda d: d.purpose_code.isin(codes), "sector"] = sector
+    sectors = {code: sector for sector, codes in health_group.items() for code in codes}
 
-    return df.fillna({"sector": "Other"})
+    return df.assign(
+        sector=lambda d: map_categorical(d.purpose_code, sectors, keep_unmapped=False)
+        .cat.add_categories("Other")
+        .fillna("Other")
+    ).pipe(enforce_crs_schema)
 
 
 def add_broad_sectors_column(df: pd.DataFrame) -> pd.DataFrame:
     """Broad sector name for health, and 'other' for everything else"""
 
-    df = df.copy(deep=True)
-
-    for sector, name in health_broad_group.items():
-        df.loc[df.sector == sector, "broad_sector"] = name
-
-    return df.fillna({"broad_sector": "Other"})
+    return df.assign(
+        broad_sector=lambda d: map_categorical(d.sector, health_broad_group, keep_unmapped=False)
+        .cat.add_categories("Other")
+        .fillna("Other")
+    ).pipe(enforce_crs_schema)
 
 
 def _multi_donor_query(donors_dict: dict[str, tuple[str, list[int]]]) -> str:
@@ -144,27 +284,126 @@ def filter_mdb_data(data: pd.DataFrame) -> pd.DataFrame:
 
     query = _multi_donor_query(MULTILATERALS)
 
+    names = {code: name for code, (name, _) in MULTILATERALS.items()}
+
     return data.query(query).assign(
-        donor_name=lambda d: d.donor_code.map(MULTILATERALS).str[0]
+        donor_name=lambda d: map_categorical(d.donor_code, names, keep_unmapped=False)
     )
 
 
+SUMMARY_KEYS: list[str] = [
+    "donor_code",
+    "donor_name",
+    "recipient_code",
+    "recipient_name",
+    "recipient_region_code",
+    "flow_name",
+    "year",
+    "sector",
+    "broad_sector",
+]
+
+
 def summarise_by_donor_recipient_year_flow_sector(df: pd.DataFrame) -> pd.DataFrame:
     """Summarise the data by  donor, recipient, year and sector"""
-    group_by = [
-        "donor_code",
-        "donor_name",
-        "recipient_code",
-        "recipient_name",
-        "recipient_region_code",
-        "flow_name",
-        "year",
-        "sector",
-        "broad_sector",
-    ]
-    return df.groupby(group_by, observed=True, dropna=False, as_index=False)[
-        "usd_disbursement"
-    ].sum(numeric_only=True)
+    return sum_by(df, SUMMARY_KEYS, "usd_disbursement")
+
+
+def summarise_years(years: list[int]) -> pd.DataFrame:
+    """Read, filter, tag sectors and summarise the CRS for a subset of years
+
+    Only the given years are read: the years between them may come from checkpoints.
+    """
+
+    return (
+        read_raw_data(years=list(years))
+        .pipe(filter_multi_donors)
+        .pipe(filter_mdb_data)
+        .pipe(add_sectors_column)
+        .pipe(add_broad_sectors_column)
+        .pipe(summarise_by_donor_recipient_year_flow_sector)
+    )
+
+
+def crs_year_hashes(years: range = range(MULTI_START_YEAR, MULTI_END_YEAR + 1)) -> dict[int, list[str]]:
+    """The hashes of the raw CRS files of each year"""
+
+    return {year: [file_hash(p) for p in files] for year, files in crs_files(years).items()}
+
+
+def year_summary_checkpoint(year: int) -> tuple[str, str]:
+    """Name and key of the checkpoint of a year's summary: its CRS files, donors and sectors"""
+
+    key = checkpoint_key(
+        crs=crs_year_hashes(range(year, year + 1))[year],
+        multilaterals=MULTILATERALS,
+        health_group=health_group,
+        health_broad_group=health_broad_group,
+        summary_keys=SUMMARY_KEYS,
+    )
+
+    return f"crs_summary_{year}", key
+
+
+def summarise_crs_parallel(
+    years: range = range(MULTI_START_YEAR, MULTI_END_YEAR + 1),
+    *,
+    workers: int = MULTI_WORKERS,
+    chunk_years: int = MULTI_CHUNK_YEARS,
+    checkpoints: bool = True,
+) -> pd.DataFrame:
+    """Summarise the MDB CRS data, processing chunks of years in a pool of processes.
+
+    Every stage up to `summarise_by_donor_recipient_year_flow_sector` is independent
+    per year, so each worker reads and reduces its own years. The partial summaries
+    do not overlap (year is a grouping key) and are merged in key order, so the
+    result is the same as the single process pipeline, whatever the number of workers.
+
+    The summary of each year is checkpointed, keyed by the hashes of its CRS files, so
+    only the years whose files changed (see `scripts.refresh`) are read again.
+
+    Args:
+        years: the years to read
+        workers: the number of worker processes. 1 runs in the current process
+        chunk_years: the number of years handled by each task
+        checkpoints: load and save the summary of each year from/to a checkpoint
+
+    Returns:
+        the summarised data
+    """
+
+    years = list(years)
+    names = {year: year_summary_checkpoint(year) for year in years} if checkpoints else {}
+    cached = {year: load_checkpoint(*names[year]) for year in names}
+    cached = {year: df for year, df in cached.items() if df is not None}
+
+    todo = [year for year in years if year not in cached]
+    chunks = [todo[i : i + chunk_years] for i in range(0, len(todo), chunk_years)]
+
+    if cached:
+        logger.info(f"CRS summaries loaded from checkpoints: {len(cached)} years. To summarise: {todo or 'none'}")
+
+    if workers <= 1 or len(chunks) <= 1:
+        parts = [summarise_years(chunk) for chunk in chunks]
+    else:
+        # spawned workers don't inherit the threads (writers, pipeline stages) and locks of this process
+        context = multiprocessing.get_context("spawn")
+        paths = {name: value for name, value in vars(PATHS).items() if isinstance(value, Path)}
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context,
+                                 initializer=init_worker, initargs=(paths,)) as pool:
+            parts = list(pool.map(summarise_years, chunks))
+
+    if checkpoints:
+        for chunk, part in zip(chunks, parts):
+            for year in chunk:
+                save_checkpoint(part.loc[part.year == year].reset_index(drop=True), *names[year])
+
+    return (
+        pd.concat([*cached.values(), *parts], ignore_index=True)
+        .pipe(enforce_crs_schema)
+        .sort_values(SUMMARY_KEYS, kind="stable", na_position="last")
+        .reset_index(drop=True)
+    )
 
 
 def rename_ambiguous_recipients(df: pd.DataFrame) -> pd.DataFrame:
@@ -178,19 +417,17 @@ def rename_ambiguous_recipients(df: pd.DataFrame) -> pd.DataFrame:
         r"Türkiye": "Turkey",
     }
 
-    df["recipient_name"] = (
-        df["recipient_name"].map(mapping).fillna(df["recipient_name"])
-    )
-
-    return df
+    return df.assign(recipient_name=lambda d: map_categorical(d.recipient_name, mapping))
 
 
 def add_income_levels(df: pd.DataFrame) -> pd.DataFrame:
     """Add an income level column to the data"""
 
-    return add_income_level_column(
-        df, id_column="recipient_name", id_type="regex"
-    ).fillna({"income_level": "Not classified by income"})
+    return (
+        add_income_level_column(df, id_column="recipient_name", id_type="regex")
+        .fillna({"income_level": "Not classified by income"})
+        .pipe(enforce_crs_schema)
+    )
 
 
 def add_region_groups(df: pd.DataFrame) -> pd.DataFrame:
@@ -213,10 +450,12 @@ def add_region_groups(df: pd.DataFrame) -> pd.DataFrame:
         798: "Asia",
     }
 
-    return df.assign(recipient_region=lambda d: d.recipient_region_code.map(regions))
+    return df.assign(
+        recipient_region=lambda d: map_categorical(d.recipient_region_code, regions, keep_unmapped=False)
+    )
 
 
 if __name__ == "__main__":
     # to update underlying data
-    ...
+    init_paths()
     # download_crs()
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""Rebase constant-price data to another base year, without downloading or rebuilding.
+
+The GHED `*_usd2022` indicators and the MDB data (deflated with `to_constant_dac`) are in
+constant `config.CONSTANT_YEAR` USD. Moving a constant-price series to another base year
+multiplies every year by the same factor, the price level of the new base year relative
+to the old one, so rebasing is a vectorized multiply by a cached deflator vector:
+
+- GHED: for each country, `gdp_usd / gdp_usd2022` in the new base year. Group rows are
+  not rebased with a factor: they are aggregated again from the rebased country rows, with
+  the same aggregation (and completion threshold) as the builders.
+- DAC: for each MDB donor, the ratio of the DAC deflators of the two base years (pydeflate),
+  checkpointed by base year.
+
+Several base years can be produced in one run (see `config.BASE_YEARS`).
+"""
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from scripts import config
+from scripts.analysis.aggregates import aggregate, aggregate_per_capita, requested_groups
+from scripts.analysis.checkpoint import checkpoint_key, file_hash, load_or_build
+from scripts.analysis.common import get_ghed_cube
+from scripts.analysis.cube import GDP
+from scripts.analysis.multilateral import MULTILATERALS, init_paths, pydeflate_signature, to_constant_dac
+from scripts.config import PATHS
+from scripts.logger import logger
+from scripts.manifest import read_csv, write_csv
+
+# GDP in current USD, the numerator of the GHED deflators
+GDP_CURRENT = "gdp_usd"
+
+
+def ghed_deflators(base_year: int) -> pd.Series:
+    """Factors converting constant `config.CONSTANT_YEAR` USD to constant `base_year` USD, by iso3 code
+
+    Cached for each version of ghed.csv.
+    """
+
+    return _ghed_deflators(base_year, file_hash(PATHS.raw_data / "ghed.csv"))
+
+
+@lru_cache
+def _ghed_deflators(base_year: int, source: str) -> pd.Series:
+    cube = get_ghed_cube()
+    if base_year not in cube.years:
+        raise ValueError(f"No GHED data for {base_year}. Base years: {cube.years.min()}-{cube.years.max()}")
+
+    year = cube.years.get_loc(base_year)
+    current = pd.Series(cube.panel(GDP_CURRENT)[:, year], index=cube.countries)
+    constant = pd.Series(cube.panel(GDP)[:, year], index=cube.countries)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (current / constant).replace([np.inf, -np.inf], np.nan).dropna().rename("factor")
+
+
+@lru_cache
+def dac_deflators(base_year: int) -> pd.Series:
+    """Factors converting constant `config.CONSTANT_YEAR` USD to constant `base_year` USD, by MDB donor code
+
+    The factors are the inverse of a unit value of `base_year` deflated with `to_constant_dac`.
+    """
+
+    def build() -> pd.DataFrame:
+        init_paths()
+        units = pd.DataFrame({"donor_code": list(MULTILATERALS), "year": base_year, "usd_disbursement": 1.0})
+
+        return (units
+                .pipe(to_constant_dac)
+                .assign(factor=lambda d: 1 / d.usd_disbursement)
+                .loc[:, ["donor_code", "factor"]]
+                )
+
+    key = checkpoint_key(base_year=base_year, constant_year=config.CONSTANT_YEAR,
+                         donors=list(MULTILATERALS), pydeflate=pydeflate_signature())
+
+    return load_or_build(f"dac_deflators_{base_year}", key, build).set_index("donor_code")["factor"]
+
+
+def rebase(df: pd.DataFrame, factors: pd.Series, *, key: str = "iso3_code", value: str = "value") -> pd.DataFrame:
+    """Multiply `value` by the factor of the `key` of each row. Rows without a factor become NaN
+
+    Use with `ghed_deflators` for GHED country data (by iso3_code), and with
+    `dac_deflators` for CRS data (by donor_code).
+    """
+
+    return df.assign(**{value: df[value] * df[key].map(factors)})
+
+
+def group_aggregations() -> dict[str, tuple[str, Callable]]:
+    """For each constant USD unit of the builder outputs: the unit of the country rows its
+    group rows are aggregated from, and the aggregation (as in `create_data`)"""
+
+    usd, usd_source = f"USD constant ({config.CONSTANT_YEAR})", f"constant USD ({config.CONSTANT_YEAR})"
+
+    return {
+        usd: (usd, aggregate),
+        usd_source: (usd_source, aggregate),
+        f"per capita, USD constant ({config.CONSTANT_YEAR})": (usd, aggregate_per_capita),
+    }
+
+
+def reaggregate(df: pd.DataFrame) -> pd.DataFrame:
+    """Replace the constant USD group rows of an output by aggregates of its country rows
+
+    Each group row is aggregated again from the country rows of the same source, so the
+    groups of rebased country data sum the rebased values of the members that pass the
+    completion threshold. Groups no longer aggregated are dropped. The order of the rows
+    is kept.
+    """
+
+    aggregations = group_aggregations()
+    keys = [col for col in ("unit", "source") if col in df]
+    group_rows = df.iso3_code.isna() & df.unit.isin(list(aggregations))
+
+    parts = [df.loc[~group_rows]]
+    for values, rows in df.loc[group_rows].groupby(keys, sort=False):
+        selection = dict(zip(keys, values))
+        unit, func = aggregations[selection["unit"]]
+        countries = df.loc[lambda d: d.iso3_code.notna() & (d.unit == unit)
+                                     & (d.source == selection["source"] if "source" in selection else True)]
+
+        with requested_groups(sorted(rows.entity_name.unique())):
+            groups = func(countries.loc[:, ["iso3_code", "year", "value"]])
+
+        parts.append(rows
+                     .drop(columns="value")
+                     .reset_index()
+                     .merge(groups.rename(columns={"group": "entity_name"}), on=["entity_name", "year"], how="inner")
+                     .set_index("index")
+                     .loc[:, df.columns])
+
+    return pd.concat(parts).sort_index().rename_axis(df.index.name)
+
+
+def rebase_output(df: pd.DataFrame, base_year: int) -> pd.DataFrame:
+    """Rebase the constant USD rows of a builder output and update their unit
+
+    Countries are rebased by iso3 code, and the groups are aggregated again from the
+    rebased countries (see `reaggregate`). Outputs without a unit column (expenditure by
+    condition) are all in constant USD, and have no groups.
+    """
+
+    old, new = f"({config.CONSTANT_YEAR})", f"({base_year})"
+    constant = df.unit.str.contains(old, regex=False) if "unit" in df else pd.Series(True, index=df.index)
+
+    deflators = ghed_deflators(base_year)
+    missing = sorted(set(df.iso3_code.loc[constant].dropna()) - set(deflators.index))
+    if missing:
+        logger.warning(f"No {base_year} deflator for {', '.join(missing)}: their constant USD values are missing"
+                       f" and count as missing in the group aggregates")
+
+    factors = df.iso3_code.map(deflators).where(constant, 1)
+    df = df.assign(value=df.value * factors)
+
+    if "unit" in df:
+        df = df.pipe(reaggregate)
+
+    if "unit" in df:
+        df = df.assign(unit=df.unit.str.replace(old, new, regex=False))
+
+    return df
+
+
+def rebased_path(path: Path, base_year: int) -> Path:
+    """The path of an output rebased to `base_year`, e.g. gov_expenditure_2023.csv"""
+    return path.with_name(f"{path.stem}_{base_year}{path.suffix}")
+
+
+def write_rebased(file_name: str, base_years: list[int] | None = None) -> None:
+    """Write a builder output rebased to each base year, next to the output
+
+    The output is read from memory when the pipeline keeps frames, otherwise from disk.
+    """
+
+    df = read_csv(PATHS.output / file_name)
+    for base_year in config.BASE_YEARS if base_years is None else base_years:
+        write_csv(rebase_output(df, base_year), rebased_path(PATHS.output / file_name, base_year))
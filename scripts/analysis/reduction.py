@@ -0,0 +1,208 @@
+"""Factorized group-by sums for the CRS summaries.
+
+The key columns are converted to integer codes, packed into a single int64 key and the
+values are summed with `np.bincount`. Categorical keys are coded by their codes, and the
+outputs keep the type of their keys: the CRS string columns are categoricals (see
+`CRS_SCHEMA`), so the factorization is carried forward through them and the later
+reductions (and the pivot) read `cat.codes` instead of hashing the values again. Integer
+keys with a small range (years, donor codes) are coded by subtracting their minimum,
+which needs no hashing at all.
+
+The results are the same as those of the pandas group-bys (and pivot) they replace:
+see `scripts.benchmarks.reduction`.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Integer keys spanning at most this many values are coded by offset instead of hashing
+_MAX_RANGE: int = 1_000_000
+
+# Packed keys are re-densified before they can overflow an int64
+_MAX_PACKED: int = 2**62
+
+
+def _dense_ranks(packed: np.ndarray, cardinality: int) -> tuple[np.ndarray, int]:
+    """Number the distinct packed keys 0..n-1 in sorted order. Negative keys get -1"""
+
+    valid = packed >= 0
+
+    # when the key space is small, rank the keys with a lookup table instead of hashing
+    if cardinality <= max(4 * len(packed), 1 << 20):
+        present = np.bincount(packed[valid], minlength=cardinality) > 0
+        ranks = np.cumsum(present) - 1
+        return np.where(valid, ranks[np.where(valid, packed, 0)], -1), int(present.sum())
+
+    # otherwise sort them (faster than hashing and sorting the distinct keys)
+    group_ids = np.full(len(packed), -1, dtype="int64")
+    uniques, group_ids[valid] = np.unique(packed[valid], return_inverse=True)
+    return group_ids, len(uniques)
+
+
+class KeyCodes:
+    """Integer codes for one key column.
+
+    Attributes:
+        codes: an int64 array with the (dense) code of each row, -1 for missing values
+        categories: the sorted values the codes refer to
+        positions: the position in `categories` of each code
+        kind: how the column was coded: "categorical", "range" or "factorized"
+        dtype: the dtype of the original column
+    """
+
+    def __init__(self, s: pd.Series):
+        self.dtype = s.dtype
+
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            self.kind = "categorical"
+            codes = s.cat.codes.to_numpy().astype("int64")
+            categories = s.cat.categories
+
+        elif pd.api.types.is_integer_dtype(s.dtype) and s.notna().any():
+            self.kind = "range"
+            start, end = int(s.min()), int(s.max())
+            if end - start >= _MAX_RANGE:
+                self.kind = "factorized"
+            else:
+                codes = s.to_numpy(dtype="int64", na_value=start - 1) - start
+                categories = pd.Index(np.arange(start, end + 1))
+
+        else:
+            self.kind = "factorized"
+
+        if self.kind == "factorized":
+            codes, uniques = pd.factorize(s, sort=True, use_na_sentinel=True)
+            codes = codes.astype("int64")
+            categories = pd.Index(uniques)
+
+        # keep only the values that are present, so the codes are dense
+        self.has_missing = bool((codes < 0).any())
+        present = np.bincount(codes[codes >= 0] if self.has_missing else codes, minlength=len(categories)) > 0
+        if present.all():
+            self.codes = codes
+            self.positions = np.arange(len(categories))
+        else:
+            ranks = np.cumsum(present) - 1
+            self.codes = np.where(codes >= 0, ranks[codes], -1)
+            self.positions = np.flatnonzero(present)
+        self.categories = categories
+
+    @property
+    def cardinality(self) -> int:
+        """The number of codes, including one for missing values"""
+        return len(self.positions) + 1
+
+    def decode(self, codes: np.ndarray) -> pd.Series:
+        """Return the key values for an array of codes, with the type of the original column"""
+
+        positions = np.where(codes >= 0, self.positions[codes], -1)
+
+        if self.kind == "categorical":
+            return pd.Series(pd.Categorical.from_codes(positions, dtype=self.dtype, validate=False))
+
+        return pd.Series(self.categories.array.take(positions, allow_fill=True)).astype(self.dtype)
+
+
+class Factorization:
+    """The packed group codes of a set of key columns.
+
+    Attributes:
+        keys: the key column names
+        columns: the KeyCodes of each key column
+        group_ids: the (dense) group of each row. Groups are numbered in key order
+        n_groups: the number of groups
+        first_rows: the position of the first row of each group
+    """
+
+    def __init__(self, df: pd.DataFrame, keys: list[str], *, dropna: bool = False):
+        self.keys = list(keys)
+        self.columns = [KeyCodes(df[key]) for key in self.keys]
+
+        packed = np.zeros(len(df), dtype="int64")
+        cardinality = 1
+        missing = np.zeros(len(df), dtype=bool)
+
+        for col in self.columns:
+            codes = col.codes
+            if col.has_missing:
+                missing |= codes < 0
+                # missing values are coded last, so they sort after every value (as in pandas)
+                codes = np.where(codes < 0, col.cardinality - 1, codes)
+
+            if cardinality * col.cardinality > _MAX_PACKED:
+                packed, uniques = pd.factorize(packed, sort=True)
+                cardinality = len(uniques)
+
+            packed *= col.cardinality
+            packed += codes
+            cardinality *= col.cardinality
+
+        if dropna:
+            packed[missing] = -1
+
+        self.group_ids, self.n_groups = _dense_ranks(packed, cardinality)
+
+        valid = np.flatnonzero(self.group_ids >= 0)
+        self.first_rows = np.empty(self.n_groups, dtype="int64")
+        self.first_rows[self.group_ids[valid][::-1]] = valid[::-1]
+
+    def key_frame(self) -> pd.DataFrame:
+        """A dataframe with the key values of each group, in group order"""
+
+        return pd.DataFrame(
+            {key: col.decode(col.codes[self.first_rows]) for key, col in zip(self.keys, self.columns)}
+        )
+
+    def sum(self, values: np.ndarray) -> np.ndarray:
+        """Sum an array of values by group, skipping missing values"""
+
+        valid = self.group_ids >= 0
+        return np.bincount(
+            self.group_ids[valid],
+            weights=np.nan_to_num(np.asarray(values, dtype="float64")[valid]),
+            minlength=self.n_groups,
+        )
+
+
+def sum_by(df: pd.DataFrame, keys: list[str], values: str | list[str], *, dropna: bool = False) -> pd.DataFrame:
+    """Sum values by a set of keys. Equivalent to
+    `df.groupby(keys, observed=True, dropna=dropna, as_index=False)[values].sum()`
+
+    Args:
+        df: the dataframe
+        keys: the columns to group by
+        values: the column(s) to sum
+        dropna: drop groups where any of the keys is missing
+
+    Returns:
+        a dataframe with the keys and the summed values, sorted by the keys
+    """
+
+    values = [values] if isinstance(values, str) else list(values)
+    groups = Factorization(df, keys, dropna=dropna)
+
+    return groups.key_frame().assign(**{col: groups.sum(df[col].to_numpy()) for col in values})
+
+
+def pivot(df: pd.DataFrame, index: list[str], columns: str, values: str) -> pd.DataFrame:
+    """Pivot a dataframe. Equivalent to `df.pivot(index=index, columns=columns, values=values).reset_index()`
+
+    Cells without data are NaN. Raises a ValueError if a cell has several values.
+    """
+
+    rows = Factorization(df, index)
+    cols = Factorization(df, [columns])
+
+    cells = rows.group_ids * cols.n_groups + cols.group_ids
+    size = rows.n_groups * cols.n_groups
+
+    if np.bincount(cells, minlength=size).max(initial=0) > 1:
+        raise ValueError("Index contains duplicate entries, cannot reshape")
+
+    table = np.full(size, np.nan)
+    table[cells] = df[values].to_numpy(dtype="float64", na_value=np.nan)
+
+    names = cols.key_frame()[columns].astype(object).tolist()
+    data = pd.DataFrame(table.reshape(rows.n_groups, cols.n_groups), columns=names)
+
+    return pd.concat([rows.key_frame(), data], axis=1).rename_axis(columns=columns)
@@ -0,0 +1,75 @@
+"""A snapshot of the GHED data, shared by the builders"""
+
+import numpy as np
+import pandas as pd
+
+# The columns of the indicator views
+INDICATOR_COLUMNS = ("iso3_code", "year", "value")
+
+
+def _read_only(column: pd.Series) -> pd.Series:
+    """A copy of a column whose numpy array (or categorical codes) can't be written to"""
+
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy(copy=True)
+        codes.flags.writeable = False
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=column.dtype), index=column.index,
+                         name=column.name, copy=False)
+
+    if isinstance(column.dtype, np.dtype):
+        values = column.to_numpy(copy=True)
+        values.flags.writeable = False
+        return pd.Series(values, index=column.index, name=column.name, copy=False)
+
+    # extension arrays (e.g. arrow strings) are immutable
+    return column
+
+
+class GhedSnapshot:
+    """Long GHED data in one frame, with the rows of each indicator next to each other.
+
+    Every caller (and thread) shares the snapshot. Callers get new frames that reference
+    its data through pandas (shallow copies and slices), without copying it. With
+    copy-on-write, changing a value or a column of such a frame copies the data it
+    changes in that frame only, so a frame handed to one caller is never changed by
+    another, and the snapshot never is. The rows of an indicator are a slice of the
+    data, not a filtered copy of the whole data.
+
+    Copy-on-write only protects data changed through pandas, so the arrays of the snapshot
+    are also made read-only: writing to them through numpy (e.g. `.to_numpy()` or `.values`)
+    raises instead of changing every frame.
+
+    Attributes:
+        offsets: the first and last (excluded) row of each indicator
+    """
+
+    def __init__(self, data: pd.DataFrame, offsets: dict[str, tuple[int, int]]):
+        self._data = pd.DataFrame({col: _read_only(data[col]) for col in data.columns}, copy=False)
+        self.offsets = offsets
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "GhedSnapshot":
+        """Build the snapshot from long GHED data with an indicator_code column
+
+        Rows are grouped by indicator, keeping their order within each indicator.
+        """
+
+        data = df.sort_values("indicator_code", kind="stable", na_position="last").reset_index(drop=True)
+
+        bounds = data.index.to_series().groupby(data.indicator_code.to_numpy()).agg(["min", "max"])
+        offsets = {code: (int(row["min"]), int(row["max"]) + 1) for code, row in bounds.iterrows()}
+
+        return cls(data, offsets)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def frame(self) -> pd.DataFrame:
+        """All the data, as a new frame referencing the snapshot"""
+        return self._data.copy(deep=False)
+
+    def indicator(self, code: str, columns=INDICATOR_COLUMNS) -> pd.DataFrame:
+        """The rows of an indicator, as a new frame referencing the snapshot. Empty if the indicator is unknown"""
+
+        start, stop = self.offsets.get(code, (0, 0))
+        return self._data.iloc[start:stop][list(columns)].reset_index(drop=True)
@@ -0,0 +1,116 @@
+"""Check that the builders and aggregations give the same results on threads as serially.
+
+Every builder, aggregation and `add_*` indicator helper is run once serially, then several
+times concurrently in a thread pool, in a shuffled order and starting from an empty
+cache (so the threads also race to load the GHED snapshot and cube). Every concurrent
+result must be identical to the serial one, and the shared GHED snapshot must be
+unchanged at the end.
+
+Usage:
+    python -m scripts.benchmarks.concurrency
+    python -m scripts.benchmarks.concurrency --workers 16 --rounds 5 --synthetic 2
+"""
+
+import argparse
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable
+
+import pandas as pd
+
+from scripts.analysis import common, create_data
+from scripts.benchmarks.mutation import fingerprint
+from scripts.benchmarks.parity import AGGREGATIONS
+from scripts.logger import logger
+
+HELPERS = {
+    "add_pop": common.add_pop,
+    "add_gge_usd_const_2022": common.add_gge_usd_const_2022,
+    "add_gdp_usd_curr": common.add_gdp_usd_curr,
+    "add_gdp_usd_const_2022": common.add_gdp_usd_const_2022,
+    "add_che_usd2022": common.add_che_usd2022,
+}
+
+
+def tasks() -> dict[str, Callable[[], pd.DataFrame]]:
+    """The builders, and the aggregations and helpers on the health expenditure data"""
+
+    def on_che(func: Callable) -> Callable[[], pd.DataFrame]:
+        return lambda: func(common.get_indicator("che_usd2022"))
+
+    return {
+        **{f"create_data.{file_name}": partial(create_data.build_output, file_name)
+           for file_name in create_data.OUTPUTS},
+        **{f"aggregates.{name}": on_che(func) for name, func in AGGREGATIONS.items()},
+        **{f"common.{name}": on_che(func) for name, func in HELPERS.items()},
+    }
+
+
+def difference(expected: pd.DataFrame, result: pd.DataFrame) -> str | None:
+    """The difference between two frames, or None if they are identical"""
+
+    try:
+        pd.testing.assert_frame_equal(expected, result, check_exact=True)
+    except AssertionError as error:
+        return str(error)
+
+    return None
+
+
+def run_checks(workers: int = 8, rounds: int = 3, seed: int = 42) -> list[dict]:
+    """Run every task serially, then `rounds` times on `workers` threads, and compare"""
+
+    checks = tasks()
+    expected = {name: task() for name, task in checks.items()}
+    snapshot = fingerprint(common.get_ghed_data())
+
+    order = [name for name in checks for _ in range(rounds)]
+    random.Random(seed).shuffle(order)
+
+    common.get_ghed_snapshot.cache_clear()
+    common.get_ghed_cube.cache_clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(zip(order, pool.map(lambda name: checks[name](), order)))
+
+    checked = [{"check": name, "rows": len(result), "difference": difference(expected[name], result)}
+               for name, result in results]
+
+    changed = fingerprint(common.get_ghed_data()) != snapshot
+    checked.append({"check": "ghed snapshot", "rows": len(common.get_ghed_snapshot()),
+                    "difference": "the snapshot changed" if changed else None})
+
+    return checked
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare concurrent and serial runs of the builders")
+    parser.add_argument("--workers", type=int, default=8, help="number of threads")
+    parser.add_argument("--rounds", type=int, default=3, help="number of times each task runs concurrently")
+    parser.add_argument("--synthetic", type=int, metavar="SCALE", help="use synthetic GHED data of this scale")
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        from scripts.benchmarks.suite import synthetic_environment
+
+        environment = synthetic_environment(args.synthetic, seed=42)
+    else:
+        environment = nullcontext()
+
+    with environment:
+        results = run_checks(args.workers, args.rounds)
+
+    failures = [r for r in results if r["difference"] is not None]
+    for r in failures:
+        logger.error(f"{r['check']} differs:\n{r['difference']}")
+
+    logger.info(f"{len(results) - len(failures)}/{len(results)} concurrent results match the serial run")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
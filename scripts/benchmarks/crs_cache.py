@@ -0,0 +1,111 @@
+"""Check that the CRS summaries are the same with a sparse checkpoint cache as in a cold run.
+
+Synthetic CRS data is written as one file per year (as oda_data stores it) in a temporary
+raw data folder, and read from there instead of through oda_data. The summaries of every
+year are computed once without checkpoints (the cold run), then again after caching the
+summaries of some years only, in tasks spanning cached and uncached years, so that a task
+reading more years than it should would count the cached years twice.
+
+Usage:
+    python -m scripts.benchmarks.crs_cache
+    python -m scripts.benchmarks.crs_cache --scale 2 --chunk-years 3
+"""
+
+import argparse
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.analysis import multilateral
+from scripts.analysis.checkpoint import remove_checkpoints
+from scripts.analysis.multilateral import MULTI_END_YEAR, MULTI_START_YEAR, summarise_crs_parallel
+from scripts.benchmarks.synthetic import generate_crs
+from scripts.config import PATHS
+from scripts.logger import logger
+
+# the years cached before each run, by name of the check
+CACHES = {
+    "one year cached between uncached years": [MULTI_START_YEAR + 2],
+    "every other year cached": list(range(MULTI_START_YEAR, MULTI_END_YEAR + 1, 2)),
+    "last year uncached": list(range(MULTI_START_YEAR, MULTI_END_YEAR)),
+}
+
+
+@contextmanager
+def synthetic_crs(scale: int, seed: int):
+    """Write synthetic CRS files per year to a temporary raw data folder, and read the CRS from them"""
+
+    paths = PATHS.raw_data, PATHS.checkpoints
+    read_crs = multilateral.read_crs
+
+    def read(years, columns):
+        return pd.concat([pd.read_parquet(PATHS.raw_data / f"crs_{year}_raw.parquet", columns=columns)
+                          for year in years], ignore_index=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        PATHS.raw_data = Path(tmp) / "raw_data"
+        PATHS.checkpoints = PATHS.raw_data / ".checkpoints"
+        PATHS.raw_data.mkdir()
+
+        crs = generate_crs(scale, seed)
+        for year, df in crs.groupby("year", observed=True):
+            df.to_parquet(PATHS.raw_data / f"crs_{year}_raw.parquet", index=False)
+
+        multilateral.read_crs = read
+        try:
+            yield
+        finally:
+            multilateral.read_crs = read_crs
+            PATHS.raw_data, PATHS.checkpoints = paths
+
+
+def run_checks(scale: int = 1, seed: int = 42, chunk_years: int = 5) -> list[dict]:
+    """Compare the summaries built with each sparse cache to the cold run"""
+
+    years = range(MULTI_START_YEAR, MULTI_END_YEAR + 1)
+    results = []
+
+    with synthetic_crs(scale, seed):
+        cold = summarise_crs_parallel(years, workers=1, chunk_years=chunk_years, checkpoints=False)
+
+        for name, cached in CACHES.items():
+            for year in years:
+                remove_checkpoints(f"crs_summary_{year}")
+            summarise_crs_parallel(cached, workers=1, checkpoints=True)
+
+            warm = summarise_crs_parallel(years, workers=1, chunk_years=chunk_years, checkpoints=True)
+            try:
+                pd.testing.assert_frame_equal(warm, cold)
+                passed = True
+            except AssertionError as error:
+                logger.debug(f"{name}: {error}")
+                passed = False
+
+            results.append({"check": name, "rows": len(warm), "cold_rows": len(cold), "passed": passed})
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check the CRS summaries with a sparse checkpoint cache")
+    parser.add_argument("--scale", type=int, default=1, help="size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-years", type=int, default=5, help="years summarised by each task")
+    args = parser.parse_args(argv)
+
+    results = run_checks(args.scale, args.seed, args.chunk_years)
+
+    failed = [r for r in results if not r["passed"]]
+    for r in failed:
+        logger.error(f"{r['check']}: {r['rows']} rows, {r['cold_rows']} in the cold run")
+
+    logger.info(f"{len(results) - len(failed)}/{len(results)} sparse caches match the cold run")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
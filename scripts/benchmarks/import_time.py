@@ -0,0 +1,75 @@
+"""Startup cost of the entry points of the scripts package.
+
+Each module is imported in a fresh interpreter, so nothing is cached between runs. The
+wall time of the import is reported, together with the slowest third-party packages it
+pulled in (from `python -X importtime`).
+
+Usage:
+    python -m scripts.benchmarks.import_time
+    python -m scripts.benchmarks.import_time --repeat 5 --top 10
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+from statistics import median
+
+from scripts.config import PATHS
+from scripts.logger import logger
+
+ENTRY_POINTS: list[str] = [
+    "scripts.analysis.download_data",
+    "scripts.analysis.create_data",
+    "scripts.analysis.multilateral",
+    "scripts.charts.charts",
+    "scripts.charts.multilat_chart",
+]
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| *(\S+)")
+
+
+def import_time(module: str) -> tuple[float, dict[str, float]]:
+    """Import `module` in a fresh interpreter
+
+    Returns:
+        the wall time of the import in seconds, and the import time (seconds) of each
+        third-party package it pulled in
+    """
+
+    code = (f"import time; start = time.perf_counter(); import {module}; "
+            f"print(time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, cwd=PATHS.project, check=True)
+
+    packages = {}
+    for match in _IMPORTTIME.finditer(result.stderr):
+        package = match.group(3).split(".")[0]
+        if package in sys.stdlib_module_names or package.startswith("_") or package == "scripts":
+            continue
+        # the cumulative time of a package's first import includes its submodules
+        packages[package] = max(packages.get(package, 0), int(match.group(2)) / 1e6)
+
+    return float(result.stdout.strip().splitlines()[-1]), packages
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Measure the import time of each entry point")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="number of slowest packages to show")
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        packages = runs[-1][1]
+        slowest = sorted(packages, key=packages.get, reverse=True)[: args.top]
+
+        logger.info(f"{module}: {median(r[0] for r in runs):.3f}s "
+                    f"(slowest: {', '.join(f'{p} {packages[p]:.3f}s' for p in slowest)})")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Check that no pipeline stage modifies the frame it is given.
+
+Each stage is called directly (`.pipe` hands stages a shallow copy on recent pandas, which
+would hide changes to the input) and the fingerprint of its input (columns, types, index
+and a hash of every value) is compared before and after. The stages are those of the MDB
+pipeline up to chart 4.1 (on synthetic CRS data), the GHED aggregations and their helpers,
+and the sorting and filtering helpers used on the outputs (on synthetic GHED data).
+
+Usage:
+    python -m scripts.benchmarks.mutation
+    python -m scripts.benchmarks.mutation --scale 2
+"""
+
+import argparse
+import sys
+from functools import partial
+from typing import Callable
+
+import pandas as pd
+
+from scripts.analysis import aggregates, common, create_data
+from scripts.benchmarks.parity import AGGREGATIONS
+from scripts.benchmarks.suite import crs_stages, synthetic_environment
+from scripts.benchmarks.synthetic import generate_crs
+from scripts.charts import multilat_chart
+from scripts.logger import logger
+
+
+def fingerprint(df: pd.DataFrame) -> tuple:
+    """Columns, types, index and a hash of the values of a frame"""
+
+    return (tuple(df.columns), tuple(str(dtype) for dtype in df.dtypes), len(df),
+            int(pd.util.hash_pandas_object(df, index=True).sum()))
+
+
+def check_stages(stages: dict[str, Callable], df: pd.DataFrame, *, chain: bool) -> list[dict]:
+    """Run each stage on `df` (or on the output of the previous stage, with `chain`) and
+    record whether it modified its input"""
+
+    results = []
+
+    for name, func in stages.items():
+        before = fingerprint(df)
+        result = func(df)
+        results.append({"stage": name, "rows": len(df), "mutated": fingerprint(df) != before})
+        if chain:
+            df = result
+
+    return results
+
+
+def mdb_stages() -> dict[str, Callable]:
+    """The MDB pipeline stages, from the CRS to chart 4.1"""
+
+    return {
+        **crs_stages(),
+        "multilat.reorder_columns": multilat_chart.reorder_columns,
+        "multilat.clean_numbers": multilat_chart.clean_numbers,
+        "multilat.filter_from_year": partial(multilat_chart.filter_from_year, year=2016),
+        "multilat.clean_columns": multilat_chart.clean_columns,
+    }
+
+
+def aggregation_stages() -> dict[str, Callable]:
+    """The aggregation functions, each run on the same data"""
+
+    return {f"aggregates.{name}": func for name, func in AGGREGATIONS.items()}
+
+
+def aggregation_helper_stages() -> dict[str, Callable]:
+    """The helpers the aggregations are made of, run one after the other"""
+
+    return {
+        "aggregates.expand_df": aggregates.expand_df,
+        "aggregates.ffill_df": aggregates.ffill_df,
+        "aggregates.add_group": partial(aggregates.add_group, group="continent"),
+        "aggregates.filter_threshold": aggregates.filter_threshold,
+        "aggregates.agg": aggregates.agg,
+    }
+
+
+def output_stages() -> dict[str, Callable]:
+    """The helpers applied to the outputs"""
+
+    return {
+        "common.keep_relevant_groups": common.keep_relevant_groups,
+        "common.custom_sort": partial(common.custom_sort, col="entity_name", priority_list=common.RELEVANT_GROUPS),
+    }
+
+
+def run_checks(scale: int = 1, seed: int = 42) -> list[dict]:
+    """Run every check on synthetic data"""
+
+    results = check_stages(mdb_stages(), generate_crs(scale, seed), chain=True)
+
+    with synthetic_environment(scale, seed):
+        ghed = common.get_ghed_data()
+        che = ghed.loc[lambda d: d.indicator_code == "che_usd2022", ["iso3_code", "year", "value"]]
+
+        results += check_stages(aggregation_stages(), che, chain=False)
+        results += check_stages(aggregation_helper_stages(), che, chain=True)
+
+        output = create_data.OUTPUTS["expenditure_by_source.csv"]()
+        results += check_stages(output_stages(), output, chain=False)
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check that no pipeline stage modifies its input")
+    parser.add_argument("--scale", type=int, default=1, help="size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    results = run_checks(args.scale, args.seed)
+
+    mutated = [r["stage"] for r in results if r["mutated"]]
+    for stage in mutated:
+        logger.error(f"{stage} modifies its input")
+
+    logger.info(f"{len(results) - len(mutated)}/{len(results)} stages leave their input unchanged")
+
+    return 1 if mutated else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
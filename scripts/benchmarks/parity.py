@@ -0,0 +1,113 @@
+"""Check that the alternative engines give the same results as the pandas engine.
+
+Every aggregation and every builder is run on the GHED data with the pandas engine and
+with the engine being checked, and the results are compared within a floating-point
+tolerance. Use the real GHED data (the default) or synthetic data of any size.
+
+Usage:
+    python -m scripts.benchmarks.parity --engine duckdb
+    python -m scripts.benchmarks.parity --engine polars --synthetic 1
+    python -m scripts.benchmarks.parity --engine cube --synthetic 1
+"""
+
+import argparse
+import sys
+from contextlib import nullcontext
+
+import pandas as pd
+
+from scripts.analysis import aggregates, common, create_data
+from scripts.analysis.engines import use_engine
+from scripts.logger import logger
+
+ENGINES = ["duckdb", "polars", "cube"]
+
+# Indicators aggregated by the builders
+INDICATORS = ["che_usd2022", "gghed_usd2022", "ext_usd2022", "hf3_usd2022"]
+
+AGGREGATIONS = {
+    "aggregate": aggregates.aggregate,
+    "aggregate_per_capita": aggregates.aggregate_per_capita,
+    "aggregate_pct_gdp_usd_const_2022": aggregates.aggregate_pct_gdp_usd_const_2022,
+    "aggregate_pct_gge_usd_const_2022": aggregates.aggregate_pct_gge_usd_const_2022,
+    "aggregate_pct_che_usd2022": aggregates.aggregate_pct_che_usd2022,
+}
+
+
+def frames_match(expected: pd.DataFrame, result: pd.DataFrame, rtol: float) -> str | None:
+    """Compare two frames, ignoring the index. Returns the difference, or None if they match"""
+
+    try:
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True),
+                                      check_exact=False, rtol=rtol)
+    except AssertionError as error:
+        return str(error)
+
+    return None
+
+
+def check_aggregations(engine: str, rtol: float = 1e-9) -> list[dict]:
+    """Run every aggregation with both engines and compare the results"""
+
+    ghed = common.get_ghed_data()
+    results = []
+
+    for indicator in INDICATORS:
+        data = ghed.loc[lambda d: d.indicator_code == indicator, ["iso3_code", "year", "value"]]
+        for name, func in AGGREGATIONS.items():
+            with use_engine("pandas"):
+                expected = func(data)
+            with use_engine(engine):
+                result = func(data)
+
+            difference = frames_match(expected, result, rtol)
+            results.append({"check": f"{name}({indicator})", "rows": len(expected), "difference": difference})
+
+    return results
+
+
+def check_builders(engine: str, rtol: float = 1e-9) -> list[dict]:
+    """Run every builder with both engines and compare the outputs"""
+
+    results = []
+
+    for file_name, builder in create_data.OUTPUTS.items():
+        with use_engine("pandas"):
+            expected = builder().pipe(common.keep_relevant_groups)
+        with use_engine(engine):
+            result = builder().pipe(common.keep_relevant_groups)
+
+        difference = frames_match(expected, result, rtol)
+        results.append({"check": builder.__name__, "rows": len(expected), "difference": difference})
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare the results of an engine to the pandas engine")
+    parser.add_argument("--engine", choices=ENGINES, required=True)
+    parser.add_argument("--rtol", type=float, default=1e-9, help="relative tolerance")
+    parser.add_argument("--synthetic", type=int, metavar="SCALE", help="use synthetic GHED data of this scale")
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        from scripts.benchmarks.suite import synthetic_environment
+
+        environment = synthetic_environment(args.synthetic, seed=42)
+    else:
+        environment = nullcontext()
+
+    with environment:
+        results = check_aggregations(args.engine, args.rtol) + check_builders(args.engine, args.rtol)
+
+    failures = [r for r in results if r["difference"] is not None]
+    for r in failures:
+        logger.error(f"{r['check']} differs:\n{r['difference']}")
+
+    logger.info(f"{len(results) - len(failures)}/{len(results)} checks match the pandas engine")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Check the factorized group-by kernel against the pandas group-bys, and time both.
+
+Each CRS reduction (the yearly summary, the MDB health disbursements, their total and the
+chart pivot) is run with pandas and with `scripts.analysis.reduction` on the same data.
+The results must be equal, dtypes included. The CRS is read from the raw data folder with
+`--crs` (the years under study must have been downloaded, see
+`scripts.analysis.multilateral`), otherwise synthetic CRS data is used.
+
+Usage:
+    python -m scripts.benchmarks.reduction
+    python -m scripts.benchmarks.reduction --scale 4
+    python -m scripts.benchmarks.reduction --crs
+"""
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+
+from scripts.analysis.multilateral import (
+    SUMMARY_KEYS,
+    add_broad_sectors_column,
+    add_region_groups,
+    add_sectors_column,
+    filter_mdb_data,
+    filter_multi_donors,
+    init_paths,
+    read_raw_data,
+)
+from scripts.analysis.reduction import pivot, sum_by
+from scripts.benchmarks.synthetic import generate_crs
+from scripts.charts.multilat_chart import filter_health_broad, rename_regions
+from scripts.logger import logger
+
+HEALTH_KEYS = ["year", "broad_sector", "flow_name", "recipient_region", "recipient_name", "donor_name", "donor_code"]
+TOTAL_KEYS = ["year", "broad_sector", "flow_name", "recipient_region", "recipient_name"]
+
+
+def _timed(func, *args, repeat: int = 3) -> tuple[pd.DataFrame, float]:
+    """Run a function `repeat` times and return its result and the best wall time"""
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return result, best
+
+
+def _pandas_sum(df: pd.DataFrame, keys: list[str], *, dropna: bool = False) -> pd.DataFrame:
+    return df.groupby(keys, observed=True, dropna=dropna, as_index=False)["usd_disbursement"].sum()
+
+
+def _pandas_pivot(df: pd.DataFrame) -> pd.DataFrame:
+    return df.pivot(index=TOTAL_KEYS, columns="donor_name", values="usd_disbursement").reset_index()
+
+
+def _kernel_pivot(df: pd.DataFrame) -> pd.DataFrame:
+    return pivot(df, TOTAL_KEYS, "donor_name", "usd_disbursement")
+
+
+def _raises(func, df: pd.DataFrame) -> bool:
+    try:
+        func(df)
+    except ValueError:
+        return True
+    return False
+
+
+def run_checks(crs: pd.DataFrame, repeat: int = 3) -> list[dict]:
+    """Run each CRS reduction with pandas and with the kernel, and compare the results
+
+    Args:
+        crs: the CRS data, as read by `read_raw_data`
+        repeat: the number of runs timed (the best is kept)
+    """
+
+    crs = (crs
+           .pipe(filter_multi_donors)
+           .pipe(filter_mdb_data)
+           .pipe(add_sectors_column)
+           .pipe(add_broad_sectors_column)
+           )
+
+    summary = _pandas_sum(crs, SUMMARY_KEYS)
+    health = _pandas_sum(summary.pipe(add_region_groups).pipe(rename_regions).pipe(filter_health_broad),
+                         HEALTH_KEYS)
+    chart = pd.concat([health, _pandas_sum(health, TOTAL_KEYS, dropna=True).assign(donor_name="Total")],
+                      ignore_index=True)
+
+    cases = {
+        "summarise_by_donor_recipient_year_flow_sector": (
+            crs, lambda d: _pandas_sum(d, SUMMARY_KEYS), lambda d: sum_by(d, SUMMARY_KEYS, "usd_disbursement")),
+        "summarise_health_disbursements": (
+            health, lambda d: _pandas_sum(d, HEALTH_KEYS), lambda d: sum_by(d, HEALTH_KEYS, "usd_disbursement")),
+        "create_health_total": (
+            health, lambda d: _pandas_sum(d, TOTAL_KEYS, dropna=True),
+            lambda d: sum_by(d, TOTAL_KEYS, "usd_disbursement", dropna=True)),
+        "pivot_chart_data": (chart, _pandas_pivot, _kernel_pivot),
+    }
+
+    results = []
+    for name, (df, pandas_path, kernel_path) in cases.items():
+        expected, pandas_time = _timed(pandas_path, df, repeat=repeat)
+        result, kernel_time = _timed(kernel_path, df, repeat=repeat)
+
+        try:
+            pd.testing.assert_frame_equal(result, expected)
+            passed = True
+        except AssertionError as error:
+            logger.debug(f"{name}: {error}")
+            passed = False
+
+        results.append({"check": name, "rows": len(df), "pandas_s": pandas_time, "kernel_s": kernel_time,
+                        "speedup": pandas_time / kernel_time, "passed": passed})
+
+    duplicated = pd.concat([chart, chart.head(1)], ignore_index=True)
+    passed = _raises(_pandas_pivot, duplicated) and _raises(_kernel_pivot, duplicated)
+    results.append({"check": "pivot raises on duplicate cells", "rows": len(duplicated), "passed": passed})
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check and time the factorized group-by kernel")
+    parser.add_argument("--crs", action="store_true", help="use the CRS in the raw data folder")
+    parser.add_argument("--scale", type=int, default=1, help="size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="runs timed (the best is kept)")
+    args = parser.parse_args(argv)
+
+    if args.crs:
+        init_paths()
+        crs = read_raw_data()
+    else:
+        crs = generate_crs(args.scale, args.seed)
+
+    results = run_checks(crs, args.repeat)
+
+    timed = pd.DataFrame([r for r in results if "speedup" in r]).drop(columns="passed")
+    print(timed.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    failed = [r["check"] for r in results if not r["passed"]]
+    for check in failed:
+        logger.error(f"Failed: {check}")
+
+    logger.info(f"{len(results) - len(failed)}/{len(results)} reductions match pandas")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""Check the conditional requests of the raw data refresh, over HTTP.
+
+A fixture (an income classification in the format of the World Bank API) is served by a
+local http.server that answers If-None-Match with 304 and counts the requests. A source
+mirroring it (see `refresh.mirrored`) is refreshed in a temporary raw data folder:
+
+- the first refresh downloads and installs the fixture
+- the second one sends the ETag of the first, is answered 304, and rewrites nothing
+- once the fixture changes, it is downloaded and installed again
+- when installing fails, the mirror index keeps the previous entry, so the next refresh
+  downloads the file again
+
+Usage:
+    python -m scripts.benchmarks.refresh
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import tempfile
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from scripts import refresh
+from scripts.config import PATHS
+from scripts.logger import logger
+
+NAME = "income_fixture"
+
+
+def fixture(level: str = "Lower middle income") -> bytes:
+    """An income classification in the format of the World Bank API"""
+
+    countries = [{"id": "KEN", "incomeLevel": {"value": level}, "region": {"value": "Sub-Saharan Africa"}},
+                 {"id": "NOR", "incomeLevel": {"value": "High income"}, "region": {"value": "Europe & Central Asia"}},
+                 {"id": "AFE", "incomeLevel": {"value": "Aggregates"}, "region": {"value": "Aggregates"}}]
+
+    return json.dumps([{"page": 1, "pages": 1}, countries]).encode()
+
+
+class FixtureServer:
+    """Serve a body with an ETag, answering If-None-Match with 304, and log every request"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requests: list[tuple[int, str | None]] = []
+
+        served = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                etag = f'"{hashlib.sha256(served.body).hexdigest()[:16]}"'
+                status = HTTPStatus.NOT_MODIFIED if self.headers.get("If-None-Match") == etag else HTTPStatus.OK
+                served.requests.append((status.value, self.headers.get("If-None-Match")))
+
+                self.send_response(status)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0" if status == HTTPStatus.NOT_MODIFIED else str(len(served.body)))
+                self.end_headers()
+                if status == HTTPStatus.OK:
+                    self.wfile.write(served.body)
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt % args)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/{NAME}.json"
+
+    def __enter__(self) -> "FixtureServer":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_checks() -> list[dict]:
+    """Refresh the fixture source in a temporary folder and run every check"""
+
+    paths = PATHS.raw_data, PATHS.mirror, PATHS.checkpoints
+    checks = {}
+
+    with tempfile.TemporaryDirectory() as tmp, FixtureServer(fixture()) as server:
+        PATHS.raw_data = Path(tmp) / "raw_data"
+        PATHS.mirror, PATHS.checkpoints = PATHS.raw_data / ".mirror", PATHS.raw_data / ".checkpoints"
+        refresh.URLS[NAME] = server.url
+
+        try:
+            installed = PATHS.raw_data / "income_levels.csv"
+            mirrored = PATHS.mirror / f"{NAME}.json"
+            installs = []
+
+            def install(path: Path) -> None:
+                installs.append(path)
+                refresh.install_income_levels(path)
+
+            source = refresh.mirrored(NAME, ".json", install, [installed])
+
+            changed = source.refresh(False, False)
+            checks["the first refresh downloads and installs"] = (
+                changed and server.requests == [(200, None)] and installed.exists() and len(installs) == 1)
+
+            stamps = mirrored.stat().st_mtime_ns, installed.stat().st_mtime_ns
+            changed = source.refresh(False, False)
+            checks["an unchanged source is answered 304"] = (
+                not changed and server.requests[-1][0] == 304 and server.requests[-1][1] is not None)
+            checks["an unchanged source is not rewritten"] = (
+                (mirrored.stat().st_mtime_ns, installed.stat().st_mtime_ns) == stamps and len(installs) == 1)
+
+            server.body = fixture("Upper middle income")
+            changed = source.refresh(False, False)
+            checks["a changed source is installed again"] = (
+                changed and server.requests[-1][0] == 200 and len(installs) == 2
+                and "Upper middle income" in installed.read_text())
+
+            entry = refresh.read_index()[NAME]
+            server.body = b"not json"
+            try:
+                source.refresh(False, False)
+                failed = False
+            except ValueError:
+                failed = True
+            checks["a failed install keeps the index entry"] = failed and refresh.read_index()[NAME] == entry
+
+            server.body = fixture("Low income")
+            changed = source.refresh(False, False)
+            checks["a failed install is retried"] = (
+                changed and server.requests[-1] == (200, None) and "Low income" in installed.read_text())
+        finally:
+            PATHS.raw_data, PATHS.mirror, PATHS.checkpoints = paths
+            refresh.URLS.pop(NAME, None)
+
+    return [{"check": name, "passed": bool(passed)} for name, passed in checks.items()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check the conditional requests of the raw data refresh")
+    parser.parse_args(argv)
+
+    results = run_checks()
+
+    failed = [r["check"] for r in results if not r["passed"]]
+    for check in failed:
+        logger.error(f"Failed: {check}")
+
+    logger.info(f"{len(results) - len(failed)}/{len(results)} refresh checks passed")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
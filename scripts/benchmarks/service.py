@@ -0,0 +1,114 @@
+"""Check the query service end to end, over HTTP.
+
+A small dataset is written to a temporary folder and served by `scripts.service` on a free
+local port. The checks cover filtering (case-insensitive values, repeated values, year
+ranges, unknown filters and datasets), revalidation (a request with the ETag of the
+previous response is answered 304 without a body) and reloading (once the file changes,
+the old ETag no longer matches and the new values are served).
+
+Usage:
+    python -m scripts.benchmarks.service
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+
+from scripts import service
+from scripts.logger import logger
+
+FIXTURE = pd.DataFrame({
+    "entity_name": ["Africa", "Africa", "Kenya", "Kenya", "Africa"],
+    "iso3_code": [None, None, "KEN", "KEN", None],
+    "year": [2010, 2011, 2010, 2011, 2012],
+    "unit": ["percent of GDP"] * 5,
+    "value": [1.0, 2.0, 3.0, 4.0, 5.0],
+})
+
+
+def get(url: str, etag: str | None = None) -> tuple[int, str | None, bytes]:
+    """The status, ETag and body of a GET request"""
+
+    request = urllib.request.Request(url, headers={"If-None-Match": etag} if etag else {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers.get("ETag"), response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers.get("ETag"), error.read()
+
+
+def values(body: bytes) -> list[float]:
+    return [row["value"] for row in json.loads(body)]
+
+
+def run_checks() -> list[dict]:
+    """Serve the fixture and run every check"""
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / service.DATASETS["gov_expenditure"]
+        FIXTURE.to_csv(path, index=False)
+
+        served = service.Service(Path(folder))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), service.handler(served))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/gov_expenditure"
+
+        try:
+            checks = {}
+
+            status, etag, body = get(f"{url}?entity_name=africa")
+            checks["values are case-insensitive"] = status == 200 and values(body) == [1.0, 2.0, 5.0]
+
+            _, _, body = get(f"{url}?entity_name=Africa&entity_name=AFRICA&iso3_code=ken&iso3_code=KEN")
+            checks["filters combine"] = values(body) == []
+
+            _, _, body = get(f"{url}?entity_name=Kenya&entity_name=kenya")
+            checks["repeated values are returned once"] = values(body) == [3.0, 4.0]
+
+            _, _, body = get(f"{url}?year=2011-2012&year=2012")
+            checks["year ranges"] = values(body) == [2.0, 4.0, 5.0]
+
+            checks["unknown filters are rejected"] = get(f"{url}?donor=x")[0] == 400
+            checks["unknown datasets are not found"] = get(f"{url}_missing")[0] == 404
+
+            status, revalidated, body = get(f"{url}?entity_name=africa", etag)
+            checks["unchanged responses are revalidated"] = status == 304 and revalidated == etag and body == b""
+
+            FIXTURE.assign(value=lambda d: d.value * 10).to_csv(path, index=False)
+            served.reload()
+
+            status, new_etag, body = get(f"{url}?entity_name=africa", etag)
+            checks["changed files are reloaded"] = (status == 200 and new_etag != etag
+                                                   and values(body) == [10.0, 20.0, 50.0])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    return [{"check": name, "passed": passed} for name, passed in checks.items()]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check the filtering, revalidation and reloading of the query service")
+    parser.parse_args(argv)
+
+    results = run_checks()
+
+    failed = [r["check"] for r in results if not r["passed"]]
+    for check in failed:
+        logger.error(f"Failed: {check}")
+
+    logger.info(f"{len(results) - len(failed)}/{len(results)} service checks passed")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,361 @@
+"""Benchmark suite for the aggregation helpers, the builders, the charts and the MDB pipeline.
+
+Every stage runs on seeded synthetic data (see `synthetic.py`) at one or more scales, and
+records its wall time and peak memory, measured in a single run (with tracemalloc
+tracing, unless `--no-memory`, so compare results taken with the same option). Results are saved as json and can be compared to a
+stored baseline, failing when a stage is slower (or uses more memory) than the baseline by
+more than a threshold.
+
+The suite runs offline. Reference data used by the pipelines (the income classification
+used by `bblocks`) must have been cached by a previous run. CRS deflation is not included,
+as it needs the DAC deflators.
+
+The GHED stages can also be run with the other engines (see scripts/analysis/engines.py),
+in which case the speedup and the memory saved relative to pandas are reported. Their
+peak memory is also measured as resident memory, as tracemalloc doesn't see the memory
+allocated by DuckDB or Polars.
+
+Usage:
+    python -m scripts.benchmarks.suite --scales 1 10
+    python -m scripts.benchmarks.suite --scales 1 10 --groups ghed --engines pandas polars duckdb
+    python -m scripts.benchmarks.suite --scales 1 --baseline scripts/.logs/benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import writers
+from scripts.analysis import aggregates, common, create_data
+from scripts.analysis.engines import ENGINES, use_engine
+from scripts.analysis.multilateral import (
+    add_broad_sectors_column,
+    add_region_groups,
+    add_sectors_column,
+    filter_mdb_data,
+    filter_multi_donors,
+    rename_ambiguous_recipients,
+    summarise_by_donor_recipient_year_flow_sector,
+)
+from scripts.benchmarks.synthetic import generate_crs, generate_ghed
+from scripts.charts import charts, multilat_chart
+from scripts.config import PATHS
+from scripts.logger import logger
+
+RESULTS_DIR = PATHS.logs / "benchmarks"
+DEFAULT_SCALES = [1, 10]
+DEFAULT_THRESHOLD = 0.2
+
+
+def _rss() -> int | None:
+    """Resident memory of the process in bytes (Linux only)"""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+class PeakRss:
+    """Sample the resident memory in a background thread, to find its peak while a block runs"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self) -> "PeakRss":
+        self.start = self.peak = _rss()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.start is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss())
+
+    @property
+    def delta_mb(self) -> float | None:
+        return None if self.start is None else (self.peak - self.start) / 1e6
+
+
+def measure(func: Callable, *args, memory: bool = True, **kwargs) -> tuple[object, dict]:
+    """Run a function once and measure its wall time, peak resident memory and, with
+    `memory`, the peak memory allocated by python (tracemalloc slows the run down)
+    """
+
+    if memory:
+        tracemalloc.start()
+
+    try:
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            stats = {"wall_s": time.perf_counter() - start}
+
+        if memory:
+            stats["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        if memory:
+            tracemalloc.stop()
+
+    if rss.delta_mb is not None:
+        stats["peak_rss_mb"] = rss.delta_mb
+
+    return result, stats
+
+
+@contextmanager
+def synthetic_environment(scale: int, seed: int):
+    """Point the raw data and output paths to a temporary folder with synthetic GHED data"""
+
+    paths = PATHS.raw_data, PATHS.output, PATHS.checkpoints
+
+    with tempfile.TemporaryDirectory() as tmp:
+        PATHS.raw_data, PATHS.output = Path(tmp) / "raw_data", Path(tmp) / "output"
+        PATHS.checkpoints = PATHS.raw_data / ".checkpoints"
+        PATHS.raw_data.mkdir()
+        PATHS.output.mkdir()
+        generate_ghed(scale, seed).to_csv(PATHS.raw_data / "ghed.csv", index=False)
+        common.get_ghed_snapshot.cache_clear()
+        common.get_ghed_cube.cache_clear()
+
+        try:
+            yield
+        finally:
+            writers.flush()
+            PATHS.raw_data, PATHS.output, PATHS.checkpoints = paths
+            common.get_ghed_snapshot.cache_clear()
+            common.get_ghed_cube.cache_clear()
+
+
+def ghed_stages() -> dict[str, Callable]:
+    """Aggregation helpers and builders, run on the synthetic GHED data"""
+
+    def che():
+        ghed = common.get_ghed_data()
+        return ghed.loc[lambda d: d.indicator_code == "che_usd2022", ["iso3_code", "year", "value"]]
+
+    def read_ghed():
+        common.get_ghed_snapshot.cache_clear()
+        return common.get_ghed_snapshot()
+
+    return {
+        "common.get_ghed_data": read_ghed,
+        "aggregates.aggregate": lambda: aggregates.aggregate(che()),
+        "aggregates.aggregate_per_capita": lambda: aggregates.aggregate_per_capita(che()),
+        "aggregates.aggregate_pct_gdp_usd_const_2022": lambda: aggregates.aggregate_pct_gdp_usd_const_2022(che()),
+        "create_data.create_total_health_expenditure": create_data.create_total_health_expenditure,
+        "create_data.create_gov_expenditure": create_data.create_gov_expenditure,
+        "create_data.create_expenditure_by_source": create_data.create_expenditure_by_source,
+        "create_data.create_expenditure_by_condition": create_data.create_expenditure_by_condition,
+    }
+
+
+def write_builder_outputs() -> None:
+    """Write the builder outputs read by the charts (not timed)"""
+
+    for file_name in create_data.OUTPUTS:
+        create_data.write_output(file_name)
+
+
+def chart_stages() -> dict[str, Callable]:
+    """Chart functions, run on the builder outputs"""
+
+    names = ["chart_1_1", "chart_1_2", "chart_2_1", "chart_2_2", "chart_2_3", "chart_3_1",
+             "chart_4_1", "chart_4_2", "chart_into_2", "chart_intro_3"]
+
+    return {f"charts.{name}": getattr(charts, name) for name in names}
+
+
+def _add_health_total(df: pd.DataFrame) -> pd.DataFrame:
+    return pd.concat([df, multilat_chart.create_health_total(df)], ignore_index=True)
+
+
+def crs_stages() -> dict[str, Callable]:
+    """The stages of the MDB pipeline (without deflation and income levels), in order"""
+
+    stages = [
+        filter_multi_donors,
+        filter_mdb_data,
+        add_sectors_column,
+        add_broad_sectors_column,
+        summarise_by_donor_recipient_year_flow_sector,
+        rename_ambiguous_recipients,
+        add_region_groups,
+        multilat_chart.rename_regions,
+        multilat_chart.filter_health_broad,
+        multilat_chart.summarise_health_disbursements,
+        multilat_chart.filter_columns,
+        _add_health_total,
+        multilat_chart.pivot_chart_data,
+    ]
+
+    return {f"multilat.{func.__name__.lstrip('_')}": func for func in stages}
+
+
+def run_suite(scales: list[int], seed: int = 42, groups: list[str] | None = None,
+              memory: bool = True, engines: list[str] | None = None) -> list[dict]:
+    """Run the benchmark stages at each scale
+
+    Args:
+        scales: the data sizes, as multiples of the real data
+        seed: the random seed for the synthetic data
+        groups: the groups of stages to run: "ghed", "charts" and "crs". Defaults to all
+        memory: measure the peak memory of each stage
+        engines: the engines to run the "ghed" stages with. Defaults to pandas
+
+    Returns:
+        a list of results, one per stage, engine and scale
+    """
+
+    groups = groups or ["ghed", "charts", "crs"]
+    engines = engines or ["pandas"]
+    results = []
+
+    def record(scale: int, stage: str, func: Callable, engine: str = "pandas") -> object:
+        with use_engine(engine):
+            result, stats = measure(func, memory=memory)
+        rows = len(result) if isinstance(result, pd.DataFrame) else None
+        stage = stage if engine == "pandas" else f"{stage}[{engine}]"
+        results.append({"scale": scale, "stage": stage, "engine": engine, "rows_out": rows, **stats})
+        logger.info(f"[x{scale}] {stage}: {stats['wall_s']:.3f}s"
+                    + (f", peak {stats['peak_mb']:.1f} MB" if memory else ""))
+        return result
+
+    for scale in scales:
+        if {"ghed", "charts"} & set(groups):
+            with synthetic_environment(scale, seed):
+                if "ghed" in groups:
+                    for engine in engines:
+                        for stage, func in ghed_stages().items():
+                            record(scale, stage, func, engine)
+                if "charts" in groups:
+                    write_builder_outputs()
+                    for stage, func in chart_stages().items():
+                        record(scale, stage, func)
+
+        if "crs" in groups:
+            # every stage runs on the output of the previous one
+            df = record(scale, "synthetic.generate_crs", lambda: generate_crs(scale, seed))
+            for stage, func in crs_stages().items():
+                df = record(scale, stage, lambda f=func, d=df: f(d))
+
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float = DEFAULT_THRESHOLD) -> list[dict]:
+    """Return the stages that are slower or use more memory than the baseline by more than `threshold`"""
+
+    reference = {(r["scale"], r["stage"]): r for r in baseline}
+    regressions = []
+
+    for result in results:
+        base = reference.get((result["scale"], result["stage"]))
+        if base is None:
+            continue
+        for metric in ["wall_s", "peak_mb"]:
+            if metric in result and metric in base and base[metric] > 0:
+                change = result[metric] / base[metric] - 1
+                if change > threshold:
+                    regressions.append({"scale": result["scale"], "stage": result["stage"], "metric": metric,
+                                        "baseline": base[metric], "current": result[metric], "change": change})
+
+    return regressions
+
+
+def engine_report(results: list[dict]) -> list[dict]:
+    """Speedup and memory saved by each engine, relative to pandas, for every stage and scale"""
+
+    pandas = {(r["scale"], r["stage"]): r for r in results if r.get("engine", "pandas") == "pandas"}
+    report = []
+
+    for result in results:
+        if result.get("engine", "pandas") == "pandas":
+            continue
+        base = pandas.get((result["scale"], result["stage"].rsplit("[", 1)[0]))
+        if base is None:
+            continue
+
+        row = {"scale": result["scale"], "stage": base["stage"], "engine": result["engine"],
+               "speedup": base["wall_s"] / result["wall_s"]}
+        for metric in ["peak_mb", "peak_rss_mb"]:
+            if metric in result and metric in base:
+                row[f"{metric}_saved"] = base[metric] - result[metric]
+        report.append(row)
+
+    return report
+
+
+def save_results(results: list[dict], path: Path, **meta) -> None:
+    """Save benchmark results as json, with information about the environment"""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"meta": {"created": datetime.now().isoformat(timespec="seconds"),
+                                         "python": sys.version.split()[0],
+                                         "pandas": pd.__version__,
+                                         "platform": platform.platform(),
+                                         **meta},
+                                "results": results}, indent=2))
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on synthetic data")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES)
+    parser.add_argument("--groups", nargs="+", choices=["ghed", "charts", "crs"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=["pandas"],
+                        help="engines to run the ghed stages with")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure peak memory")
+    parser.add_argument("--output", type=Path, help="where to save the results")
+    parser.add_argument("--baseline", type=Path, help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative increase above which a stage is a regression")
+    args = parser.parse_args(argv)
+
+    engines = args.engines if "pandas" in args.engines else ["pandas", *args.engines]
+    results = run_suite(args.scales, seed=args.seed, groups=args.groups, memory=not args.no_memory,
+                        engines=engines)
+
+    report = engine_report(results)
+    if report:
+        logger.info(f"Engines compared to pandas:\n{pd.DataFrame(report).round(2).to_string(index=False)}")
+
+    output = args.output or RESULTS_DIR / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+    save_results(results, output, scales=args.scales, seed=args.seed, engines=engines, memory=not args.no_memory)
+    logger.info(f"Results saved to {output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            logger.error(f"[x{r['scale']}] {r['stage']} {r['metric']}: {r['baseline']:.3f} -> "
+                         f"{r['current']:.3f} (+{r['change']:.0%})")
+        if regressions:
+            return 1
+        logger.info("No regressions against the baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
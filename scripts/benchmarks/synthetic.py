@@ -0,0 +1,136 @@
+"""Seeded synthetic GHED and CRS data, with the same schemas as the real sources.
+
+Sizes are expressed as a multiple of the real data: `scale=1` is roughly the size of the
+GHED release and of the CRS years read by `read_raw_data`. GHED is scaled by adding
+indicator panels (the countries and years stay those of the real data, so groupings and
+income levels still work; the builders read a fixed set of indicators, so only reading
+and indexing the data grows with the scale), and the CRS is scaled by adding rows to
+every year.
+"""
+
+import numpy as np
+import pandas as pd
+
+from scripts.analysis.multilateral import (
+    MULTI_END_YEAR,
+    MULTI_START_YEAR,
+    MULTILATERALS,
+    all_health,
+    enforce_crs_schema,
+)
+from scripts.lazy import LazyModule
+
+coco = LazyModule("country_converter")
+
+# Approximate sizes of the real data
+GHED_YEARS: int = 24
+GHED_LAST_YEAR: int = 2023
+GHED_OTHER_INDICATORS: int = 150
+CRS_ROWS_PER_YEAR: int = 300_000
+
+# Indicators read by the builders and aggregation helpers
+GHED_INDICATORS: list[str] = [
+    "pop", "gdp_usd", "gdp_usd2022", "gge_usd2022",
+    "che_usd2022", "che_usd2022_pc", "che_gdp",
+    "gghed_gge", "gghed_usd2022", "gghed_gdp", "gghed_usd2022_pc", "gghed_che",
+    "ext_che", "ext_usd2022", "hf3_che", "hf3_usd2022",
+    "fs4_usd2022", "fs5_usd2022", "fs6_usd2022", "fsnec_usd2022", "fs61_usd2022",
+    "fs4", "fs5", "fs6", "fsnec", "fs61", "hf1", "hf2", "hf3", "hf4", "hfnec",
+    *[f"{dis}_{source}usd2022" for dis in ["dis11", "dis12", "dis13", "dis21", "dis23", "dis3", "dis4", "dis5"]
+      for source in ["", "ext_", "gghed_", "pvtd_"]],
+]
+
+INCOME_LEVELS = ["Low income", "Lower middle income", "Upper middle income", "High income"]
+
+
+def generate_ghed(scale: int = 1, seed: int = 42, missing: float = 0.1) -> pd.DataFrame:
+    """Generate long GHED data with the columns written by `download_data.download_ghed`
+
+    Args:
+        scale: the size as a multiple of the real GHED data (more indicators)
+        seed: the random seed
+        missing: the share of country-year-indicator values that are missing
+    """
+
+    rng = np.random.default_rng(seed)
+
+    countries = coco.CountryConverter().data["ISO3"].dropna().unique()
+    years = np.arange(GHED_LAST_YEAR - GHED_YEARS + 1, GHED_LAST_YEAR + 1)
+    others = (len(GHED_INDICATORS) + GHED_OTHER_INDICATORS) * scale - len(GHED_INDICATORS)
+    indicators = np.array(GHED_INDICATORS + [f"other_{i}" for i in range(others)])
+
+    continents = pd.Series(coco.convert(list(countries), src="ISO3", to="continent"), index=countries)
+    incomes = pd.Series(rng.choice(INCOME_LEVELS, len(countries)), index=countries)
+
+    n = len(countries) * len(years) * len(indicators)
+    df = pd.DataFrame({
+        "iso3_code": np.repeat(countries, len(years) * len(indicators)),
+        "year": np.tile(np.repeat(years, len(indicators)), len(countries)),
+        "indicator_code": np.tile(indicators, len(countries) * len(years)),
+        "value": rng.lognormal(mean=18, sigma=2, size=n),
+    })
+
+    return (df
+            .loc[rng.random(n) >= missing]
+            .assign(continent=lambda d: d.iso3_code.map(continents),
+                    income_level=lambda d: d.iso3_code.map(incomes))
+            .reset_index(drop=True)
+            )
+
+
+def generate_crs(scale: int = 1, seed: int = 42) -> pd.DataFrame:
+    """Generate CRS data with the columns (and types) returned by `multilateral.read_raw_data`
+
+    Args:
+        scale: the size as a multiple of the real CRS years under study (more rows per year)
+        seed: the random seed
+    """
+
+    rng = np.random.default_rng(seed)
+
+    years = np.arange(MULTI_START_YEAR, MULTI_END_YEAR + 1)
+    n = CRS_ROWS_PER_YEAR * scale * len(years)
+
+    # about a third of the rows come from multilateral development banks
+    donors = np.concatenate([np.array(list(MULTILATERALS)), np.arange(1, 100)])
+    donor_codes = np.where(rng.random(n) < 0.3,
+                           rng.choice(list(MULTILATERALS), n),
+                           rng.choice(donors, n))
+
+    recipient_codes = np.arange(1, 301)
+    region_codes = np.array([298, 798, 10001, 10002, 10003, 10004, 10005, 10006, 10007, 10008, 10009,
+                             10010, 10011, 10012, 15006])
+    recipient_regions = rng.choice(region_codes, len(recipient_codes))
+
+    purpose_codes = np.unique(np.concatenate([np.array(all_health), rng.integers(11000, 99999, 400)]))
+    sector_codes = np.unique(purpose_codes // 100)
+    flows = np.array(["ODA Grants", "ODA Loans", "Equity Investment", "Other Official Flows (non Export Credit)",
+                      "Private Development Finance"])
+
+    recipients = rng.choice(len(recipient_codes), n)
+    purposes = rng.choice(purpose_codes, n)
+
+    df = pd.DataFrame({
+        "year": rng.choice(years, n),
+        "donor_code": donor_codes,
+        "agency_code": rng.integers(1, 6, n),
+        "donor_name": pd.Categorical.from_codes(np.searchsorted(np.sort(donors), donor_codes),
+                                                categories=[f"Donor {d}" for d in np.sort(donors)]),
+        "recipient_code": recipient_codes[recipients],
+        "recipient_name": pd.Categorical.from_codes(recipients,
+                                                    categories=[f"Recipient {r}" for r in recipient_codes]),
+        "recipient_region_code": recipient_regions[recipients],
+        "recipient_region": pd.Categorical.from_codes(
+            np.searchsorted(region_codes, recipient_regions[recipients]),
+            categories=[f"Region {r}" for r in region_codes]),
+        "purpose_code": purposes,
+        "sector_code": purposes // 100,
+        "purpose_name": pd.Categorical.from_codes(np.searchsorted(purpose_codes, purposes),
+                                                  categories=[f"Purpose {p}" for p in purpose_codes]),
+        "sector_name": pd.Categorical.from_codes(np.searchsorted(sector_codes, purposes // 100),
+                                                 categories=[f"Sector {s}" for s in sector_codes]),
+        "flow_name": pd.Categorical.from_codes(rng.choice(len(flows), n), categories=flows),
+        "usd_disbursement": np.where(rng.random(n) < 0.2, np.nan, rng.lognormal(mean=-1, sigma=2, size=n)),
+    })
+
+    return df.sort_values("year", kind="stable").reset_index(drop=True).pipe(enforce_crs_schema)
@@ -2,11 +2,16 @@
 
 import pandas as pd
 import numpy as np
-import country_converter as coco
-from bblocks.dataframe_tools.add import add_income_level_column
 
+from scripts import config, writers
 from scripts.analysis.common import custom_sort, format_large_numbers
+from scripts.analysis.income_levels import add_income_level
 from scripts.config import PATHS
+from scripts.instrumentation import enable_from_env, stage
+from scripts.lazy import LazyModule
+from scripts.manifest import read_csv, track, write_csv
+
+coco = LazyModule("country_converter")
 
 
 # Section 1
@@ -16,17 +21,17 @@ def chart_1_1():
 
     """
 
-    df = pd.read_csv(PATHS.output / "total_health_expenditure.csv")
+    df = read_csv(PATHS.output / "total_health_expenditure.csv")
 
 
     # save data for download
-    df.to_csv(PATHS.output / "section_1_1_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_1_1_download.csv")
 
     # format data for chart
     (df
-     .assign(value = lambda d: np.where(d.unit == "USD constant (2022)", d.value/1e9, d.value))
-     .assign(unit = lambda d: d.unit.map({"USD constant (2022)": "Total (US$ billions)",
-                                          "per capita, USD constant (2022)": "Per capita (US$)",
+     .assign(value = lambda d: np.where(d.unit == f"USD constant ({config.CONSTANT_YEAR})", d.value/1e9, d.value))
+     .assign(unit = lambda d: d.unit.map({f"USD constant ({config.CONSTANT_YEAR})": "Total (US$ billions)",
+                                          f"per capita, USD constant ({config.CONSTANT_YEAR})": "Per capita (US$)",
                                           "percent of GDP": "Percent of GDP"}),
              unit_annotate = lambda d: d.unit.map({"Total (US$ billions)": "billion US$",
                                                    "Per capita (US$)": "US$ per capita",
@@ -36,117 +41,134 @@ def chart_1_1():
      .pivot(index=['year', 'unit', "unit_annotate"], columns='entity_name', values="value")
      .reset_index()
      .pipe(custom_sort, 'unit', ["Total (US$ billions)", "Per capita (US$)", "Percent of GDP"])
-     .to_csv(PATHS.output / "section_1_1_chart.csv", index=False)
+     .pipe(write_csv, PATHS.output / "section_1_1_chart.csv")
      )
 
 
 def chart_1_2():
     """Government health spending as a percentage of total government expenditure"""
 
-    df = (pd.read_csv(PATHS.output / "gov_expenditure.csv")
+    df = (read_csv(PATHS.output / "gov_expenditure.csv")
     .dropna(subset='value')
-    .loc[lambda d: d.unit.isin(['USD constant (2022)', 'percent of general government expenditure'])]
+    .loc[lambda d: d.unit.isin([f'USD constant ({config.CONSTANT_YEAR})', 'percent of general government expenditure'])]
           )
 
     # save data
-    df.to_csv(PATHS.output / "section_1_2_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_1_2_download.csv")
 
     #create chart
     (df
      .pivot(index = ['year', 'entity_name'], columns='unit', values='value')
-     .rename(columns = {'USD constant (2022)': "total",
+     .rename(columns = {f'USD constant ({config.CONSTANT_YEAR})': "total",
                         'percent of general government expenditure': "share_of_gov"})
      .reset_index()
      .assign(total = lambda d: format_large_numbers(d.total))
      .pivot(index=['year', 'total'], columns='entity_name', values='share_of_gov')
      .reset_index()
-     .to_csv(PATHS.output / "section_1_2_chart.csv", index=False)
+     .pipe(write_csv, PATHS.output / "section_1_2_chart.csv")
      )
 
 
-def chart_2_1():
-    """ """
+def filter_years(df: pd.DataFrame, first_year: int | None = None, last_year: int | None = None) -> pd.DataFrame:
+    """Keep the years from `first_year` to `last_year` (included)"""
 
-    df =  (pd.read_csv(PATHS.output / "gov_expenditure.csv")
-           .loc[lambda d: (d.iso3_code.notna())&(d.unit == "percent of GDP")]
-           .assign(continent = lambda d: coco.convert(d.iso3_code, src="ISO3", to="continent"))
-           .pipe(add_income_level_column, "iso3_code", "ISO3")
-           )
+    if first_year is not None:
+        df = df.loc[lambda d: d.year >= first_year]
+    if last_year is not None:
+        df = df.loc[lambda d: d.year <= last_year]
 
-    # save data
-    df.to_csv(PATHS.output / "section_2_1_download.csv", index=False)
+    return df
 
-    (df
-     .assign(continent = lambda d: np.where(d.continent == 'Africa', "Africa", "Other"))
+
+def countries_data(unit: str) -> pd.DataFrame:
+    """Government health expenditure of each country in a unit, with its continent and income level
+
+    The income level is that of each year with the historical income classification (see
+    `scripts.analysis.income_levels`).
+    """
+
+    return (read_csv(PATHS.output / "gov_expenditure.csv")
+            .loc[lambda d: (d.iso3_code.notna())&(d.unit == unit)]
+            .assign(continent = lambda d: coco.convert(d.iso3_code, src="ISO3", to="continent"))
+            .pipe(add_income_level, "iso3_code")
+            )
+
+
+def countries_chart(df: pd.DataFrame, first_year: int | None = None, last_year: int = 2022,
+                    highlight: str = "Africa") -> pd.DataFrame:
+    """Countries by income level, with the countries of a continent highlighted (charts 2.1 and 2.2)"""
+
+    return (df
+     .assign(continent = lambda d: np.where(d.continent == highlight, highlight, "Other"))
      .loc[lambda d: ~d.income_level.isin(['Not classified', np.nan])]
-     .loc[lambda d: d.year <= 2022]
+     .pipe(filter_years, first_year, last_year)
      .sort_values(by="year", ascending=False)
      .pipe(custom_sort, "income_level", ["Low income", "Lower middle income", "Upper middle income", "High income"])
 
      .reset_index(drop=True)
-     .assign(colour = lambda d: np.where(d.continent == "Africa", "Africa", None))
-
-     .to_csv(PATHS.output / "section_2_1_chart.csv", index=False)
+     .assign(colour = lambda d: np.where(d.continent == highlight, highlight, None))
      )
 
+
+def chart_2_1():
+    """ """
+
+    df = countries_data("percent of GDP")
+
+    # save data
+    write_csv(df, PATHS.output / "section_2_1_download.csv")
+
+    countries_chart(df).pipe(write_csv, PATHS.output / "section_2_1_chart.csv")
+
+
 def chart_2_2():
     """ """
 
-    df =  (pd.read_csv(PATHS.output / "gov_expenditure.csv")
-           .loc[lambda d: (d.iso3_code.notna())&(d.unit == "per capita, USD constant (2022)")]
-           .assign(continent = lambda d: coco.convert(d.iso3_code, src="ISO3", to="continent"))
-           .pipe(add_income_level_column, "iso3_code", "ISO3")
-           )
+    df = countries_data(f"per capita, USD constant ({config.CONSTANT_YEAR})")
 
     # save data
-    df.to_csv(PATHS.output / "section_2_2_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_2_2_download.csv")
 
+    countries_chart(df).pipe(write_csv, PATHS.output / "section_2_2_chart.csv")
 
-    (df
-     .assign(continent = lambda d: np.where(d.continent == 'Africa', "Africa", "Other"))
-     .loc[lambda d: ~d.income_level.isin(['Not classified', np.nan])]
-     .loc[lambda d: d.year <= 2022]
-     .sort_values(by="year", ascending=False)
-     .pipe(custom_sort, "income_level", ["Low income", "Lower middle income", "Upper middle income", "High income"])
 
-     .reset_index(drop=True)
-     .assign(colour = lambda d: np.where(d.continent == "Africa", "Africa", None))
+def abuja_chart(df: pd.DataFrame, continent: str = "Africa", target: float = 15, first_year: int | None = None,
+                last_year: int = 2022) -> pd.DataFrame:
+    """Whether the countries of a continent reach a target share of government expenditure (chart 2.3)
 
-     .to_csv(PATHS.output / "section_2_2_chart.csv", index=False)
+    The Abuja declaration target is 15% of government expenditure, for African countries.
+    """
 
+    return (df.loc[lambda d: d.continent == continent]
+     .pipe(filter_years, first_year, last_year)
+     .sort_values(by="year", ascending=False)
+     .pipe(custom_sort, "income_level", ["Low income", "Lower middle income", "Upper middle income", "High income"])
+     .reset_index(drop=True)
+     .assign(target = lambda d: np.where(d.value >= target, "target reached", "target not reached"))
+     .loc[:, ["iso3_code",	"target",	'year',	'value',	'unit',	'entity_name',	'continent',	'income_level']]
      )
 
 
 def chart_2_3():
     """Abuja"""
 
-    df = (pd.read_csv(PATHS.output / "gov_expenditure.csv")
-          .loc[lambda d: (d.iso3_code.notna())&(d.unit == "percent of general government expenditure")]
-          .assign(continent = lambda d: coco.convert(d.iso3_code, src="ISO3", to="continent"))
+    df = (countries_data("percent of general government expenditure")
           .loc[lambda d: d.continent == "Africa"]
-          .pipe(add_income_level_column, "iso3_code", "ISO3")
           )
 
     # save data
-    df.to_csv(PATHS.output / "section_2_3_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_2_3_download.csv")
 
     # create chart
-    (df.loc[lambda d: d.year <= 2022]
-     .sort_values(by="year", ascending=False)
-     .pipe(custom_sort, "income_level", ["Low income", "Lower middle income", "Upper middle income", "High income"])
-     .reset_index(drop=True)
-     .assign(target = lambda d: np.where(d.value >= 15, "target reached", "target not reached"))
-     .loc[:, ["iso3_code",	"target",	'year',	'value',	'unit',	'entity_name',	'continent',	'income_level']]
-     .to_csv(PATHS.output / "section_2_3_chart.csv", index=False)
-     )
+    abuja_chart(df).pipe(write_csv, PATHS.output / "section_2_3_chart.csv")
 
 def chart_3_1():
     """ """
 
-    df = (pd.read_csv(PATHS.output / "expenditure_by_source.csv"))
+    df = (read_csv(PATHS.output / "expenditure_by_source.csv"))
 
     # save data
-    df.to_csv(PATHS.output / "section_3_1_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_3_1_download.csv")
 
     # create chart
     (df
@@ -154,25 +176,25 @@ def chart_3_1():
      .assign(value = lambda d: format_large_numbers(d.value))
      .pivot(index=['year', 'entity_name', "source"], columns="unit", values='value')
      .reset_index()
-     .pivot(index=['year', 'entity_name', "constant USD (2022)"], columns='source', values="percent of health expenditure")
+     .pivot(index=['year', 'entity_name', f"constant USD ({config.CONSTANT_YEAR})"], columns='source', values="percent of health expenditure")
      .reset_index()
 
      .pipe(custom_sort, "entity_name", ["Africa (Low and lower middle income)", "Africa", "Low income", "Lower middle income", "Upper middle income", "High income"])
      .reset_index(drop=True)
-     .to_csv(PATHS.output / "section_3_1_chart.csv", index=False)
+     .pipe(write_csv, PATHS.output / "section_3_1_chart.csv")
      )
 
 
 def chart_4_1():
     """ """
 
-    df = (pd.read_csv(PATHS.output / "expenditure_by_condition.csv")
+    df = (read_csv(PATHS.output / "expenditure_by_condition.csv")
           .loc[lambda d: d.source=="total"]
           .dropna(subset='value')
           )
 
     # save data
-    df.to_csv(PATHS.output / "section_4_1_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_4_1_download.csv")
 
     # create chart
     (df
@@ -180,7 +202,7 @@ def chart_4_1():
      .pivot(index=['year', 'entity_name', 'value_annotation'], columns="condition", values='value')
      .reset_index()
      .sort_values(by='entity_name')
-     .to_csv(PATHS.output / "section_4_1_chart.csv", index=False)
+     .pipe(write_csv, PATHS.output / "section_4_1_chart.csv")
      )
 
 
@@ -188,7 +210,7 @@ def chart_4_1():
 def chart_4_2():
     """ """
 
-    df = (pd.read_csv(PATHS.output / "expenditure_by_condition.csv")
+    df = (read_csv(PATHS.output / "expenditure_by_condition.csv")
     .dropna(subset="value")
     .loc[lambda d: d.source!="total"]
     .loc[lambda d: d.year == d.groupby("entity_name").year.transform("max")]
@@ -196,72 +218,79 @@ def chart_4_2():
     )
 
     # save data
-    df.to_csv(PATHS.output / "section_4_2_download.csv", index=False)
+    write_csv(df, PATHS.output / "section_4_2_download.csv")
 
     # create chart
     (df
      .assign(value_annotation = lambda d: format_large_numbers(d.value, other_dec=0))
      .sort_values(by="entity_name")
-     .to_csv(PATHS.output / "section_4_2_chart.csv", index=False)
+     .pipe(write_csv, PATHS.output / "section_4_2_chart.csv")
      )
 
 
 
 
 
-def chart_into_2():
-    """ """
+def income_shares_chart(df: pd.DataFrame, year: int = 2022) -> pd.DataFrame:
+    """The share of each income group in total health expenditure in a year"""
 
-    df = pd.read_csv(PATHS.output / "total_health_expenditure.csv")
-
-    (df
-     .loc[lambda d: (d.year == 2022)
+    return (df
+     .loc[lambda d: (d.year == year)
                     & (d.entity_name.isin(['Low income', "Lower middle income", "Upper middle income", "High income"]))
-                    & (d.unit == "USD constant (2022)")
+                    & (d.unit == f"USD constant ({config.CONSTANT_YEAR})")
      ]
      .assign(share = lambda d: d.value/d.value.sum()*100)
-     .to_csv(PATHS.output / "section_into_2_chart.csv", index=False)
      )
 
 
-
-def chart_intro_3():
+def chart_into_2():
     """ """
 
+    df = read_csv(PATHS.output / "total_health_expenditure.csv")
 
-    (pd.read_csv(PATHS.output / "total_health_expenditure.csv")
-     .loc[lambda d:(d.entity_name == "Africa")
-                   & (d.unit == "USD constant (2022)")
-     ]
-    .assign(value_annotation = lambda d: format_large_numbers(d.value))
-     .to_csv(PATHS.output / "section_intro_3_chart.csv", index=False)
-     )
-
-
-
-if __name__ == "__main__":
-
-    chart_1_1()
-    chart_1_2()
-
-    chart_2_1()
-    chart_2_2()
-    chart_2_3()
-
-    chart_3_1()
+    income_shares_chart(df).pipe(write_csv, PATHS.output / "section_into_2_chart.csv")
 
-    chart_4_1()
-    chart_4_2()
 
-    chart_into_2()
-    chart_intro_3()
+def entity_total_chart(df: pd.DataFrame, entity: str = "Africa") -> pd.DataFrame:
+    """Total health expenditure of a country or group"""
 
+    return (df
+     .loc[lambda d:(d.entity_name == entity)
+                   & (d.unit == f"USD constant ({config.CONSTANT_YEAR})")
+     ]
+    .assign(value_annotation = lambda d: format_large_numbers(d.value))
+     )
 
 
+def chart_intro_3():
+    """ """
 
+    (read_csv(PATHS.output / "total_health_expenditure.csv")
+     .pipe(entity_total_chart)
+     .pipe(write_csv, PATHS.output / "section_intro_3_chart.csv")
+     )
 
 
+# The builder output read by each chart
+CHART_SOURCES = {
+    chart_1_1: "total_health_expenditure.csv",
+    chart_1_2: "gov_expenditure.csv",
+    chart_2_1: "gov_expenditure.csv",
+    chart_2_2: "gov_expenditure.csv",
+    chart_2_3: "gov_expenditure.csv",
+    chart_3_1: "expenditure_by_source.csv",
+    chart_4_1: "expenditure_by_condition.csv",
+    chart_4_2: "expenditure_by_condition.csv",
+    chart_into_2: "total_health_expenditure.csv",
+    chart_intro_3: "total_health_expenditure.csv",
+}
 
 
+if __name__ == "__main__":
+    enable_from_env()
 
+    for chart, source in CHART_SOURCES.items():
+        with stage(f"charts.{chart.__name__}"), track(f"charts.{chart.__name__}", [PATHS.output / source]):
+            chart()
 
+    writers.flush()
@@ -1,19 +1,34 @@
 """Clean and analyse CRS data for multilateral (MDB) donors."""
+import argparse
+from contextlib import nullcontext
+
 import pandas as pd
 
+from scripts import config, profiling, writers
+from scripts.analysis.checkpoint import checkpoint_key, file_hash, load_or_build
 from scripts.analysis.multilateral import (
-    add_broad_sectors_column,
+    MULTI_END_YEAR,
+    MULTI_START_YEAR,
+    MULTI_WORKERS,
+    MULTILATERALS,
     add_income_levels,
     add_region_groups,
-    add_sectors_column,
-    filter_mdb_data,
-    filter_multi_donors,
-    read_raw_data,
-    summarise_by_donor_recipient_year_flow_sector,
+    crs_files,
+    enforce_crs_schema,
+    init_paths,
+    map_categorical,
+    pydeflate_signature,
+    summarise_crs_parallel,
+    health_broad_group,
+    health_group,
     to_constant_dac,
     rename_ambiguous_recipients,
 )
+from scripts.analysis.rebase import dac_deflators, rebase, rebased_path
+from scripts.analysis.reduction import pivot, sum_by
 from scripts.config import PATHS
+from scripts.instrumentation import enable_from_env, stage
+from scripts.manifest import track, write_csv
 
 
 def rename_regions(df: pd.DataFrame) -> pd.DataFrame:
@@ -31,7 +46,9 @@ def rename_regions(df: pd.DataFrame) -> pd.DataFrame:
         "Regional and Unspecified": "Other, unspecified",
     }
 
-    return df.assign(recipient_region=lambda d: d.recipient_region.map(regions))
+    return df.assign(
+        recipient_region=lambda d: map_categorical(d.recipient_region, regions, keep_unmapped=False)
+    )
 
 
 def filter_health_broad(df: pd.DataFrame) -> pd.DataFrame:
@@ -46,14 +63,10 @@ def summarise_health_disbursements(df: pd.DataFrame) -> pd.DataFrame:
         "recipient_region",
         "recipient_name",
         "donor_name",
+        "donor_code",
     ]
 
-    return df.groupby(
-        group_by,
-        as_index=False,
-        observed=True,
-        dropna=False,
-    )["usd_disbursement"].sum()
+    return sum_by(df, group_by, "usd_disbursement")
 
 
 def filter_columns(df: pd.DataFrame) -> pd.DataFrame:
@@ -65,6 +78,7 @@ def filter_columns(df: pd.DataFrame) -> pd.DataFrame:
             "recipient_region",
             "recipient_name",
             "donor_name",
+            "donor_code",
             "usd_disbursement",
         ],
         axis=1,
@@ -73,19 +87,16 @@ def filter_columns(df: pd.DataFrame) -> pd.DataFrame:
 
 def create_health_total(df: pd.DataFrame) -> pd.DataFrame:
     group_by = ["year", "broad_sector", "flow_name", "recipient_region", "recipient_name"]
-    return (
-        df.groupby(group_by, as_index=False)["usd_disbursement"]
-        .sum()
-        .assign(donor_name="Total")
-    )
+    return sum_by(df, group_by, "usd_disbursement", dropna=True).assign(donor_name="Total")
 
 
 def pivot_chart_data(df: pd.DataFrame) -> pd.DataFrame:
-    return df.pivot(
+    return pivot(
+        df,
         index=["year", "broad_sector", "flow_name", "recipient_region", "recipient_name"],
         columns="donor_name",
         values="usd_disbursement",
-    ).reset_index()
+    )
 
 
 def reorder_columns(df: pd.DataFrame) -> pd.DataFrame:
@@ -113,20 +124,42 @@ def clean_columns(df: pd.DataFrame) -> pd.DataFrame:
     )
 
 
-def chart_4_1() -> None:
-    """Pipeline for chart 4.1"""
+def health_checkpoint_key() -> str:
+    """Key for the MDB health checkpoint: CRS file hashes, donors, sector groups, years, and
+    the DAC deflators and income levels the data is deflated and classified with"""
+
+    income_levels = PATHS.raw_data / "income_levels.csv"
+
+    return checkpoint_key(
+        crs={year: [file_hash(p) for p in files] for year, files in crs_files().items()},
+        pydeflate=pydeflate_signature(),
+        income_levels=file_hash(income_levels) if income_levels.exists() else None,
+        multilaterals=MULTILATERALS,
+        health_group=health_group,
+        health_broad_group=health_broad_group,
+        years=[MULTI_START_YEAR, MULTI_END_YEAR],
+        constant_year=config.CONSTANT_YEAR,
+    )
+
+
+def build_health_disbursements(*, checkpoints: bool = True, workers: int = MULTI_WORKERS) -> pd.DataFrame:
+    """Read the CRS and summarise health disbursements by multilaterals (MDBs)
+
+    Args:
+        checkpoints: load the CRS summary of each year from its checkpoint when valid
+        workers: the number of processes summarising the CRS years. 1 runs them in this process
+    """
 
-    # read the raw crs data. Years are controlled from the config file
-    data = read_raw_data()
+    init_paths()
+
+    # read, filter and summarise the raw crs data by year, in parallel.
+    # Years are controlled from the multilateral module
+    data = summarise_crs_parallel(workers=workers, checkpoints=checkpoints)
 
     # Create a 'health' dataframe for multilaterals (MDBs)
-    health = (
-        data.pipe(filter_multi_donors)
-        .pipe(filter_mdb_data)
-        .pipe(add_sectors_column)
-        .pipe(add_broad_sectors_column)
-        .pipe(summarise_by_donor_recipient_year_flow_sector)
-        .pipe(to_constant_dac)
+    return (
+        data.pipe(to_constant_dac)
+        .pipe(enforce_crs_schema)
         .pipe(rename_ambiguous_recipients)
         .pipe(add_income_levels)
         .pipe(add_region_groups)
@@ -136,6 +169,43 @@ def chart_4_1() -> None:
         .pipe(filter_columns)
     )
 
+
+def health_disbursements(refresh: bool = False, *, checkpoints: bool = True,
+                         workers: int = MULTI_WORKERS) -> pd.DataFrame:
+    """MDB health disbursements, loaded from a checkpoint when the inputs have not changed
+
+    Args:
+        refresh: rebuild the checkpoint even if a valid one exists
+        checkpoints: use the checkpoints (of the health data and of each CRS year). If
+            False, every CRS year is read and summarised again, and nothing is saved
+        workers: the number of processes summarising the CRS years
+    """
+
+    if not checkpoints:
+        return build_health_disbursements(checkpoints=False, workers=workers)
+
+    return load_or_build(
+        "mdb_health", health_checkpoint_key(), lambda: build_health_disbursements(workers=workers), refresh=refresh
+    )
+
+
+def chart_4_1_chart(health: pd.DataFrame, from_year: int = 2016, base_year: int | None = None,
+                    region: str | None = None) -> pd.DataFrame:
+    """The data of chart 4.1, from the MDB health disbursements
+
+    Args:
+        health: the MDB health disbursements (see `health_disbursements`)
+        from_year: the first year of the chart
+        base_year: rebase the data from `config.CONSTANT_YEAR` to this year
+        region: keep the disbursements to this recipient region only
+    """
+
+    if base_year is not None and base_year != config.CONSTANT_YEAR:
+        health = rebase(health, dac_deflators(base_year), key="donor_code", value="usd_disbursement")
+
+    if region is not None:
+        health = health.loc[lambda d: d.recipient_region == region]
+
     # Create a 'total' summary of the data. This produces a 'Total' for all mdbs
     health_total = health.pipe(create_health_total)
 
@@ -146,16 +216,58 @@ def chart_4_1() -> None:
     chart_data = chart_data.pipe(pivot_chart_data)
 
     # Create the chart dataframe (reorder, clean, filter, sort)
-    chart = (
+    return (
         chart_data.pipe(reorder_columns)
         .pipe(clean_numbers)
-        .pipe(filter_from_year, 2016)
+        .pipe(filter_from_year, from_year)
         .sort_values(["year"], ascending=False)
         .pipe(clean_columns)
     )
 
-    chart.to_csv(PATHS.output / "section4_chart_1.csv", index=False)
+
+def chart_4_1(refresh: bool = False, base_year: int | None = None, *, checkpoints: bool = True,
+              workers: int = MULTI_WORKERS) -> None:
+    """Pipeline for chart 4.1
+
+    Args:
+        refresh: rebuild the MDB health checkpoint
+        base_year: rebase the data from `config.CONSTANT_YEAR` to this year, and write the
+            chart as section4_chart_1_<base_year>.csv
+        checkpoints, workers: see `health_disbursements`
+    """
+
+    # MDB health disbursements (checkpointed)
+    health = health_disbursements(refresh=refresh, checkpoints=checkpoints, workers=workers)
+
+    path = PATHS.output / "section4_chart_1.csv"
+    if base_year is not None and base_year != config.CONSTANT_YEAR:
+        path = rebased_path(path, base_year)
+
+    write_csv(chart_4_1_chart(health, base_year=base_year), path)
 
 
 if __name__ == "__main__":
-    chart_4_1()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the data of chart 4.1 (MDB health disbursements)")
+    parser.add_argument("--refresh", action="store_true", help="rebuild the MDB health checkpoint")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    files = crs_files(required=False)
+    missing = [year for year, paths in files.items() if not paths]
+    if missing:
+        parser.exit(1, f"No CRS data for {', '.join(map(str, missing))}. "
+                       "Download it with `python -m scripts.refresh crs`\n")
+
+    enable_from_env()
+    crs = [path for paths in files.values() for path in paths]
+    profiled = (profiling.profile("multilat_chart", ("multilateral.", "multilat_chart."), args.flamegraph)
+                if args.profile else nullcontext())
+
+    with profiled, stage("multilat_chart.chart_4_1"), track("multilat_chart.chart_4_1", crs):
+        if args.profile:
+            # every CRS stage runs in this process, where it is profiled, without checkpoints
+            chart_4_1(checkpoints=False, workers=1)
+        else:
+            chart_4_1(refresh=args.refresh)
+
+    writers.flush()
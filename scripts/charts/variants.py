@@ -0,0 +1,189 @@
+"""Chart variants: many parameter sets of a chart from one pass over its data.
+
+The base frame of a chart (its builder output, read and prepared, e.g. with continents and
+income levels) is built once, and each variant (year window, region, threshold, base
+year...) is computed from it in memory. Variants are queued to the background writers
+(see scripts/writers.py), so they are written in parallel, to `PATHS.output / "variants"`
+with the chart name and the parameters in their file name. Every variant written is listed
+in `index.json` there.
+
+Usage:
+    python -m scripts.charts.variants                 # the default sweep of every chart
+    python -m scripts.charts.variants chart_2_3 --param target=10,15,20 --param last_year=2020,2022
+    python -m scripts.charts.variants --param last_year=2021,2022    # the charts with a last_year
+"""
+
+import argparse
+import inspect
+import itertools
+import json
+import re
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import config, instrumentation, writers
+from scripts.analysis.common import RELEVANT_GROUPS
+from scripts.charts import charts, multilat_chart
+from scripts.config import PATHS
+from scripts.logger import logger
+from scripts.manifest import read_csv, track, write_csv
+
+
+def variants_folder() -> Path:
+    return PATHS.output / "variants"
+
+
+@dataclass(frozen=True)
+class ChartVariants:
+    """A chart whose variants can be generated
+
+    Attributes:
+        base: loads and prepares the data shared by the variants
+        chart: computes a variant from the base frame and keyword parameters
+        name: the name of the chart output, the prefix of the variant file names
+        sweep: the values of each parameter swept by default
+    """
+
+    base: Callable[[], pd.DataFrame]
+    chart: Callable[..., pd.DataFrame]
+    name: str
+    sweep: dict[str, list] = field(default_factory=dict)
+
+
+def _total_health_expenditure() -> pd.DataFrame:
+    return read_csv(PATHS.output / "total_health_expenditure.csv")
+
+
+CHARTS: dict[str, ChartVariants] = {
+    "chart_2_1": ChartVariants(lambda: charts.countries_data("percent of GDP"), charts.countries_chart,
+                               "section_2_1_chart",
+                               {"last_year": [2020, 2021, 2022], "highlight": ["Africa", "Asia"]}),
+    "chart_2_2": ChartVariants(lambda: charts.countries_data(f"per capita, USD constant ({config.CONSTANT_YEAR})"),
+                               charts.countries_chart, "section_2_2_chart",
+                               {"last_year": [2020, 2021, 2022], "highlight": ["Africa", "Asia"]}),
+    "chart_2_3": ChartVariants(lambda: charts.countries_data("percent of general government expenditure"),
+                               charts.abuja_chart, "section_2_3_chart",
+                               {"target": [10, 15, 20], "last_year": [2021, 2022]}),
+    "chart_into_2": ChartVariants(_total_health_expenditure, charts.income_shares_chart, "section_into_2_chart",
+                                  {"year": [2019, 2020, 2021, 2022]}),
+    "chart_intro_3": ChartVariants(_total_health_expenditure, charts.entity_total_chart, "section_intro_3_chart",
+                                   {"entity": RELEVANT_GROUPS}),
+    "multilat_chart_4_1": ChartVariants(multilat_chart.health_disbursements, multilat_chart.chart_4_1_chart,
+                                        "section4_chart_1",
+                                        {"from_year": [2010, 2016], "region": [None, "Africa", "Asia"],
+                                         "base_year": [None, *config.BASE_YEARS]}),
+}
+
+
+def variant_path(name: str, params: dict) -> Path:
+    """The path of a variant, e.g. variants/section_2_3_chart__target-10_last_year-2022.csv"""
+
+    slug = re.sub(r"[^\w.-]+", "-", "_".join(f"{key}-{value}" for key, value in params.items()))
+    return variants_folder() / f"{name}__{slug}.csv"
+
+
+def parse_value(value: str):
+    """A parameter value from the command line: an int, a float, None or a string"""
+
+    if value.lower() == "none":
+        return None
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parameters(chart: ChartVariants) -> set[str]:
+    """The names of the parameters of a chart"""
+
+    return set(inspect.signature(chart.chart).parameters)
+
+
+def generate(names: list[str] | None = None, params: dict[str, list] | None = None) -> list[dict]:
+    """Generate the variants of charts, and add them to the index
+
+    Args:
+        names: the charts (keys of `CHARTS`). Defaults to all, or with `params` to the
+            charts taking any of them, each with the parameters it takes
+        params: parameter values replacing those of the default sweeps
+
+    Returns:
+        the index entries of the variants written
+    """
+
+    params = params or {}
+    entries = []
+
+    if params and not names:
+        names = [name for name, chart in CHARTS.items() if set(params) & parameters(chart)]
+        unused = set(params) - set().union(*(parameters(CHARTS[name]) for name in names))
+        if unused:
+            raise ValueError(f"No chart has the parameter {', '.join(sorted(unused))}")
+        params_of = {name: {key: values for key, values in params.items() if key in parameters(CHARTS[name])}
+                     for name in names}
+    else:
+        params_of = {name: params for name in names or CHARTS}
+
+    for name in names or CHARTS:
+        if name not in CHARTS:
+            raise ValueError(f"Unknown chart {name!r}. Charts: {', '.join(CHARTS)}")
+        chart = CHARTS[name]
+        sweep = {**chart.sweep, **params_of[name]}
+
+        unknown = set(sweep) - parameters(chart)
+        if unknown:
+            raise ValueError(f"{name} has no parameter {', '.join(sorted(unknown))}")
+
+        variants = [dict(zip(sweep, values)) for values in itertools.product(*sweep.values())]
+
+        with track(f"variants.{name}"):
+            base = chart.base()
+            for variant in variants:
+                df = chart.chart(base, **variant)
+                path = variant_path(chart.name, variant)
+                write_csv(df, path)
+                entries.append({"chart": name, "params": variant,
+                                "path": str(path.relative_to(PATHS.output)), "rows": len(df)})
+
+        logger.info(f"Queued {len(variants)} variants of {name}")
+
+    writers.flush()
+
+    index_path = variants_folder() / "index.json"
+    index = {e["path"]: e for e in json.loads(index_path.read_text())} if index_path.exists() else {}
+    index.update({e["path"]: e for e in entries})
+    writers.atomic_write(index_path, lambda p: p.write_text(json.dumps(list(index.values()), indent=2)),
+                         deduplicate=False)
+
+    return entries
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate variants of the charts from one pass over their data")
+    parser.add_argument("charts", nargs="*", metavar="CHART", help=f"charts ({', '.join(CHARTS)}). Defaults to all")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2",
+                        help="values of a parameter, replacing the default sweep")
+    parser.add_argument("--jobs", type=int, default=config.WRITE_WORKERS, help="number of threads writing variants")
+    args = parser.parse_args(argv)
+
+    params = {}
+    for param in args.param:
+        key, _, values = param.partition("=")
+        params[key] = [parse_value(v) for v in values.split(",")]
+
+    instrumentation.enable_from_env()
+    config.WRITE_WORKERS = args.jobs
+    entries = generate(args.charts, params)
+    logger.info(f"Wrote {len(entries)} variants to {variants_folder()}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
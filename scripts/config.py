@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -7,10 +8,38 @@ class PATHS:
     project = Path(__file__).resolve().parent.parent
     raw_data = project / "raw_data"
     pydeflate_data = raw_data / ".pydeflate_data"
+    checkpoints = raw_data / ".checkpoints"
+    mirror = raw_data / ".mirror"
     output = project / "output"
     scripts = project / "scripts"
     db_credentials = scripts / "config.ini"
     logs = scripts / ".logs"
 
 
-CONSTANT_YEAR = 2022
\ No newline at end of file
+CONSTANT_YEAR = 2022
+
+# Other base years the constant USD outputs are rebased to, e.g. "2023,2024"
+# (see scripts/analysis/rebase.py). Set with HF_BASE_YEARS or the --base-years option of scripts.pipeline
+BASE_YEARS = [int(year) for year in os.environ.get("HF_BASE_YEARS", "").split(",") if year]
+
+# Engine running the GHED aggregations and builders: "pandas", "duckdb", "polars" or "cube"
+# (see scripts/analysis/engines.py).
+# Set with the HF_ENGINE environment variable or the --engine option of scripts.pipeline
+ENGINE = os.environ.get("HF_ENGINE", "pandas")
+
+# Income classification of the income groups: "current" (today's classification for every
+# year) or "historical" (the classification of each year, see scripts/analysis/income_levels.py).
+# Set with HF_INCOME_CLASSIFICATION or the --income-classification option of scripts.pipeline
+INCOME_CLASSIFICATION = os.environ.get("HF_INCOME_CLASSIFICATION", "current")
+
+# Formats the outputs are written in ("csv", "parquet", "feather"), and whether identical
+# outputs are stored once, as links to a .store folder (opt-in with HF_DEDUPLICATE_OUTPUTS=1,
+# see scripts/writers.py)
+OUTPUT_FORMATS = os.environ.get("HF_OUTPUT_FORMATS", "csv").split(",")
+DEDUPLICATE_OUTPUTS = os.environ.get("HF_DEDUPLICATE_OUTPUTS", "0") != "0"
+
+# Outputs are written by background threads (see scripts/writers.py): the number of threads
+# (0 writes synchronously), and the memory (MB) of the frames waiting to be written above
+# which computation waits. Set with HF_WRITE_WORKERS and HF_WRITE_QUEUE_MB
+WRITE_WORKERS = int(os.environ.get("HF_WRITE_WORKERS", "2"))
+WRITE_QUEUE_MB = float(os.environ.get("HF_WRITE_QUEUE_MB", "512"))
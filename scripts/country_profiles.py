@@ -0,0 +1,180 @@
+"""Country profiles: one file per country with all its health financing data.
+
+A profile combines, for one country, the total and government health expenditure, the
+expenditure by source and by condition (the outputs of `scripts.analysis.create_data`),
+and the MDB health disbursements it received in every year from `MULTI_START_YEAR` (the
+health disbursements of `scripts.charts.multilat_chart`, from their checkpoint, in the
+layout of chart 4.1, which itself starts in 2016), in one long table.
+
+The datasets are read once and stacked on the iso3 code (MDB recipients are matched to
+their iso3 code by name), sorted by country once, and split in a single pass: each
+country is a slice of the sorted table, queued to the background writers (see
+scripts/writers.py), so the files are written in parallel while the memory of the slices
+waiting to be written stays bounded by `config.WRITE_QUEUE_MB`.
+
+Usage:
+    python -m scripts.country_profiles                  # every country
+    python -m scripts.country_profiles KEN NGA --jobs 8
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scripts import config, instrumentation, writers
+from scripts.analysis.multilateral import MULTI_START_YEAR, crs_files
+from scripts.charts.multilat_chart import chart_4_1_chart, health_disbursements
+from scripts.config import PATHS
+from scripts.lazy import LazyModule
+from scripts.logger import logger
+from scripts.manifest import read_csv, track, write_csv
+
+coco = LazyModule("country_converter")
+
+# The builder outputs in a profile, by the name of their dataset
+DATASETS = {
+    "total": "total_health_expenditure.csv",
+    "government": "gov_expenditure.csv",
+    "source": "expenditure_by_source.csv",
+    "condition": "expenditure_by_condition.csv",
+}
+
+# The dataset name of the MDB health disbursements
+MDB_DATASET = "mdb_disbursements"
+
+PROFILE_COLUMNS = ["iso3_code", "entity_name", "dataset", "year", "unit", "source", "condition", "flow", "value"]
+
+
+def profiles_folder() -> Path:
+    return PATHS.output / "profiles"
+
+
+def builder_data() -> pd.DataFrame:
+    """The builder outputs, stacked, with the name of their dataset"""
+
+    return pd.concat(
+        [read_csv(PATHS.output / file_name).assign(dataset=dataset) for dataset, file_name in DATASETS.items()],
+        ignore_index=True,
+    )
+
+
+def recipient_iso3(names: pd.Series) -> pd.Series:
+    """The iso3 code of CRS recipient names (NaN for regions and unmatched names)
+
+    Each distinct name is converted once.
+    """
+
+    unique = names.dropna().unique()
+    codes = coco.convert(list(unique), src="regex", to="ISO3", not_found="not found")
+    codes = codes if isinstance(codes, list) else [codes]
+
+    return names.map({name: code for name, code in zip(unique, codes) if code != "not found"})
+
+
+def mdb_data() -> pd.DataFrame | None:
+    """The MDB health disbursements from `MULTI_START_YEAR`, long (one row per donor, "Total" for all MDBs)
+
+    None if the CRS has not been downloaded.
+    """
+
+    try:
+        df = chart_4_1_chart(health_disbursements(), from_year=MULTI_START_YEAR)
+    except FileNotFoundError as error:
+        logger.warning(f"{error}: profiles have no MDB disbursements")
+        return None
+
+    return (
+        df.drop(columns=["Region"])
+        .melt(id_vars=["Year", "Type", "Recipient"], var_name="source", value_name="value")
+        .dropna(subset="value")
+        .rename(columns={"Year": "year", "Type": "flow", "Recipient": "entity_name"})
+        .assign(iso3_code=lambda d: recipient_iso3(d.entity_name),
+                unit=f"USD million, constant ({config.CONSTANT_YEAR})",
+                dataset=MDB_DATASET)
+    )
+
+
+def profile_data(countries: list[str] | None = None) -> pd.DataFrame:
+    """All the datasets, stacked on the iso3 code and sorted by country
+
+    Rows without an iso3 code (groups, regional recipients) are dropped. Entity names are
+    those of the GHED, where the country is in it.
+
+    Args:
+        countries: iso3 codes of the countries to keep. Defaults to all
+    """
+
+    builders = builder_data()
+    names = builders.dropna(subset="iso3_code").drop_duplicates("iso3_code").set_index("iso3_code").entity_name
+
+    df = (
+        pd.concat([builders, mdb_data()], ignore_index=True)
+        .reindex(columns=PROFILE_COLUMNS)
+        .dropna(subset="iso3_code")
+        .assign(entity_name=lambda d: d.iso3_code.map(names).fillna(d.entity_name))
+    )
+
+    if countries:
+        df = df.loc[lambda d: d.iso3_code.isin(countries)]
+
+    order = ["iso3_code", "dataset", "unit", "source", "condition", "flow", "year"]
+    return df.sort_values(order, kind="stable", na_position="first").reset_index(drop=True)
+
+
+def split(df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """The rows of each country, as slices of data sorted by country"""
+
+    codes = df.iso3_code.to_numpy()
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops = np.r_[starts[1:], len(df)]
+
+    return {codes[start]: df.iloc[start:stop] for start, stop in zip(starts, stops)}
+
+
+def export(countries: list[str] | None = None) -> dict[str, Path]:
+    """Write the profile of each country to profiles/<iso3>.csv
+
+    Args:
+        countries: iso3 codes of the countries to export. Defaults to all
+
+    Returns:
+        the path of each profile, by iso3 code
+    """
+
+    paths = {}
+
+    crs = [path for files in crs_files(required=False).values() for path in files]
+
+    with track("country_profiles.export", [*(PATHS.output / f for f in DATASETS.values()), *crs]):
+        for iso3, profile in split(profile_data(countries)).items():
+            paths[iso3] = profiles_folder() / f"{iso3}.csv"
+            write_csv(profile, paths[iso3])
+
+    writers.flush()
+
+    missing = set(countries or []) - set(paths)
+    if missing:
+        logger.warning(f"No data for {', '.join(sorted(missing))}")
+
+    return paths
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Write one file per country with all its health financing data")
+    parser.add_argument("countries", nargs="*", metavar="ISO3", help="countries to export. Defaults to all")
+    parser.add_argument("--jobs", type=int, default=config.WRITE_WORKERS, help="number of threads writing profiles")
+    args = parser.parse_args(argv)
+
+    instrumentation.enable_from_env()
+    config.WRITE_WORKERS = args.jobs
+    paths = export([c.upper() for c in args.countries] or None)
+    logger.info(f"Wrote {len(paths)} country profiles to {profiles_folder()}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""Opt-in timing and memory instrumentation for the .pipe pipelines.
+
+When enabled, every `DataFrame.pipe` call is recorded as a stage with its wall time, rows
+in and out, frame memory before and after, and the peak memory allocated while it ran
+(measured with tracemalloc, nested stages included). Each record is logged as json
+through `scripts.logger` and a summary report is written when the process exits.
+
+Instrumentation is enabled by the entry points when the HF_INSTRUMENT environment
+variable is set (see `enable_from_env`), or by calling `enable()`. Importing the scripts
+does not change pandas: when instrumentation is disabled, `DataFrame.pipe` is the original
+pandas method, so there is no overhead at all.
+
+Stages nest within their thread. tracemalloc measures the whole process, so the peak of a
+stage that overlapped a stage of another thread (e.g. `pipeline --jobs 4`) includes the
+allocations of both, and its record has `peak_shared` set.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from scripts.config import PATHS
+from scripts.logger import logger
+
+_original_pipe = pd.DataFrame.pipe
+_records: list[dict] = []
+_listeners: list = []
+
+# the open stages of each thread, and of all threads (to detect overlapping stages)
+_local = threading.local()
+_open: set["Stage"] = set()
+_lock = threading.Lock()
+
+
+def _stack() -> list["Stage"]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _stage_name(func) -> str:
+    func = func[0] if isinstance(func, tuple) else func
+    module = getattr(func, "__module__", "") or ""
+    return f"{module.rsplit('.', 1)[-1]}.{getattr(func, '__qualname__', repr(func))}".lstrip(".")
+
+
+def _rows(obj) -> int | None:
+    return len(obj) if isinstance(obj, (pd.DataFrame, pd.Series)) else None
+
+
+def _memory(obj) -> int | None:
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    return None
+
+
+class Stage:
+    """Context manager recording one stage. Set `output` to the stage result before exiting."""
+
+    def __init__(self, name: str, frame=None):
+        self.name = name
+        self.frame = frame
+        self.output = None
+        self.child_peak = 0
+        self.shared = False
+
+    def __enter__(self) -> "Stage":
+        stack = _stack()
+        self.memory_in = _memory(self.frame)
+
+        with _lock:
+            # the peak reached so far belongs to the enclosing stage
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, tracemalloc.get_traced_memory()[1])
+
+            self.depth = len(stack)
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+
+            # the peak is process-wide: it is only reset when no other thread is in a stage
+            if any(s.thread != threading.get_ident() for s in _open):
+                self.shared = True
+                for other in _open:
+                    other.shared = True
+            else:
+                tracemalloc.reset_peak()
+
+            self.thread = threading.get_ident()
+            _open.add(self)
+            listeners = list(_listeners)
+
+        for listener in listeners:
+            listener("start", self)
+
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        wall = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+
+        with _lock:
+            _open.discard(self)
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+                stack[-1].shared = stack[-1].shared or self.shared
+
+        self.record = {
+            "stage": self.name,
+            "depth": self.depth,
+            "wall_s": round(wall, 6),
+            "rows_in": _rows(self.frame),
+            "rows_out": _rows(self.output),
+            "memory_in_mb": None if self.memory_in is None else round(self.memory_in / 1e6, 3),
+            "memory_out_mb": None if _memory(self.output) is None else round(_memory(self.output) / 1e6, 3),
+            "peak_delta_mb": round((peak - self.traced_start) / 1e6, 3),
+            "peak_shared": self.shared,
+            "failed": exc[0] is not None,
+        }
+        with _lock:
+            _records.append(self.record)
+            listeners = list(_listeners)
+        logger.debug(json.dumps(self.record))
+
+        for listener in listeners:
+            listener("end", self)
+
+        # don't keep the frames alive
+        self.frame = self.output = None
+
+
+def _instrumented_pipe(self, func, *args, **kwargs):
+    with Stage(_stage_name(func), self) as stage:
+        result = stage.output = _original_pipe(self, func, *args, **kwargs)
+    return result
+
+
+def enabled() -> bool:
+    """Whether instrumentation is enabled"""
+    return pd.DataFrame.pipe is _instrumented_pipe
+
+
+def enable() -> None:
+    """Instrument every DataFrame.pipe call, and write a report when the process exits"""
+
+    if enabled():
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    pd.DataFrame.pipe = _instrumented_pipe
+    atexit.register(write_report)
+
+
+def enable_from_env() -> None:
+    """Enable instrumentation if the HF_INSTRUMENT environment variable is set. Called by the entry points"""
+
+    if os.environ.get("HF_INSTRUMENT"):
+        enable()
+
+
+def disable() -> None:
+    """Restore the original DataFrame.pipe"""
+
+    pd.DataFrame.pipe = _original_pipe
+    atexit.unregister(write_report)
+
+
+def stage(name: str, frame=None):
+    """Record a block of code that is not a .pipe call (e.g. a chart function) as a stage
+
+    Returns a no-op context manager when instrumentation is disabled.
+    """
+
+    return Stage(name, frame) if enabled() else nullcontext()
+
+
+def add_listener(listener) -> None:
+    """Call `listener(event, stage)` when a stage starts ("start") and ends ("end")"""
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener) -> None:
+    """Stop calling a listener added with `add_listener`"""
+    with _lock:
+        _listeners.remove(listener)
+
+
+def records() -> list[dict]:
+    """The stages recorded so far"""
+    with _lock:
+        return list(_records)
+
+
+def report() -> pd.DataFrame:
+    """Summary of the recorded stages: calls, total and maximum time, rows and peak memory"""
+
+    recorded = records()
+    if not recorded:
+        return pd.DataFrame()
+
+    return (pd.DataFrame(recorded)
+            .groupby("stage", as_index=False)
+            .agg(calls=("wall_s", "size"),
+                 total_s=("wall_s", "sum"),
+                 max_s=("wall_s", "max"),
+                 max_rows_in=("rows_in", "max"),
+                 max_rows_out=("rows_out", "max"),
+                 max_peak_delta_mb=("peak_delta_mb", "max"))
+            .sort_values("total_s", ascending=False)
+            .reset_index(drop=True)
+            )
+
+
+def write_report(path: Path | None = None) -> Path | None:
+    """Write all records and the summary as json, and log the summary"""
+
+    recorded = records()
+    if not recorded:
+        return None
+
+    path = path or PATHS.logs / "instrumentation" / f"run_{datetime.now():%Y%m%d_%H%M%S}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    summary = report()
+    path.write_text(json.dumps({"summary": summary.to_dict(orient="records"), "stages": recorded},
+                               indent=2, default=str))
+
+    logger.info(f"Stage report ({path}):\n{summary.head(25).to_string(index=False)}")
+
+    return path
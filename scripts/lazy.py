@@ -0,0 +1,38 @@
+"""Deferred imports for heavy dependencies.
+
+`country_converter`, `bblocks`, `oda_data` and `pydeflate` load large reference tables
+(or other heavy packages) when imported. Modules use these helpers so that the cost is
+only paid by the code paths that actually call them.
+"""
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """A module that is imported the first time one of its attributes is accessed"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self) -> types.ModuleType:
+        if self.__dict__["_module"] is None:
+            self.__dict__["_module"] = importlib.import_module(self.__name__)
+        return self.__dict__["_module"]
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+
+def lazy_function(module: str, name: str):
+    """A function that imports `module` and calls `module.name` when it is first called"""
+
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module), name)(*args, **kwargs)
+
+    call.__name__ = call.__qualname__ = name
+    call.__module__ = module
+    call.__doc__ = f"Lazily imported `{module}.{name}`"
+
+    return call
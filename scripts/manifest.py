@@ -0,0 +1,262 @@
+"""Machine-readable manifest of the artifacts produced by a run.
+
+Each `track` block is recorded under "blocks" with the hashes of its inputs, its wall time,
+the CPU time of its thread, the peak resident memory of the process when it ended (a
+process-wide high-water mark, not the memory of the block) and the artifacts it wrote.
+Every output written through `write_csv` is recorded under "artifacts" with the block
+that produced it and its rows and size on disk. The manifest is saved to
+`PATHS.logs / "manifests" / "<run id>.json"` when the process exits. Scripts run with the
+same HF_RUN_ID environment variable add to the same manifest.
+
+When frames are kept (see `keep_frames`), the frames written with `write_csv` are also
+kept in memory and `read_csv` returns them without reading the file back, so that a
+single process running several stages (see `scripts.pipeline`) only parses each csv once.
+
+Compare two runs (e.g. two data releases) with:
+    python -m scripts.manifest compare <old manifest> <new manifest> --threshold 0.5
+"""
+
+import argparse
+import atexit
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from scripts import writers
+from scripts.analysis.checkpoint import file_hash
+from scripts.config import PATHS
+from scripts.logger import logger
+
+RUN_ID: str = os.environ.get("HF_RUN_ID", f"{datetime.now():%Y%m%d_%H%M%S}")
+
+# metrics compared between runs, by section of the manifest
+METRICS = {"blocks": ["duration_s", "cpu_s", "process_peak_rss_mb"], "artifacts": ["size_bytes", "rows"]}
+
+# blocks and artifacts are recorded from the pipeline threads and the writer threads
+_blocks: dict[str, dict] = {}
+_entries: dict[str, dict] = {}
+_lock = threading.Lock()
+_frames: dict[Path, pd.DataFrame] | None = None
+
+# tracked blocks are per thread, so that concurrent stages register their own outputs
+_local = threading.local()
+
+
+def _tracking() -> list[dict]:
+    if not hasattr(_local, "tracking"):
+        _local.tracking = []
+    return _local.tracking
+
+
+def manifest_path(run_id: str = RUN_ID) -> Path:
+    return PATHS.logs / "manifests" / f"{run_id}.json"
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1e3
+
+
+@contextmanager
+def track(producer: str, inputs: list[Path] = ()):
+    """Track a block of code and the artifacts it writes
+
+    The CPU time is that of the thread running the block (outputs written by the
+    background writers are not included).
+
+    Args:
+        producer: the name of the function producing the artifacts
+        inputs: the files the block reads. Their hashes are recorded
+    """
+
+    block = {"producer": producer,
+             "inputs": {Path(p).name: file_hash(Path(p)) for p in inputs if Path(p).exists()},
+             "outputs": []}
+    _tracking().append(block)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+
+    try:
+        yield block
+    finally:
+        _tracking().remove(block)
+        entry = {
+            "producer": producer,
+            "inputs": block["inputs"],
+            "duration_s": round(time.perf_counter() - start, 4),
+            "cpu_s": round(time.thread_time() - cpu_start, 4),
+            "process_peak_rss_mb": round(_peak_rss_mb(), 1),
+            "outputs": [path.name for path, _ in block["outputs"]],
+            "created": datetime.now().isoformat(timespec="seconds"),
+        }
+
+        with _lock:
+            _blocks[producer] = entry
+            for path, rows in block["outputs"]:
+                _entries[path.name] = _entry(path, rows, producer)
+
+
+def _entry(path: Path, rows: int | None, producer: str) -> dict:
+    return {
+        "artifact": path.name,
+        "path": str(path),
+        "producer": producer,
+        "rows": rows,
+        "size_bytes": path.stat().st_size if path.exists() else None,
+        "created": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def register(path: Path, rows: int | None = None) -> None:
+    """Register an artifact. Artifacts written outside a `track` block have no producer block"""
+
+    path = Path(path)
+    if _tracking():
+        _tracking()[-1]["outputs"].append((path, rows))
+    else:
+        with _lock:
+            _entries[path.name] = _entry(path, rows, "untracked")
+
+
+def write_csv(df: pd.DataFrame, path: Path) -> pd.DataFrame:
+    """Write a dataframe (without the index) and register it in the manifest
+
+    The dataframe is written to `path` and/or next to it in the other output formats, by
+    the background writers (see `scripts.writers`).
+    """
+
+    for output in writers.write_background(df, path).values():
+        register(output, rows=len(df))
+
+    if _frames is not None:
+        # categories are read back from csv with the type of their values
+        _frames[Path(path)] = df.reset_index(drop=True).astype(
+            {col: dtype.categories.dtype for col, dtype in df.dtypes.items()
+             if isinstance(dtype, pd.CategoricalDtype)}
+        )
+
+    return df
+
+
+def read_csv(path: Path) -> pd.DataFrame:
+    """Read an output written by `write_csv`, from memory if frames are kept
+
+    Otherwise it is read from disk, in the first output format it exists in (see `writers.read`).
+    """
+
+    if _frames is not None and Path(path) in _frames:
+        # a shallow copy: with copy-on-write, changes made by the caller don't reach the kept frame
+        return _frames[Path(path)].copy(deep=False)
+
+    return writers.read(Path(path))
+
+
+def keep_frames(keep: bool = True) -> None:
+    """Keep the frames written by `write_csv` in memory, so `read_csv` doesn't re-read them"""
+
+    global _frames
+    _frames = {} if keep else None
+
+
+def save(run_id: str = RUN_ID) -> Path | None:
+    """Add the blocks and artifacts of this process to the run manifest"""
+
+    with _lock:
+        blocks, entries = dict(_blocks), dict(_entries)
+
+    if not blocks and not entries:
+        return None
+
+    # outputs written in the background may not have been written when they were registered
+    for entry in entries.values():
+        output = Path(entry["path"])
+        entry["size_bytes"] = output.stat().st_size if output.exists() else None
+
+    path = manifest_path(run_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    manifest = json.loads(path.read_text()) if path.exists() else {"run_id": run_id}
+    manifest.setdefault("blocks", {}).update(blocks)
+    manifest.setdefault("artifacts", {}).update(entries)
+    manifest["updated"] = datetime.now().isoformat(timespec="seconds")
+    path.write_text(json.dumps(manifest, indent=2))
+
+    logger.info(f"{len(blocks)} blocks and {len(entries)} artifacts recorded in {path}")
+
+    return path
+
+
+atexit.register(save)
+
+
+def _inputs(manifest: dict, entry: dict) -> dict | None:
+    # the input hashes of a block, or of the block producing an artifact
+    if "inputs" in entry:
+        return entry["inputs"]
+    return manifest.get("blocks", {}).get(entry["producer"], {}).get("inputs")
+
+
+def compare(old: dict, new: dict, threshold: float = 0.5) -> pd.DataFrame:
+    """Compare two manifests, flagging blocks whose cost and artifacts whose size grew by more than `threshold`
+
+    Returns:
+        a dataframe with one row per block or artifact and metric, and a `flagged` column
+    """
+
+    rows = []
+    for section, metrics in METRICS.items():
+        for name, entry in new.get(section, {}).items():
+            before = old.get(section, {}).get(name)
+            inputs_changed = before is not None and _inputs(old, before) != _inputs(new, entry)
+            for metric in metrics:
+                current = entry.get(metric)
+                previous = before.get(metric) if before else None
+                change = (current / previous - 1) if previous and current is not None else None
+                rows.append({"section": section, "name": name, "metric": metric, "old": previous, "new": current,
+                             "change": change, "flagged": change is not None and change > threshold,
+                             "inputs_changed": inputs_changed})
+
+    return pd.DataFrame(rows)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Inspect and compare run manifests")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    show = commands.add_parser("show", help="print a manifest")
+    show.add_argument("manifest", type=Path)
+
+    diff = commands.add_parser("compare", help="flag blocks whose cost or artifacts whose size jumped")
+    diff.add_argument("old", type=Path)
+    diff.add_argument("new", type=Path)
+    diff.add_argument("--threshold", type=float, default=0.5)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        manifest = json.loads(args.manifest.read_text())
+        print(pd.DataFrame(manifest.get("blocks", {}).values()).drop(columns=["inputs"], errors="ignore")
+              .to_string(index=False))
+        print(pd.DataFrame(manifest["artifacts"].values()).drop(columns=["path"]).to_string(index=False))
+        return 0
+
+    result = compare(json.loads(args.old.read_text()), json.loads(args.new.read_text()), args.threshold)
+    flagged = result.loc[lambda d: d.flagged]
+    if flagged.empty:
+        logger.info("No block or artifact grew beyond the threshold")
+        return 0
+
+    logger.warning(f"Blocks and artifacts above the threshold:\n{flagged.to_string(index=False)}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""Run the whole analysis, or part of it, from a single command.
+
+The pipeline is a graph of stages: downloading the raw data, loading it, building the
+outputs and creating the charts. A stage runs as soon as the stages it depends on are
+done, so independent stages (e.g. the builders, or the charts) run concurrently and the
+runtime is bounded by the longest chain of dependent stages. Everything runs in one
+process: frames written by a stage are kept in memory and read from there by the stages
+that depend on them.
+
+The CRS data used by the MDB chart is not downloaded by the pipeline (it is large and
+rarely updated). When it is missing, the MDB stages are skipped with a warning. See
+`scripts.analysis.multilateral`.
+
+The engine, output formats and base years are passed to the stages (not set in `config`
+while they run), so stages running concurrently never see another run's settings.
+
+Usage:
+    python -m scripts.pipeline                      # download, build and chart everything
+    python -m scripts.pipeline --only charts.chart_1_1 --jobs 4
+    python -m scripts.pipeline --only build --no-deps
+    python -m scripts.pipeline --only export --no-deps
+    python -m scripts.pipeline --dry-run
+    python -m scripts.pipeline --only rebase --base-years 2021 2023
+    python -m scripts.pipeline --only build --income-classification historical
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from scripts import config, country_profiles, instrumentation, refresh, writers
+from scripts.analysis import common, create_data, income_levels, rebase
+from scripts.analysis.engines import ENGINES, use_engine
+from scripts.analysis.multilateral import crs_files
+from scripts.charts import charts, multilat_chart
+from scripts.config import PATHS
+from scripts.logger import logger
+from scripts.manifest import keep_frames, track
+
+
+@dataclass(frozen=True)
+class Node:
+    """A stage of the pipeline"""
+
+    name: str
+    run: Callable[[], object]
+    deps: tuple[str, ...] = ()
+    inputs: Callable[[], list[Path]] = field(default=lambda: [])
+
+
+def _ghed() -> list[Path]:
+    return [PATHS.raw_data / "ghed.csv"]
+
+
+def _crs() -> list[Path]:
+    return [path for files in crs_files(required=False).values() for path in files]
+
+
+def _load_ghed() -> None:
+    common.get_ghed_snapshot()
+    common.get_ghed_cube()
+
+
+def build_graph(base_years: list[int] | None = None) -> dict[str, Node]:
+    """The pipeline stages, by name
+
+    Args:
+        base_years: also rebase the constant USD outputs to these years. Defaults to
+            `config.BASE_YEARS`
+    """
+
+    base_years = config.BASE_YEARS if base_years is None else base_years
+    missing = [year for year, files in crs_files(required=False).items() if not files]
+    if missing:
+        logger.warning(f"No CRS data for {', '.join(map(str, missing))}: the MDB stages are skipped. "
+                       "Download it with `python -m scripts.refresh crs`")
+
+    nodes = [
+        Node("download.ghed", lambda: refresh.refresh(["ghed", "income_history"] if income_levels.historical() else ["ghed"])),
+        Node("load.ghed", _load_ghed, ("download.ghed",), _ghed),
+    ]
+
+    for file_name in create_data.OUTPUTS:
+        nodes.append(Node(f"build.{Path(file_name).stem}",
+                          lambda f=file_name: create_data.write_output(f),
+                          ("load.ghed",),
+                          _ghed))
+
+    for chart, source in charts.CHART_SOURCES.items():
+        nodes.append(Node(f"charts.{chart.__name__}",
+                          chart,
+                          (f"build.{Path(source).stem}",),
+                          lambda s=source: [PATHS.output / s]))
+
+    if not missing:
+        nodes.append(Node("multilat_chart.chart_4_1", multilat_chart.chart_4_1, (), _crs))
+
+    nodes.append(Node("export.country_profiles",
+                      country_profiles.export,
+                      (*(f"build.{Path(f).stem}" for f in country_profiles.DATASETS.values()),
+                       *([] if missing else ["multilat_chart.chart_4_1"])),
+                      lambda: [PATHS.output / f for f in country_profiles.DATASETS.values()]))
+
+    if base_years:
+        for file_name in create_data.OUTPUTS:
+            nodes.append(Node(f"rebase.{Path(file_name).stem}",
+                              lambda f=file_name: rebase.write_rebased(f, base_years),
+                              (f"build.{Path(file_name).stem}",),
+                              _ghed))
+
+        if not missing:
+            nodes.append(Node("rebase.section4_chart_1",
+                              lambda: [multilat_chart.chart_4_1(base_year=year) for year in base_years],
+                              ("multilat_chart.chart_4_1",),
+                              _crs))
+
+    return {node.name: node for node in nodes}
+
+
+def select(graph: dict[str, Node], targets: list[str] | None, deps: bool = True) -> list[str]:
+    """The stages to run for `targets`, in dependency order
+
+    Args:
+        graph: the pipeline stages
+        targets: stage names or prefixes (e.g. "build" selects every build stage).
+            Defaults to every stage
+        deps: include the stages the targets depend on
+    """
+
+    if not targets:
+        return list(graph)
+
+    selected = set()
+    for target in targets:
+        matches = [name for name in graph if name == target or name.startswith(f"{target}.")]
+        if not matches:
+            raise ValueError(f"Unknown target {target!r}. Stages: {', '.join(graph)}")
+        selected.update(matches)
+
+    if deps:
+        pending = list(selected)
+        while pending:
+            for dep in graph[pending.pop()].deps:
+                if dep not in selected:
+                    selected.add(dep)
+                    pending.append(dep)
+
+    return [name for name in graph if name in selected]
+
+
+def waves(graph: dict[str, Node], names: list[str]) -> list[list[str]]:
+    """Group stages in waves: each wave only depends on the previous ones"""
+
+    level = {}
+    for name in names:  # names are in dependency order
+        level[name] = 1 + max((level[dep] for dep in graph[name].deps if dep in level), default=-1)
+
+    return [[name for name in names if level[name] == i] for i in range(max(level.values(), default=-1) + 1)]
+
+
+def _run_node(node: Node, engine: str | None, formats: list[str] | None) -> float:
+    start = time.perf_counter()
+    with (use_engine(engine), writers.use_formats(formats),
+          instrumentation.stage(node.name), track(node.name, node.inputs())):
+        node.run()
+    return time.perf_counter() - start
+
+
+def run(graph: dict[str, Node], names: list[str], jobs: int = 1, *, engine: str | None = None,
+        formats: list[str] | None = None) -> dict[str, float]:
+    """Run stages, each one as soon as the stages it depends on are done
+
+    Stages that depend on a failed stage are skipped, and the stages already running are
+    allowed to finish before the error is raised.
+
+    Args:
+        graph, names: the stages, and the names of those to run (see `select`)
+        jobs: the number of stages run concurrently
+        engine: the engine the stages run with. Defaults to `config.ENGINE`
+        formats: the formats the stages write their outputs in. Defaults to `config.OUTPUT_FORMATS`
+
+    Returns:
+        the wall time of each stage, in seconds
+    """
+
+    keep_frames()
+
+    pending = set(names)
+    done, failed, timings = set(), {}, {}
+
+    def ready(name: str) -> bool:
+        # dependencies that are not selected are expected to be on disk already
+        return all(dep in done or dep not in names for dep in graph[name].deps)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+
+        while pending or running:
+            if not failed:
+                for name in [n for n in names if n in pending and ready(n)]:
+                    pending.discard(name)
+                    running[pool.submit(_run_node, graph[name], engine, formats)] = name
+                    logger.info(f"Started {name}")
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception as error:
+                    failed[name] = error
+                    logger.error(f"{name} failed: {error!r}")
+                else:
+                    done.add(name)
+                    logger.info(f"Finished {name} in {timings[name]:.2f}s")
+
+    # wait for the outputs still being written in the background
+    try:
+        writers.flush()
+    except Exception as error:
+        failed.setdefault("writers.flush", error)
+
+    if failed:
+        logger.error(f"Not run: {', '.join(n for n in names if n in pending) or 'none'}")
+        raise next(iter(failed.values()))
+
+    return timings
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the health financing pipeline")
+    parser.add_argument("--only", nargs="+", metavar="TARGET",
+                        help="stages (or prefixes such as 'build' or 'charts') to run, with their dependencies")
+    parser.add_argument("--no-deps", action="store_true",
+                        help="don't run the dependencies of the selected stages (read their outputs from disk)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of stages to run concurrently")
+    parser.add_argument("--dry-run", action="store_true", help="show the stages that would run, and exit")
+    parser.add_argument("--engine", choices=ENGINES, default=config.ENGINE,
+                        help="engine running the GHED aggregations and builders")
+    parser.add_argument("--base-years", nargs="+", type=int, default=config.BASE_YEARS, metavar="YEAR",
+                        help=f"also write the constant USD outputs rebased from {config.CONSTANT_YEAR} to these years")
+    parser.add_argument("--income-classification", choices=income_levels.CLASSIFICATIONS,
+                        default=config.INCOME_CLASSIFICATION,
+                        help="income groups by today's classification, or by the classification of each year")
+    parser.add_argument("--formats", nargs="+", choices=list(writers.FORMATS), default=config.OUTPUT_FORMATS,
+                        help="formats to write the outputs in")
+    args = parser.parse_args(argv)
+
+    config.INCOME_CLASSIFICATION = args.income_classification
+
+    graph = build_graph(args.base_years)
+    names = select(graph, args.only, deps=not args.no_deps)
+
+    if args.dry_run:
+        for i, wave in enumerate(waves(graph, names)):
+            print(f"{i + 1}. {', '.join(wave)}")
+        return 0
+
+    instrumentation.enable_from_env()
+    if args.jobs > 1 and instrumentation.enabled():
+        logger.info("Stages run concurrently: the memory peaks of overlapping stages are shared (peak_shared)")
+
+    start = time.perf_counter()
+    timings = run(graph, names, jobs=args.jobs, engine=args.engine, formats=args.formats)
+    logger.info(f"Ran {len(timings)} stages in {time.perf_counter() - start:.2f}s "
+                f"(sum of stage times: {sum(timings.values()):.2f}s)")
+
+    if config.DEDUPLICATE_OUTPUTS:
+        writers.prune_store()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
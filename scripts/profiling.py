@@ -0,0 +1,187 @@
+"""Profiling mode for the entry points (`--profile`).
+
+A profiled run writes, to a folder under `PATHS.logs / "profiles"`:
+
+- cpu.prof: a deterministic CPU profile (cProfile), e.g. for `snakeviz` or `pstats`
+- NNN_<stage>_<start|end>.snapshot: tracemalloc snapshots taken at the start and end of
+  the selected stages (the builders, the CRS stages), to load with `tracemalloc.Snapshot.load`
+- flame.folded: with `--flamegraph`, stacks sampled every few milliseconds, in the folded
+  format read by speedscope or flamegraph.pl
+- summary.json: the hottest functions, and the top allocations of each selected stage
+
+The hottest functions and the allocations of each stage are also logged. Stages are the
+`.pipe` calls and the `instrumentation.stage` blocks (see scripts/instrumentation.py),
+which profiling enables for the duration of the run. Only the main thread is profiled.
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import count
+from pathlib import Path
+
+from scripts import instrumentation
+from scripts.config import PATHS
+from scripts.logger import logger
+
+# Number of functions in the hot-function summary, and of allocation sites per stage
+TOP_N: int = 25
+
+# Frames kept by tracemalloc for each allocation
+TRACEMALLOC_FRAMES: int = 1
+
+# Interval between two stack samples of the flame graph, in seconds
+SAMPLE_INTERVAL: float = 0.005
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the profiling options to the parser of an entry point"""
+
+    parser.add_argument("--profile", action="store_true",
+                        help=f"write CPU and allocation profiles to {PATHS.logs / 'profiles'}")
+    parser.add_argument("--flamegraph", action="store_true",
+                        help="with --profile, also sample the stacks for a flame graph")
+
+
+class _Sampler(threading.Thread):
+    """Sample the stack of a thread at a fixed interval, counting folded stacks"""
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: Path) -> None:
+        path.write_text("".join(f"{stack} {samples}\n" for stack, samples in self.stacks.most_common()))
+
+
+def hot_functions(profiler: cProfile.Profile, n: int = TOP_N) -> list[dict]:
+    """The `n` functions with the most time spent in their own code"""
+
+    stats = pstats.Stats(profiler).stats
+    rows = [{"function": f"{Path(file).name}:{line}({name})", "calls": calls,
+             "own_s": round(own, 6), "cumulative_s": round(cumulative, 6)}
+            for (file, line, name), (_, calls, own, cumulative, _) in stats.items()]
+
+    return sorted(rows, key=lambda r: r["own_s"], reverse=True)[:n]
+
+
+def top_allocations(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, n: int = TOP_N) -> list[dict]:
+    """The `n` allocation sites that grew the most between two snapshots"""
+
+    return [{"site": str(stat.traceback), "size_diff_mb": round(stat.size_diff / 1e6, 3),
+             "count_diff": stat.count_diff}
+            for stat in after.compare_to(before, "lineno")[:n]]
+
+
+@contextmanager
+def profile(name: str, stages: tuple[str, ...] = (), flamegraph: bool = False):
+    """Profile a block of code
+
+    Args:
+        name: the name of the run, used for its folder
+        stages: prefixes of the names of the stages to snapshot allocations at
+            (e.g. "create_data.create_"). No snapshots if empty
+        flamegraph: also sample the stacks for a flame graph
+
+    Yields:
+        the folder the profiles are written to
+    """
+
+    folder = PATHS.logs / "profiles" / f"{name}_{datetime.now():%Y%m%d_%H%M%S}"
+    folder.mkdir(parents=True, exist_ok=True)
+
+    was_tracing, was_enabled = tracemalloc.is_tracing(), instrumentation.enabled()
+    if not was_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    instrumentation.enable()
+
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    profiler = cProfile.Profile()
+    snapshots: dict[int, tracemalloc.Snapshot] = {}
+    allocations = []
+    numbers = count()
+
+    def snapshot(event: str, stage: instrumentation.Stage) -> None:
+        if not stages or not stage.name.startswith(stages):
+            return
+
+        # taking and comparing snapshots is not part of the profiled run
+        profiler.disable()
+
+        current = tracemalloc.take_snapshot().filter_traces(ignored)
+        file_name = re.sub(r"[^\w.-]", "_", f"{next(numbers):03d}_{stage.name}_{event}")
+        current.dump(folder / f"{file_name}.snapshot")
+
+        if event == "start":
+            snapshots[id(stage)] = current
+        elif id(stage) in snapshots:
+            allocations.append({"stage": stage.name,
+                                "top": top_allocations(snapshots.pop(id(stage)), current)})
+
+        profiler.enable()
+
+    instrumentation.add_listener(snapshot)
+
+    sampler = _Sampler(threading.get_ident()) if flamegraph else None
+    if sampler:
+        sampler.start()
+
+    start = time.perf_counter()
+    profiler.enable()
+
+    try:
+        yield folder
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - start
+        instrumentation.remove_listener(snapshot)
+        if not was_enabled:
+            instrumentation.disable()
+        if not was_tracing:
+            tracemalloc.stop()
+
+        profiler.dump_stats(folder / "cpu.prof")
+        if sampler:
+            sampler.stopped.set()
+            sampler.join()
+            sampler.write(folder / "flame.folded")
+
+        hot = hot_functions(profiler)
+        (folder / "summary.json").write_text(json.dumps({"name": name, "wall_s": round(wall, 3),
+                                                         "hot_functions": hot,
+                                                         "allocations": allocations}, indent=2))
+
+        table = io.StringIO()
+        for row in hot:
+            table.write(f"{row['own_s']:>10.3f} {row['cumulative_s']:>10.3f} {row['calls']:>9} {row['function']}\n")
+        logger.info(f"Profile of {name} ({wall:.2f}s) written to {folder}\n"
+                    f"{'own s':>10} {'cum s':>10} {'calls':>9} function\n{table.getvalue()}")
+
+        for stage in allocations:
+            if stage["top"]:
+                top = stage["top"][0]
+                logger.info(f"{stage['stage']}: largest allocation {top['size_diff_mb']:+.1f} MB at {top['site']}")
@@ -0,0 +1,358 @@
+"""Refresh the raw data sources concurrently, through a local mirror.
+
+Sources published as a file are fetched into `PATHS.mirror` with a conditional request
+(If-None-Match / If-Modified-Since, from the ETag and Last-Modified of the previous
+fetch), and installed into the raw data folder only when their content changed, or when
+what they install is missing. The mirror index (`mirror.json`) records the validators and
+the sha256 of every file, so an unchanged source costs one request.
+
+Sources:
+- income_levels: the World Bank income classification, saved where bblocks reads it
+- income_history: the World Bank historical income classification (OGHIST), saved as a
+  country-year table for the historical income groups (see scripts/analysis/income_levels.py)
+- ghed: the GHED workbook from WHO, cleaned into ghed.csv (after income_levels, which it uses)
+- dac_deflators: the DAC deflators, downloaded by pydeflate when its cache is stale
+- crs: the CRS, downloaded by oda_data year by year: the missing years and the ones
+  requested with --crs-years. The hashes of the files of each year are tracked, and the
+  MDB checkpoints of the years that changed are removed
+
+pydeflate and oda_data don't expose their requests, so the last two are conditional on
+the age or the presence of their files instead. The conditional requests are checked by
+`python -m scripts.benchmarks.refresh`.
+
+Usage:
+    python -m scripts.refresh                       # every source
+    python -m scripts.refresh ghed --force          # ignore the mirror
+    python -m scripts.refresh --url ghed=http://localhost:8000/ghed.xlsx
+    python -m scripts.refresh crs --crs-years 2020 2021 2022
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import instrumentation, writers
+from scripts.analysis import download_data, income_levels
+from scripts.analysis.checkpoint import file_hash, remove_checkpoints
+from scripts.analysis.multilateral import (
+    MULTI_END_YEAR,
+    MULTI_START_YEAR,
+    crs_files,
+    crs_year_hashes,
+    download_crs,
+    init_paths,
+)
+from scripts.config import PATHS
+from scripts.lazy import lazy_function
+from scripts.logger import logger
+from scripts.writers import atomic_write
+
+read_dac = lazy_function("pydeflate.sources.dac", "read_dac")
+
+# Where the sources published as a file are fetched from
+URLS: dict[str, str] = {
+    "ghed": "https://apps.who.int/nha/database/Home/IndicatorsDownload/en",
+    "income_levels": "https://api.worldbank.org/v2/country?format=json&per_page=1000",
+    "income_history": "https://databankfiles.worldbank.org/public/ddpext_download/site-content/OGHIST.xlsx",
+}
+
+TIMEOUT: float = 60
+
+# CRS years downloaded again by a refresh, besides the missing ones. The CRS revises its
+# latest years, e.g. [2020, 2021, 2022]. Set with --crs-years
+CRS_YEARS: list[int] = []
+
+_index_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Source:
+    """A raw data source
+
+    Attributes:
+        name: the source name
+        refresh: refreshes the source. Called with `force` and whether a dependency
+            changed, returns whether the source changed
+        deps: sources that must be refreshed first
+    """
+
+    name: str
+    refresh: Callable[[bool, bool], bool]
+    deps: tuple[str, ...] = ()
+
+
+# ----------------------------------- mirror ---------------------------------------------
+
+
+def _index_path() -> Path:
+    return PATHS.mirror / "mirror.json"
+
+
+def read_index() -> dict:
+    """The mirror index: the url, validators and sha256 of each mirrored file"""
+
+    return json.loads(_index_path().read_text()) if _index_path().exists() else {}
+
+
+def _update_index(name: str, entry: dict) -> None:
+    with _index_lock:
+        index = read_index()
+        index[name] = entry
+        PATHS.mirror.mkdir(parents=True, exist_ok=True)
+        atomic_write(_index_path(), lambda p: p.write_text(json.dumps(index, indent=2)), deduplicate=False)
+
+
+def fetch(name: str, url: str, suffix: str = "", *, force: bool = False) -> tuple[Path, bool, dict | None]:
+    """Fetch a file into the mirror, unless it has not changed since the last fetch
+
+    The request is conditional on the validators of the last fetch of the same url, as
+    long as the mirrored file still has the recorded checksum. The index is not updated:
+    record the returned entry (with `_update_index`) once the file has been installed.
+
+    Returns:
+        the path of the mirrored file, whether its content changed, and its index entry
+        (None if it was not modified)
+    """
+
+    path = PATHS.mirror / f"{name}{suffix}"
+    entry = read_index().get(name, {})
+    valid = path.exists() and entry.get("url") == url and file_hash(path) == entry.get("sha256")
+
+    headers = {}
+    if valid and not force:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=TIMEOUT)
+    except urllib.error.HTTPError as error:
+        if error.code == 304 and headers:
+            logger.info(f"{name} not modified")
+            return path, False, None
+        raise
+
+    # the validators of the response, read before its body is streamed
+    etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    def write(temporary: Path) -> None:
+        with open(temporary, "wb") as f:
+            for block in iter(lambda: response.read(1 << 20), b""):
+                f.write(block)
+
+    with response:
+        atomic_write(path, write, deduplicate=False)
+
+    sha256 = file_hash(path)
+    changed = sha256 != entry.get("sha256")
+    logger.info(f"{name} {'changed' if changed else 'downloaded, unchanged'}")
+
+    return path, changed, {"url": url,
+                           "etag": etag,
+                           "last_modified": last_modified,
+                           "sha256": sha256,
+                           "size": path.stat().st_size,
+                           "fetched": f"{datetime.now():%Y-%m-%d %H:%M:%S}"}
+
+
+def mirrored(name: str, suffix: str, install: Callable[[Path], None], outputs: list[Path]) -> Source:
+    """A source published as a file, installed with `install(mirrored file)`
+
+    The mirror index is only updated once the file is installed, so a failed install is
+    retried (with an unconditional request) on the next refresh.
+    """
+
+    def refresh(force: bool, deps_changed: bool) -> bool:
+        path, changed, entry = fetch(name, URLS[name], suffix, force=force)
+        if changed or deps_changed or not all(p.exists() for p in outputs):
+            install(path)
+            for output in outputs:
+                writers.wait(output)
+            missing = [p.name for p in outputs if not p.exists()]
+            if missing:
+                raise RuntimeError(f"Installing {name} did not write {', '.join(missing)}")
+        if entry is not None:
+            _update_index(name, entry)
+        return changed
+
+    return Source(name, refresh)
+
+
+# ----------------------------------- sources --------------------------------------------
+
+
+def install_income_levels(path: Path) -> None:
+    """Save the World Bank income classification where bblocks reads it (see `init_paths`)"""
+
+    countries = json.loads(path.read_text())[1]
+    df = pd.DataFrame({"Code": [c["id"] for c in countries],
+                       "Income group": [c["incomeLevel"]["value"] for c in countries],
+                       "region": [c["region"]["value"] for c in countries]})
+
+    df = df.loc[lambda d: d.region != "Aggregates", ["Code", "Income group"]]
+    atomic_write(PATHS.raw_data / "income_levels.csv", lambda p: df.to_csv(p, index=False), deduplicate=False)
+
+
+def install_income_history(path: Path) -> None:
+    """Save the historical income classification as a table of iso3_code, year and income_level
+
+    The "Country Analytical History" sheet has a row per country (iso3 code first) and a
+    column per year of data (the "Data for calendar year" row), with the codes of `income_levels.LEVELS`.
+    """
+
+    sheet = pd.read_excel(path, sheet_name="Country Analytical History", header=None)
+
+    labels = sheet.iloc[:, :2].astype("str")
+    header = labels.loc[labels.apply(lambda c: c.str.startswith("Data for calendar year")).any(axis=1)].index[0]
+    years = pd.to_numeric(sheet.loc[header], errors="coerce")
+
+    df = (sheet
+          .loc[lambda d: d.iloc[:, 0].astype("str").str.fullmatch(r"[A-Z]{3}"), years.notna()]
+          .set_axis(years.dropna().astype("int64"), axis=1)
+          .assign(iso3_code=sheet.iloc[:, 0])
+          .melt(id_vars="iso3_code", var_name="year", value_name="income_level")
+          .assign(income_level=lambda d: d.income_level.map(income_levels.LEVELS))
+          .dropna(subset="income_level")
+          .sort_values(["iso3_code", "year"])
+          )
+
+    atomic_write(income_levels.history_path(), lambda p: df.to_csv(p, index=False), deduplicate=False)
+
+
+def refresh_dac_deflators(force: bool, deps_changed: bool) -> bool:
+    """Let pydeflate download the DAC deflators if its cache is stale (or `force`)"""
+
+    def signature() -> list:
+        return sorted((str(p), p.stat().st_mtime_ns) for p in PATHS.pydeflate_data.rglob("*dac*") if p.is_file())
+
+    before = signature()
+    read_dac(update=force)
+
+    return signature() != before
+
+
+def refresh_crs(force: bool, deps_changed: bool) -> bool:
+    """Download the CRS years that are missing, in `CRS_YEARS`, or all of them with `force`
+
+    Each year is downloaded (and converted) by oda_data on its own. The hashes of the
+    files of each year are compared to the ones recorded in the mirror index, and the
+    checkpoints of the years that changed (and of the MDB health data) are removed, so
+    only those years are summarised again.
+    """
+
+    years = range(MULTI_START_YEAR, MULTI_END_YEAR + 1)
+    missing = [year for year, files in crs_files(years, required=False).items() if not files]
+    download = list(years) if force else sorted(set(missing) | {year for year in CRS_YEARS if year in years})
+
+    recorded = {int(year): hashes for year, hashes in read_index().get("crs", {}).get("years", {}).items()}
+    for year in download:
+        logger.info(f"Downloading the CRS for {year}")
+        download_crs(years=[year])
+
+    hashes = crs_year_hashes(years)
+    changed = [year for year in years if (year in recorded and hashes[year] != recorded[year])
+               or (year not in recorded and year in download)]
+
+    for year in changed:
+        remove_checkpoints(f"crs_summary_{year}")
+    if changed:
+        remove_checkpoints("mdb_health")
+        logger.info(f"CRS years changed: {', '.join(map(str, changed))}")
+
+    _update_index("crs", {"years": hashes, "fetched": f"{datetime.now():%Y-%m-%d %H:%M:%S}"})
+
+    return bool(changed)
+
+
+SOURCES: dict[str, Source] = {
+    "income_levels": mirrored("income_levels", ".json", install_income_levels,
+                              [PATHS.raw_data / "income_levels.csv"]),
+    "income_history": mirrored("income_history", ".xlsx", install_income_history,
+                               [PATHS.raw_data / "income_levels_history.csv"]),
+    "ghed": Source("ghed",
+                   mirrored("ghed", ".xlsx", lambda p: download_data.download_ghed(data_file=p),
+                            [PATHS.raw_data / "ghed.csv"]).refresh,
+                   deps=("income_levels",)),
+    "dac_deflators": Source("dac_deflators", refresh_dac_deflators),
+    "crs": Source("crs", refresh_crs),
+}
+
+
+# ----------------------------------- refresh --------------------------------------------
+
+
+def refresh(names: list[str] | None = None, *, force: bool = False) -> dict[str, bool]:
+    """Refresh sources (and the sources they depend on) concurrently
+
+    A source waits for its dependencies before refreshing, and is reinstalled if one of
+    them changed.
+
+    Returns:
+        whether each source changed
+    """
+
+    selected = list(names or SOURCES)
+    for name in selected:
+        if name not in SOURCES:
+            raise ValueError(f"Unknown source {name!r}. Sources: {', '.join(SOURCES)}")
+        selected.extend(dep for dep in SOURCES[name].deps if dep not in selected)
+
+    init_paths()
+    futures: dict[str, Future] = {}
+
+    def run(source: Source) -> bool:
+        deps_changed = any([futures[dep].result() for dep in source.deps])
+        start = time.perf_counter()
+        changed = source.refresh(force, deps_changed)
+        logger.info(f"Refreshed {source.name} in {time.perf_counter() - start:.2f}s")
+        return changed
+
+    # one thread per source, so sources waiting for their dependencies don't block others
+    with ThreadPoolExecutor(max_workers=len(selected)) as pool:
+        for name in [n for n in SOURCES if n in selected]:
+            futures[name] = pool.submit(run, SOURCES[name])
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Refresh the raw data sources")
+    parser.add_argument("sources", nargs="*", metavar="SOURCE",
+                        help=f"sources to refresh ({', '.join(SOURCES)}). Defaults to all")
+    parser.add_argument("--force", action="store_true", help="download every source, ignoring the mirror")
+    parser.add_argument("--url", action="append", default=[], metavar="SOURCE=URL",
+                        help="fetch a source from another url (e.g. a local copy)")
+    parser.add_argument("--crs-years", nargs="+", type=int, default=[], metavar="YEAR",
+                        help="CRS years to download again (the latest years are revised)")
+    args = parser.parse_args(argv)
+
+    instrumentation.enable_from_env()
+    CRS_YEARS.extend(args.crs_years)
+    for override in args.url:
+        name, _, url = override.partition("=")
+        if name not in URLS:
+            parser.error(f"Sources fetched from a url: {', '.join(URLS)}")
+        URLS[name] = url
+
+    start = time.perf_counter()
+    changed = refresh(args.sources, force=args.force)
+    logger.info(f"Refreshed {len(changed)} sources in {time.perf_counter() - start:.2f}s. "
+                f"Changed: {', '.join(n for n, c in changed.items() if c) or 'none'}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""Local HTTP service answering filtered queries on the published datasets.
+
+The builder outputs and the MDB chart data are loaded into memory, with an index on each
+of the columns that can be filtered (entity, iso3 code, unit, source, condition, year, and
+region, recipient and type for the MDB data). Responses are cached (LRU) and carry an
+ETag, so clients can revalidate with If-None-Match. The datasets are reloaded when their
+files change.
+
+Usage:
+    python -m scripts.service --port 8000
+
+    GET /                                       the datasets and their columns
+    GET /gov_expenditure?entity_name=Africa&unit=percent of GDP&year=2010-2022
+    GET /expenditure_by_condition?condition=Malaria&condition=Tuberculosis&format=csv
+
+Filters can be repeated to select several values. `year` also accepts a range (2010-2022).
+Filter names and values are case-insensitive.
+
+Check the service with `python -m scripts.benchmarks.service`.
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from scripts import writers
+from scripts.config import PATHS
+from scripts.logger import logger
+
+DATASETS = {
+    "total_health_expenditure": "total_health_expenditure.csv",
+    "gov_expenditure": "gov_expenditure.csv",
+    "expenditure_by_source": "expenditure_by_source.csv",
+    "expenditure_by_condition": "expenditure_by_condition.csv",
+    "section4_chart_1": "section4_chart_1.csv",
+}
+
+# columns that can be filtered (names and values are matched case-insensitively)
+INDEXED = ["entity_name", "iso3_code", "unit", "source", "condition", "year", "region", "recipient", "type"]
+
+CACHE_SIZE: int = 512
+RELOAD_INTERVAL: float = 2.0
+
+
+class Dataset:
+    """A dataset in memory, with the row positions of each value of the indexed columns
+
+    Values are indexed in lower case (years as numbers).
+    """
+
+    def __init__(self, name: str, path: Path):
+        self.name = name
+        self.path = path
+        self.signature = self._signature()
+        self.df = writers.read(path)
+        self.version = hashlib.sha256(f"{name}{self.signature}".encode()).hexdigest()[:16]
+
+        self.columns = {col.lower(): col for col in self.df.columns if col.lower() in INDEXED}
+        self.index = {key: self._keys(key, col).pipe(lambda k: k.groupby(k, sort=False, dropna=True).indices)
+                      for key, col in self.columns.items()}
+
+    def _keys(self, key: str, col: str) -> pd.Series:
+        return self.df[col] if key == "year" else self.df[col].astype("string").str.lower()
+
+    def _signature(self) -> tuple:
+        stats = [p.stat() for p in writers.output_paths(self.path, list(writers.FORMATS)).values() if p.exists()]
+        return tuple((s.st_size, s.st_mtime_ns) for s in stats)
+
+    def changed(self) -> bool:
+        return self._signature() != self.signature
+
+    def _positions(self, key: str, values: list[str]) -> np.ndarray:
+        index = self.index[key]
+        if key == "year":
+            years = set()
+            for value in values:
+                start, _, end = value.partition("-")
+                years.update(range(int(start), int(end or start) + 1))
+            keys = {year for year in years if year in index}
+        else:
+            keys = {value.lower() for value in values} & set(index)
+
+        # sorted and without repeats, also when a value is requested twice
+        return np.unique(np.concatenate([index[k] for k in keys])) if keys else np.array([], dtype=int)
+
+    def query(self, filters: dict[str, list[str]]) -> pd.DataFrame:
+        """Rows matching every filter (and any of the values of each filter), in file order"""
+
+        unknown = set(filters) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Cannot filter {self.name} by {', '.join(sorted(unknown))}. "
+                           f"Filters: {', '.join(self.columns)}")
+
+        positions = None
+        for key, values in filters.items():
+            matches = self._positions(key, values)
+            positions = matches if positions is None else np.intersect1d(positions, matches)
+
+        if positions is None:
+            return self.df
+
+        return self.df.iloc[positions]
+
+
+class Service:
+    """The datasets, reloaded when their files change, and a cache of responses"""
+
+    def __init__(self, folder: Path = PATHS.output):
+        self.folder = folder
+        self.datasets: dict[str, Dataset] = {}
+        self.cache: OrderedDict[str, tuple[str, bytes, str]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        """Load the datasets that are new or whose files changed"""
+
+        datasets = dict(self.datasets)
+        for name, file_name in DATASETS.items():
+            dataset = datasets.get(name)
+            if dataset is not None and not dataset.changed():
+                continue
+            try:
+                datasets[name] = Dataset(name, self.folder / file_name)
+            except FileNotFoundError:
+                datasets.pop(name, None)
+                continue
+            logger.info(f"Loaded {name} ({len(datasets[name].df):,} rows)")
+
+        if datasets != self.datasets:
+            with self.lock:
+                self.datasets = datasets
+                self.cache.clear()
+
+    def watch(self, interval: float = RELOAD_INTERVAL) -> None:
+        """Reload the datasets when their files change, in a background thread"""
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as error:
+                    logger.error(f"Reload failed: {error!r}")
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def respond(self, path: str, query: str) -> tuple[str, bytes, str]:
+        """The ETag, body and content type of the response to a request (cached)"""
+
+        key = f"{path}?{query}"
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            datasets = self.datasets
+
+        response = self._build(datasets, path.strip("/"), parse_qs(query))
+
+        with self.lock:
+            if datasets is self.datasets:
+                self.cache[key] = response
+                if len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last=False)
+
+        return response
+
+    @staticmethod
+    def _build(datasets: dict[str, Dataset], name: str, params: dict[str, list[str]]) -> tuple[str, bytes, str]:
+        if not name:
+            body = json.dumps({n: {"rows": len(d.df), "columns": list(d.df.columns), "filters": list(d.columns),
+                                   "version": d.version} for n, d in datasets.items()}).encode()
+            etag = hashlib.sha256(body).hexdigest()[:16]
+            return f'"{etag}"', body, "application/json"
+
+        if name not in datasets:
+            raise LookupError(f"Unknown dataset {name!r}")
+
+        dataset = datasets[name]
+        output = params.pop("format", ["json"])[0]
+        filters = {key.lower(): [value.lower() for value in values] for key, values in params.items()}
+        result = dataset.query(filters)
+
+        if output == "csv":
+            body, content_type = result.to_csv(index=False).encode(), "text/csv"
+        else:
+            body, content_type = result.to_json(orient="records").encode(), "application/json"
+
+        request = json.dumps([output, sorted(filters.items())], default=str)
+        etag = f'"{dataset.version}-{hashlib.sha256(request.encode()).hexdigest()[:16]}"'
+
+        return etag, body, content_type
+
+
+def handler(service: Service) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                etag, body, content_type = service.respond(url.path, url.query)
+            except ValueError as error:
+                return self._send(HTTPStatus.BAD_REQUEST, str(error).encode(), "text/plain")
+            except LookupError as error:
+                return self._send(HTTPStatus.NOT_FOUND, str(error).encode(), "text/plain")
+
+            if etag in self.headers.get("If-None-Match", ""):
+                return self._send(HTTPStatus.NOT_MODIFIED, b"", content_type, etag)
+            self._send(HTTPStatus.OK, body, content_type, etag)
+
+        def _send(self, status: HTTPStatus, body: bytes, content_type: str, etag: str | None = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if etag:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            if status != HTTPStatus.NOT_MODIFIED:
+                self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt % args)
+
+    return Handler
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Serve filtered queries on the published datasets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    service = Service()
+    service.watch()
+
+    server = ThreadingHTTPServer((args.host, args.port), handler(service))
+    logger.info(f"Serving {', '.join(service.datasets)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""Writers for the published datasets.
+
+Every output is written in each of the formats in `config.OUTPUT_FORMATS` (csv, parquet
+and feather, the binary formats compressed with zstd), next to each other and with the
+same name, or in the formats selected with `use_formats` in the current thread. Other
+formats can be added with `register_format`.
+
+Writes are atomic: a file is written to a temporary file in the same folder and then
+renamed, so readers never see a partially written file.
+
+`write_background` queues a frame to be written by a pool of background threads
+(`config.WRITE_WORKERS`), so computation carries on while outputs are serialized. When
+the queued frames use more than `config.WRITE_QUEUE_MB`, it waits for writes to finish
+before queueing more. `read` (and `checkpoint.file_hash`) wait for the pending writes of
+the file they read, and `flush` waits for every write and raises if one failed. Frames
+are not copied when queued: with copy-on-write, later changes by the caller don't reach
+them. When `config.DEDUPLICATE_OUTPUTS`
+is set, files are stored once by content in a `.store` folder next to them, and the
+outputs are hard links to the stored files (copies where links are not supported), so
+identical outputs (e.g. a `section_*_download.csv` and the builder output it copies) take
+space once. Outputs are always replaced, never modified in place, so a link never changes
+the content of another output.
+"""
+
+import atexit
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+
+from scripts import config
+from scripts.config import PATHS
+from scripts.logger import logger
+
+COMPRESSION = "zstd"
+
+
+def _write_csv(df: pd.DataFrame, path: Path) -> None:
+    df.to_csv(path, index=False)
+
+
+def _write_parquet(df: pd.DataFrame, path: Path) -> None:
+    df.to_parquet(path, index=False, compression=COMPRESSION)
+
+
+def _write_feather(df: pd.DataFrame, path: Path) -> None:
+    df.reset_index(drop=True).to_feather(path, compression=COMPRESSION)
+
+
+# format: (suffix, writer, reader)
+FORMATS: dict[str, tuple[str, Callable, Callable]] = {
+    "csv": (".csv", _write_csv, pd.read_csv),
+    "parquet": (".parquet", _write_parquet, pd.read_parquet),
+    "feather": (".feather", _write_feather, pd.read_feather),
+}
+
+
+# the formats selected with `use_formats` in this thread (context), if any
+_formats: ContextVar[tuple[str, ...] | None] = ContextVar("formats", default=None)
+
+
+def register_format(name: str, suffix: str, writer: Callable[[pd.DataFrame, Path], None],
+                    reader: Callable[[Path], pd.DataFrame]) -> None:
+    """Add an output format, which can then be selected in `config.OUTPUT_FORMATS`"""
+    FORMATS[name] = (suffix, writer, reader)
+
+
+def selected_formats() -> list[str]:
+    """The output formats selected with `use_formats` in this thread, or `config.OUTPUT_FORMATS`"""
+
+    formats = _formats.get()
+    return config.OUTPUT_FORMATS if formats is None else list(formats)
+
+
+@contextmanager
+def use_formats(formats: list[str] | None):
+    """Write the outputs in these formats in this thread (threads started in the block
+    don't inherit them). None keeps the formats selected"""
+
+    token = _formats.set(_formats.get() if formats is None else tuple(formats))
+    try:
+        yield
+    finally:
+        _formats.reset(token)
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _temporary(path: Path) -> Path:
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+
+
+def store_path(path: Path, digest: str) -> Path:
+    """Where the content of `path` with this digest is stored"""
+    return path.parent / ".store" / digest[:2] / f"{digest}{path.suffix}"
+
+
+def _link(source: Path, target: Path) -> None:
+    """Atomically replace `target` with a hard link to (or a copy of) `source`"""
+
+    temporary = _temporary(target)
+    try:
+        try:
+            os.link(source, temporary)
+        except OSError:
+            shutil.copy2(source, temporary)
+        os.replace(temporary, target)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+
+def atomic_write(path: Path, write: Callable[[Path], None], deduplicate: bool | None = None) -> None:
+    """Write a file with `write(temporary path)` and move it into place
+
+    Args:
+        path: the file to write
+        write: a function writing the file to the path it is given
+        deduplicate: store the file by content and link to it. Defaults to
+            `config.DEDUPLICATE_OUTPUTS`
+    """
+
+    deduplicate = config.DEDUPLICATE_OUTPUTS if deduplicate is None else deduplicate
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = _temporary(path)
+
+    try:
+        write(temporary)
+        if not deduplicate:
+            os.replace(temporary, path)
+            return
+
+        stored = store_path(path, _sha256(temporary))
+        if not stored.exists():
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temporary, stored)
+        _link(stored, path)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+
+def output_paths(path: Path, formats: list[str] | None = None) -> dict[str, Path]:
+    """The path of an output in each format. `path` is the csv path"""
+
+    formats = formats or selected_formats()
+    return {fmt: Path(path).with_suffix(FORMATS[fmt][0]) for fmt in formats}
+
+
+def write(df: pd.DataFrame, path: Path, formats: list[str] | None = None) -> dict[str, Path]:
+    """Write a dataframe in each output format
+
+    Returns:
+        the paths written, by format
+    """
+
+    paths = output_paths(path, formats)
+    for fmt, output in paths.items():
+        atomic_write(output, lambda p, w=FORMATS[fmt][1]: w(df, p))
+
+    return paths
+
+
+class WriteQueue:
+    """Writes outputs on a pool of background threads
+
+    Writes to the same file are done in the order they were queued. Queueing waits while
+    the frames waiting to be written use more than `max_pending_mb` (unless none is waiting).
+    """
+
+    def __init__(self, workers: int, max_pending_mb: float):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="writer")
+        self.max_pending = max_pending_mb * 1e6
+        self.pending = 0
+        self.futures: dict[Path, Future] = {}
+        self.errors: dict[Path, Exception] = {}
+        self.condition = threading.Condition()
+
+    def submit(self, df: pd.DataFrame, path: Path, formats: list[str] | None = None) -> dict[str, Path]:
+        """Queue a dataframe to be written in each output format. Returns the paths"""
+
+        paths = output_paths(path, formats)
+        size = int(df.memory_usage(deep=True).sum())
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0 or self.pending + size <= self.max_pending)
+            self.pending += size
+            previous = [self.futures[p] for p in paths.values() if p in self.futures]
+            future = self.pool.submit(self._write, df, paths, size, previous)
+            self.futures.update({p: future for p in paths.values()})
+
+        return paths
+
+    def _write(self, df: pd.DataFrame, paths: dict[str, Path], size: int, previous: list[Future]) -> None:
+        try:
+            # earlier writes to the same files were submitted first, so they are running or done
+            wait_futures(previous)
+            for fmt, output in paths.items():
+                atomic_write(output, lambda p, w=FORMATS[fmt][1]: w(df, p))
+        except Exception as error:
+            with self.condition:
+                self.errors[paths[next(iter(paths))]] = error
+        finally:
+            with self.condition:
+                self.pending -= size
+                self.condition.notify_all()
+
+    def wait(self, path: Path) -> None:
+        """Wait for the pending writes of a file"""
+
+        with self.condition:
+            future = self.futures.get(Path(path))
+        if future is not None:
+            wait_futures([future])
+
+    def flush(self) -> dict[Path, Exception]:
+        """Wait for every queued write
+
+        Returns:
+            the writes that failed since the last flush, by path
+        """
+
+        with self.condition:
+            futures = set(self.futures.values())
+        wait_futures(futures)
+
+        with self.condition:
+            errors, self.errors = self.errors, {}
+            self.futures = {p: f for p, f in self.futures.items() if not f.done()}
+
+        return errors
+
+
+_queue: WriteQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def write_background(df: pd.DataFrame, path: Path, formats: list[str] | None = None) -> dict[str, Path]:
+    """Queue a dataframe to be written in each output format by the background writers
+
+    Writes synchronously when `config.WRITE_WORKERS` is 0.
+
+    Returns:
+        the paths that will be written, by format
+    """
+
+    global _queue
+
+    if config.WRITE_WORKERS <= 0:
+        return write(df, path, formats)
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = WriteQueue(config.WRITE_WORKERS, config.WRITE_QUEUE_MB)
+            atexit.register(flush)
+
+    return _queue.submit(df, path, formats)
+
+
+def wait(path: Path) -> None:
+    """Wait for the pending background writes of a file, if any"""
+
+    if _queue is not None:
+        _queue.wait(path)
+
+
+def flush() -> None:
+    """Wait for every background write, and raise the first error if any failed"""
+
+    if _queue is None:
+        return
+
+    errors = _queue.flush()
+    for path, error in errors.items():
+        logger.error(f"Writing {path} failed: {error!r}")
+
+    if errors:
+        raise next(iter(errors.values()))
+
+
+def read(path: Path) -> pd.DataFrame:
+    """Read an output from the first of the output formats it exists in (see `selected_formats`), or from csv"""
+
+    formats = selected_formats()
+    formats = [*formats, *([] if "csv" in formats else ["csv"])]
+    for fmt, output in output_paths(path, formats).items():
+        wait(output)
+        if output.exists():
+            return FORMATS[fmt][2](output)
+
+    raise FileNotFoundError(f"{path} was not written in any of the formats {formats}")
+
+
+def prune_store(folder: Path = PATHS.output) -> int:
+    """Remove stored files that are no longer linked from any output
+
+    Returns:
+        the number of files removed
+    """
+
+    removed = 0
+    for stored in (folder / ".store").glob("*/*"):
+        if stored.stat().st_nlink == 1:
+            stored.unlink()
+            removed += 1
+
+    return removed
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["prune"]:
+        logger.info(f"Removed {prune_store()} unused files from {PATHS.output / '.store'}")
+    else:
+        print("Usage: python -m scripts.writers prune")